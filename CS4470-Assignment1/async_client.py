@@ -0,0 +1,251 @@
+"""
+GUI-free asyncio client for server.py, for bots, load tests and command-line use.
+
+It speaks the same protocol as client.py (JOIN with compression offer, ACK, heartbeats,
+MESSAGE frames with sequence numbers) and reconnects the same way, see reconnect.py: backoff
+with full jitter, since=<last seq> on the JOIN of a reconnect, and an outbox for what is sent
+while disconnected. Nothing here imports tkinter, and a client is a couple of tasks on the
+caller's event loop, so thousands of them fit in one process.
+
+    async with AsyncClient('127.0.0.1', 12345, 'bot') as client:
+        await client.send("hello")
+        async for message in client:
+            print(message.seq, message.username, message.text)
+
+Received chat messages wait in a bounded inbox. While it is full the client stops reading
+from its socket, so a consumer that falls behind slows the server's sends to this client down
+(and eventually hits the server's overflow policy) instead of growing the inbox.
+"""
+import asyncio
+import contextlib
+import zlib
+from collections import deque, namedtuple
+
+import compression
+import framing
+import liveness
+import presence
+import reconnect
+import tls
+from console import log
+
+DEFAULT_INBOX_SIZE = 1000  # Received messages waiting for the caller before the socket stops being read
+
+Message = namedtuple('Message', ('seq', 'username', 'text'))  # seq is None for announcements, which are not in the history
+
+
+class UsernameTaken(Exception):
+    """Raised by connect() when another client of the room already uses the username."""
+
+
+class AsyncClient:
+    """
+    Connection of one user to server.py on the running event loop.
+    - connect() returns once the server acknowledged the JOIN, and raises OSError or UsernameTaken.
+    - send() never raises because of a dropped connection, the frame waits in the outbox.
+    - receive() returns the next Message, or None once the client is closed or gave up.
+    - members: {username: presence.ONLINE or presence.IDLE} of the room, kept up to date by the
+      server's presence updates, see presence.py. who() asks for a fresh copy.
+    - on_frame(frame_type, payload): called for the frames that are not chat messages (file transfers).
+    - ssl_context: connect with TLS. A tls.client_context() also resumes the session on reconnects
+      and can be shared by many clients, so they all resume the session of the first one.
+    """
+
+    def __init__(self, host, port, username, room=None, reconnect_delay=reconnect.DEFAULT_BASE_DELAY,
+                 max_delay=reconnect.DEFAULT_MAX_DELAY, outbox_limit=reconnect.DEFAULT_OUTBOX_LIMIT,
+                 inbox_size=DEFAULT_INBOX_SIZE, auto_reconnect=True, on_frame=None, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.room = room
+        self.auto_reconnect = auto_reconnect
+        self.on_frame = on_frame
+        self.ssl_context = ssl_context
+        self.backoff = reconnect.Backoff(reconnect_delay, max_delay)
+        self.outbox = deque()  # (frame_type, payload) waiting for a connection
+        self.outbox_limit = outbox_limit
+        self.inbox = asyncio.Queue(inbox_size)
+        self.writer = None  # None while disconnected
+        self.codec = None
+        self.last_seq = None  # Sequence number of the latest chat message received
+        self.members = {}
+        self.task = None
+        self.closed = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        """Connect, join and start receiving in the background."""
+        reader, writer, decoder = await self.open()
+        self.task = asyncio.create_task(self.run(reader, writer, decoder))
+
+    async def open(self):
+        """Open a connection and wait for the server's ACK. Return (reader, writer, decoder)."""
+        resuming = contextlib.nullcontext()
+        if isinstance(self.ssl_context, tls.ResumingContext):
+            resuming = self.ssl_context.resuming(self.host, self.port)  # Offers the session of the previous connection
+        with resuming:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl_context),
+                                                    reconnect.CONNECT_TIMEOUT)
+        try:
+            liveness.enable_keepalive(writer.get_extra_info('socket'))
+            # Offer every codec we can decode, the server names the one it picked in the ACK
+            writer.write(framing.encode_frame(framing.JOIN, framing.encode_join(
+                self.username, room=self.room, compress=','.join(compression.CODECS), since=self.last_seq)))
+            decoder = framing.FrameDecoder()
+            while True:
+                frame = await asyncio.wait_for(framing.read_frame(reader, decoder), liveness.JOIN_TIMEOUT)
+                if frame is None:
+                    raise ConnectionResetError("The server closed the connection during the handshake")
+                frame_type, payload = frame
+                if frame_type == framing.ACK:
+                    break
+                if frame_type == framing.CONTROL and payload == reconnect.USERNAME_TAKEN:
+                    raise UsernameTaken(f"Username {self.username} is already taken")
+        except BaseException:
+            writer.close()
+            raise
+        _, fields = framing.decode_join(payload)
+        self.codec = fields.get('compress') or None
+        latest = reconnect.parse_seq(fields)
+        if self.last_seq is None or latest < self.last_seq:
+            # First join (the replay ends at latest), or a server that lost its history and numbers from 0 again
+            self.last_seq = latest
+        if isinstance(self.ssl_context, tls.ResumingContext):
+            self.ssl_context.remember(writer.get_extra_info('ssl_object'), self.port)  # The session tickets arrived before the ACK
+        self.backoff.reset()
+        # The outbox goes out before anything sent from now on, write() never yields in between
+        while self.outbox:
+            writer.write(compression.encode_frame(*self.outbox.popleft(), self.codec))
+        self.writer = writer
+        return reader, writer, decoder
+
+    async def send(self, text):
+        """Send a chat message to the room."""
+        await self.send_frame(framing.DATA, text)
+
+    async def send_frame(self, frame_type, payload):
+        """Send a frame, or queue it while disconnected, then wait until the socket buffer has room."""
+        if self.writer is None:
+            self.outbox.append((frame_type, payload))
+            if len(self.outbox) > self.outbox_limit:
+                self.outbox.popleft()
+                reconnect.outbox_dropped.inc()
+            return
+        writer = self.writer
+        writer.write(compression.encode_frame(frame_type, payload, self.codec))
+        try:
+            await writer.drain()
+        except OSError:
+            pass  # The receiving task notices the dropped connection and reconnects
+
+    async def who(self):
+        """Ask the server for the members of the room, members is replaced when the answer arrives."""
+        await self.send_frame(framing.CONTROL, presence.WHO)
+
+    async def receive(self):
+        """Return the next chat message, or None once the client stopped."""
+        return await self.inbox.get()
+
+    async def close(self):
+        """Stop reconnecting, close the connection and end receive()."""
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.writer is not None:
+            # A task cancelled before it started never ran the cleanup of run()
+            self.writer.close()
+            self.writer = None
+        self.finish()
+
+    def finish(self):
+        # Wake up a caller waiting in receive(), even if the inbox is full
+        if self.inbox.full():
+            self.inbox.get_nowait()
+        self.inbox.put_nowait(None)
+
+    async def run(self, reader, writer, decoder):
+        """Receive until the connection drops, then reconnect, until the client is closed."""
+        try:
+            while True:
+                try:
+                    reason = await self.listen(reader, writer, decoder)
+                except (OSError, framing.FrameError, ValueError, zlib.error) as e:  # ValueError includes UnicodeDecodeError
+                    reason = f"Connection to the server lost: {e}"
+                finally:
+                    self.writer = None
+                    writer.close()
+                if self.closed or not self.auto_reconnect:
+                    break
+                reader, writer, decoder = await self.reconnect(reason)
+                reconnect.reconnects.inc()
+        finally:
+            if not self.closed:
+                self.finish()
+
+    async def reconnect(self, reason):
+        """Try again with backoff until a connection is acknowledged."""
+        while True:
+            delay = self.backoff.next_delay()
+            log.debug(f"{self.username}: {reason}, reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            try:
+                return await self.open()
+            except UsernameTaken:
+                # Our previous connection is still registered until the server notices it is gone
+                reason = "The previous session is still open on the server"
+            except (OSError, asyncio.TimeoutError, framing.FrameError, ValueError) as e:
+                reason = f"Cannot connect to the server at {self.host}:{self.port}: {e}"
+
+    async def listen(self, reader, writer, decoder):
+        """Receive frames until the connection ends and return why it ended."""
+        while True:
+            frame = await framing.read_frame(reader, decoder)
+            if frame is None:
+                return "The server closed the connection"
+            frame_type, payload = frame
+            if frame_type == framing.COMPRESSED:
+                frame_type, payload = compression.decompress_frame(payload, self.codec)
+            if frame_type == framing.CONTROL and payload == liveness.PING.encode():
+                # Answer the server's heartbeat, otherwise it disconnects an idle client
+                writer.write(framing.encode_frame(framing.CONTROL, liveness.PONG))
+                continue
+            if frame_type in (framing.MESSAGE, framing.DATA):
+                try:
+                    if frame_type == framing.MESSAGE:
+                        seq, text = framing.decode_message(payload)
+                        self.last_seq = seq
+                    else:
+                        seq, text = None, payload.decode('utf-8')
+                except ValueError as e:  # UnicodeDecodeError included, the frames after it are still intact
+                    log.warning(f"{self.username}: dropped a malformed message from the server: {e}")
+                    continue
+            else:
+                try:
+                    if frame_type == framing.PRESENCE:
+                        presence.apply_presence(self.members, payload)
+                    if self.on_frame is not None:
+                        self.on_frame(frame_type, payload)
+                except Exception as e:  # One frame the caller cannot handle must not stop receiving
+                    log.error(f"{self.username}: dropped a frame of type {frame_type} from the server: {e!r}")
+                continue
+            username, _, text = text.partition(": ")
+            await self.inbox.put(Message(seq, username, text))
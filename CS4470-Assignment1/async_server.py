@@ -0,0 +1,330 @@
+import asyncio
+import socket
+import ssl
+import time
+
+import compression
+import fanout
+import framing
+import history
+import liveness
+import metrics
+import persistence
+import presence
+import ratelimit
+import tls
+import transfer
+from console import log
+from registry import ConnectionRegistry
+
+# asyncio engine for the chat server. Behaves like the threaded engine in
+# server.py (username first, then messages broadcast to everyone in the room),
+# but every client runs as a task on a single event loop instead of two threads each.
+
+active_clients = ConnectionRegistry() # Registry of all active clients, indexed by id, address and username
+broadcaster = fanout.Broadcaster(fanout.AsyncClientQueue) # Outbound queue and writer task per client, replaced in configure()
+message_history = history.MessageHistory() # Recent messages of every room, replayed to joining clients, replaced in configure()
+shard = None # shards.Shard when this process is one of several worker processes
+client_tasks = set() # Keeps a reference to every running client task
+heartbeat = None # liveness.Heartbeat that pings silent clients and evicts dead ones, created in configure()
+rate_limiter = ratelimit.RateLimiter() # Message rate limits per client and per room, replaced in configure()
+room_presence = presence.Presence() # Who is online or idle in every room, broadcast as coalesced deltas, replaced in configure()
+file_relay = transfer.Relay(active_clients.find_username) # Routes file transfers between two clients of a room
+tls_context = None # SSL context when the server accepts TLS connections only, created in configure()
+PING_FRAME = framing.encode_frame(framing.CONTROL, liveness.PING)
+PONG_FRAME = framing.encode_frame(framing.CONTROL, liveness.PONG)
+PING_PAYLOAD = liveness.PING.encode() # CONTROL payload of a ping from a client
+
+# Metrics, shared with server.py (registering a name again returns the same metric, and points gauges here)
+connections_accepted = metrics.counter('chat_connections_accepted_total', "Client connections accepted")
+bytes_received = metrics.counter('chat_bytes_received_total', "Bytes of complete frames received from clients")
+messages_received = metrics.counter('chat_messages_received_total', "Chat messages received from clients")
+metrics.gauge('chat_clients_connected', "Clients that joined a room", lambda: len(active_clients))
+metrics.gauge('chat_outbound_queued_frames', "Frames waiting in the outbound queues of all clients",
+              lambda: sum(broadcaster.queue_depths().values()))
+metrics.gauge('chat_outbound_queue_max_frames', "Frames waiting in the fullest outbound queue",
+              lambda: max(broadcaster.queue_depths().values(), default=0))
+
+# Function to listen for incoming messages from the client
+async def listen_for_messages(reader, connection, decoder):
+    username = connection.username
+    bucket = rate_limiter.client_bucket()
+    while True:
+        frame = await framing.read_frame(reader, decoder)
+        if frame is None:
+            # An empty read means the client closed the connection
+            log.info(f"{username} has disconnected.")
+            break
+        frame_type, payload = frame
+        connection.last_seen = time.monotonic() # Any frame shows the client is alive
+        bytes_received.inc(framing.HEADER.size + len(payload))
+        if frame_type == framing.COMPRESSED:
+            try:
+                frame_type, payload = compression.decompress_frame(payload, connection.codec)
+            except framing.FrameError as e:
+                log.warning(f"Dropped a frame from {username}: {e}")
+                continue
+        if frame_type == framing.CONTROL and payload == PING_PAYLOAD:
+            send_to_client(PONG_FRAME, connection.sock)
+        if frame_type == framing.CONTROL and payload == presence.WHO:
+            send_presence(connection.sock, connection.room)
+        if frame_type in framing.FILE_FRAMES:
+            await relay_file_frame(connection, frame_type, payload)
+            continue
+        if frame_type != framing.DATA:
+            continue
+        try:
+            message = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            log.warning(f"Dropped a message from {username}, it is not valid UTF-8.")
+            continue
+        if message != '':
+            messages_received.inc()
+            delay = rate_limiter.admit(bucket, connection.room)
+            if delay is None:
+                log.debug(f"Dropped a message from {username}, it is over the rate limit.")
+                continue
+            final_message = f"{username}: {message}"
+            broadcast_message(final_message, connection.room)
+            room_presence.active(connection.room, username)
+            if delay > 0:
+                # Not reading from the stream lets TCP flow control slow the client down
+                await asyncio.sleep(delay)
+            # With the block policy, stop reading from this client until every queue has room
+            await broadcaster.wait_for_space()
+        else:
+            log.info(f"The message from {username} is empty.")
+
+# Function to record a chat message in the room's history and send it to everyone in the room
+def broadcast_message(message, room):
+    frame = message_history.record(room, message)
+    broadcaster.broadcast(frame, room)
+
+# Function to register a client's outbound queue and replay the room's history to it
+def join_room(writer, username, room, since, codec=None):
+    # Nothing else runs on the event loop in between, so the client gets every message exactly once
+    broadcaster.add(writer, username, room, codec)
+    ack = framing.encode_join(username, seq=message_history.latest(room), compress=codec)
+    send_to_client(framing.encode_frame(framing.ACK, ack), writer)
+    for frame in message_history.replay(room, since):
+        send_to_client(frame, writer)
+
+# Function to send the members of the room to a client, as of the last presence update
+def send_presence(writer, room):
+    send_to_client(framing.encode_frame(framing.PRESENCE, room_presence.snapshot(room)), writer)
+
+# Function to send the presence changes of every room that changed, once per presence window
+async def flush_presence():
+    while True:
+        await asyncio.sleep(room_presence.window)
+        for room, payload in room_presence.flush():
+            broadcaster.broadcast(framing.encode_frame(framing.PRESENCE, payload), room)
+
+# Function to send an encoded frame to a specific client
+def send_to_client(frame, recipient):
+    broadcaster.send(recipient, frame)
+
+# Function to read the JOIN frame of a newly accepted client, receive() returns the next bytes from the socket or TLS stream
+async def read_join(receive):
+    decoder = framing.FrameDecoder()
+    while True:
+        while not decoder.ready:
+            data = await receive()
+            if not data:
+                return None, decoder
+            decoder.ready.extend(decoder.feed(data))
+        frame_type, payload = decoder.ready.popleft()
+        if frame_type != framing.JOIN:
+            log.info(f"Expected a JOIN frame, got a frame of type {frame_type}.")
+            continue
+        try:
+            username = framing.decode_join(payload)[0]
+        except UnicodeDecodeError:
+            log.info(f"The JOIN frame is not valid UTF-8.")
+            return None, decoder
+        if username != '':
+            return payload, decoder
+        log.info(f"Client's 'username' is empty.")
+
+# Function to pass a file transfer frame on to the other client of the transfer
+async def relay_file_frame(connection, frame_type, payload):
+    route = file_relay.route(connection, frame_type, payload)
+    if route is None:
+        return
+    target, payload = route
+    # Stop reading from the sender while the receiver is behind, so the chunks do not pile up in its queue
+    while broadcaster.depth(target.sock) >= transfer.RELAY_QUEUE_LIMIT:
+        await asyncio.sleep(transfer.RELAY_WAIT)
+    send_to_client(framing.encode_frame(frame_type, payload), target.sock)
+
+# Function to ping a silent client (called by the heartbeat reaper)
+def ping_client(connection):
+    broadcaster.try_send(connection.sock, PING_FRAME)
+
+# Function to disconnect a client that stopped responding to pings
+def evict_client(connection):
+    log.info(f"{connection.username} did not answer the heartbeat, disconnecting.")
+    # The reader then sees the end of the stream and handle_client() cleans up as if the client had left
+    connection.sock.transport.abort()
+
+# Function to run the heartbeat checks once per tick
+async def reap_clients():
+    while True:
+        await asyncio.sleep(heartbeat.wheel.tick)
+        heartbeat.check()
+
+# Function to wrap an accepted socket in a TLS stream, returns (reader, writer) once the handshake is done
+async def start_tls(client):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    tls.no_delay(client)
+    transport, _ = await loop.connect_accepted_socket(lambda: protocol, client, ssl=tls_context,
+                                                      ssl_handshake_timeout=tls.HANDSHAKE_TIMEOUT)
+    tls.record_handshake(transport.get_extra_info('ssl_object'))
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+# Function to read the JOIN frame of an accepted socket, after the TLS handshake if TLS is on
+async def accept_join(client):
+    if tls_context is None:
+        loop = asyncio.get_running_loop()
+        return (*await read_join(lambda: loop.sock_recv(client, framing.RECV_SIZE)), None, None)
+    reader, writer = await start_tls(client)
+    try:
+        return (*await read_join(lambda: reader.read(framing.RECV_SIZE)), reader, writer)
+    except BaseException:
+        writer.close()
+        raise
+
+# Function to handle client
+async def handle_client(client, address, join_payload=None, decoder=None):
+    connection = None
+    writer = None
+    try:
+        if join_payload is None:
+            try:
+                # A client that never completes its handshake or sends its JOIN frame must not keep its socket forever
+                join_payload, decoder, reader, writer = await asyncio.wait_for(accept_join(client), liveness.JOIN_TIMEOUT)
+            except (asyncio.TimeoutError, ssl.SSLError) as e:
+                log.info(f"No JOIN frame from {address[0]}:{address[1]}: {str(e) or 'timed out'}")
+                join_payload = None
+            if join_payload is None:
+                if writer is not None:
+                    writer.close()
+                    writer = None
+                client.close()
+                return
+        username, fields = framing.decode_join(join_payload)
+        room = fields.get('room') or framing.DEFAULT_ROOM
+
+        # Every client of a room is served by the worker process that owns the room
+        if shard is not None and not shard.owns(room) and await shard.hand_off(client, join_payload, decoder):
+            return
+
+        if writer is None:
+            reader, writer = await asyncio.open_connection(sock=client)
+        connection = active_clients.add(writer, address, username, room)
+        if connection is None:
+            log.info(f"Username '{username}' is already taken in room '{room}'.")
+            writer.write(framing.encode_frame(framing.CONTROL, "username-taken"))
+            return
+        if heartbeat is not None:
+            heartbeat.watch(connection)
+        connection.codec = compression.negotiate(fields.get('compress'), broadcaster.compress_threshold > 0)
+        join_room(writer, username, room, history.parse_since(fields), connection.codec)
+        # The room learns about the join with the next presence delta, the client gets the members as of the last one
+        room_presence.join(room, username)
+        send_presence(writer, room)
+
+        await listen_for_messages(reader, connection, decoder)
+    except (ConnectionError, OSError, framing.FrameError, UnicodeDecodeError) as e:
+        log.warning(f"Connection with {address[0]}:{address[1]} lost: {e}")
+    finally:
+        if connection is not None:
+            room_presence.leave(connection.room, connection.username)
+            active_clients.remove(connection)
+            file_relay.drop(connection)
+        if writer is not None:
+            broadcaster.remove(writer)
+            writer.close()
+        else:
+            client.close() # Not wrapped in a stream yet, e.g. an invalid frame came before the JOIN
+
+# Function to run handle_client() as a task
+def start_client(client, address, join_payload=None, decoder=None):
+    task = asyncio.get_running_loop().create_task(handle_client(client, address, join_payload, decoder))
+    client_tasks.add(task)
+    task.add_done_callback(client_tasks.discard)
+
+# Function to accept clients on a listening socket forever
+async def accept_clients(server):
+    loop = asyncio.get_running_loop()
+    server.setblocking(False)
+    if heartbeat is not None:
+        task = loop.create_task(reap_clients())
+        client_tasks.add(task)
+    client_tasks.add(loop.create_task(flush_presence()))
+    while True:
+        client, address = await loop.sock_accept(server)
+        connections_accepted.inc()
+        liveness.enable_keepalive(client)
+        log.info(f"Connected: {address[0]}:{address[1]}.")
+        start_client(client, address)
+
+# Function to start the server and serve clients forever
+async def serve(host, port, backlog):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # AF_INET -> IPv4, SOCK_STREAM -> TCP
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((host, port))
+        log.info(f"Server is bound to the IP address {host} and port {port}.")
+    except OSError:
+        log.error(f"Server failed to bind to the IP address {host} and port {port}.")
+        server.close()
+        return
+
+    server.listen(backlog)
+    log.info(f"Server is listening on {host}:{port} (async engine)")
+    with server:
+        await accept_clients(server)
+
+# Function to create the broadcaster, the message history and the message log from the server options
+def configure(queue_size=fanout.DEFAULT_QUEUE_SIZE, overflow=fanout.DROP_OLDEST,
+              batch_bytes=0, batch_delay=fanout.DEFAULT_BATCH_DELAY, history_bytes=history.DEFAULT_MAX_BYTES,
+              history_age=history.DEFAULT_MAX_AGE, history_replay=history.DEFAULT_REPLAY_LIMIT, log_dir=None,
+              log_segment_bytes=persistence.DEFAULT_SEGMENT_BYTES, log_retention_bytes=persistence.DEFAULT_RETENTION_BYTES,
+              log_retention_age=persistence.DEFAULT_RETENTION_AGE, log_flush_interval=persistence.DEFAULT_FLUSH_INTERVAL,
+              heartbeat_interval=liveness.DEFAULT_INTERVAL, heartbeat_timeout=liveness.DEFAULT_TIMEOUT,
+              client_rate=ratelimit.DEFAULT_CLIENT_RATE, client_burst=ratelimit.DEFAULT_CLIENT_BURST,
+              room_rate=ratelimit.DEFAULT_ROOM_RATE, room_burst=ratelimit.DEFAULT_ROOM_BURST, rate_policy=ratelimit.THROTTLE,
+              compress_threshold=compression.DEFAULT_THRESHOLD, tls_cert=None, tls_key=tls.TEST_KEY,
+              presence_window=presence.DEFAULT_WINDOW, idle_after=presence.DEFAULT_IDLE_AFTER):
+    global broadcaster, message_history, heartbeat, rate_limiter, tls_context, room_presence
+    broadcaster = fanout.Broadcaster(fanout.AsyncClientQueue, queue_size, overflow, batch_bytes, batch_delay, compress_threshold)
+    message_log = None
+    if log_dir:
+        message_log = persistence.MessageLog(log_dir, log_segment_bytes, log_retention_bytes, log_retention_age, log_flush_interval)
+    message_history = history.MessageHistory(history_bytes, history_age, history_replay, message_log)
+    message_history.load()
+    rate_limiter = ratelimit.RateLimiter(client_rate, client_burst, room_rate, room_burst, rate_policy)
+    tls_context = tls.server_context(tls_cert, tls_key) if tls_cert else None
+    room_presence = presence.Presence(presence_window, idle_after)
+    heartbeat = None
+    if heartbeat_interval > 0:
+        heartbeat = liveness.Heartbeat(ping_client, evict_client, lambda connection: active_clients.get(connection.id) is connection,
+                                       heartbeat_interval, heartbeat_timeout)
+
+# Function to write the messages that are still waiting for the group commit and close the log
+def close_log():
+    if message_history.log is not None:
+        message_history.log.close()
+
+# Function to run the asyncio engine until interrupted
+def run(host, port, backlog, **options):
+    configure(**options)
+    try:
+        asyncio.run(serve(host, port, backlog))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_log()
@@ -0,0 +1,109 @@
+"""
+Benchmark of the broadcast send path with and without write batching.
+
+Fans messages out to a number of local socket pairs through fanout.Broadcaster and reports how
+many send syscalls were needed per delivered message, plus the delivery throughput.
+    python benchmarks/batching.py --clients 50 --messages 20000 --batch-bytes 16384
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fanout  # noqa: E402
+import framing  # noqa: E402
+
+
+def drain(sock, expected, done):
+    """Read frames from the receiving end of a socket pair until all of them arrived."""
+    decoder = framing.FrameDecoder()
+    received = 0
+    while received < expected:
+        data = sock.recv(framing.RECV_SIZE)
+        if not data:
+            break
+        received += len(decoder.feed(data))
+    done.release()
+
+
+def run_threaded(args, batch_bytes):
+    """Broadcast through ClientQueue writer threads and return (send syscalls, seconds)."""
+    broadcaster = fanout.Broadcaster(fanout.ClientQueue, args.messages, fanout.BLOCK, batch_bytes, args.batch_delay / 1000)
+    done = threading.Semaphore(0)
+    pairs = [socket.socketpair() for _ in range(args.clients)]
+    for index, (server_end, client_end) in enumerate(pairs):
+        broadcaster.add(server_end, f"client{index}")
+        threading.Thread(target=drain, args=(client_end, args.messages, done), daemon=True).start()
+
+    frame = framing.encode_frame(framing.DATA, 'x' * args.size)
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        broadcaster.broadcast(frame)
+    for _ in pairs:
+        done.acquire()
+    elapsed = time.perf_counter() - start
+
+    sends = sum(queue.sends for queue in broadcaster.queues.values())
+    for server_end, client_end in pairs:
+        broadcaster.remove(server_end)
+        server_end.close()
+        client_end.close()
+    return sends, elapsed
+
+
+async def run_async(args, batch_bytes):
+    """Broadcast through AsyncClientQueue writer tasks and return (send syscalls, seconds)."""
+    broadcaster = fanout.Broadcaster(fanout.AsyncClientQueue, args.messages, fanout.BLOCK, batch_bytes, args.batch_delay / 1000)
+    done = threading.Semaphore(0)
+    pairs = [socket.socketpair() for _ in range(args.clients)]
+    for index, (server_end, client_end) in enumerate(pairs):
+        _, writer = await asyncio.open_connection(sock=server_end)
+        broadcaster.add(writer, f"client{index}")
+        threading.Thread(target=drain, args=(client_end, args.messages, done), daemon=True).start()
+
+    frame = framing.encode_frame(framing.DATA, 'x' * args.size)
+    start = time.perf_counter()
+    for count in range(args.messages):
+        broadcaster.broadcast(frame)
+        if count % 64 == 0:
+            await asyncio.sleep(0)  # Let the writer tasks run, like a server reading its sockets would
+    loop = asyncio.get_running_loop()
+    for _ in pairs:
+        await loop.run_in_executor(None, done.acquire)
+    elapsed = time.perf_counter() - start
+
+    sends = sum(queue.sends for queue in broadcaster.queues.values())
+    for writer in list(broadcaster.queues):
+        broadcaster.remove(writer)
+    for _, client_end in pairs:
+        client_end.close()
+    return sends, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send syscalls per message with and without batching")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--clients', type=int, default=50, help="number of recipients")
+    parser.add_argument('--messages', type=int, default=10000, help="number of broadcast messages")
+    parser.add_argument('--size', type=int, default=100, help="message size in bytes")
+    parser.add_argument('--batch-bytes', type=int, default=16384, help="batch size used for the batched run")
+    parser.add_argument('--batch-delay', type=float, default=fanout.DEFAULT_BATCH_DELAY * 1000, help="batch age limit in milliseconds")
+    args = parser.parse_args()
+
+    deliveries = args.clients * args.messages
+    print(f"{args.engine} engine, {args.clients} clients, {args.messages} messages of {args.size} bytes")
+    print(f"{'mode':<12}{'syscalls':>12}{'per message':>14}{'messages/s':>14}")
+    for mode, batch_bytes in (('unbatched', 0), ('batched', args.batch_bytes)):
+        if args.engine == 'threaded':
+            sends, elapsed = run_threaded(args, batch_bytes)
+        else:
+            sends, elapsed = asyncio.run(run_async(args, batch_bytes))
+        print(f"{mode:<12}{sends:>12}{sends / deliveries:>14.3f}{deliveries / elapsed:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Cost of TLS for server.py: handshakes (full and resumed) and throughput.
+
+Connect time: the time from opening a connection to the server's ACK of the JOIN, measured
+with async_client.AsyncClient, for plain TCP, TLS with a full handshake every time (a client
+context that does not resume) and TLS resuming the session of the first connection
+(tls.client_context()). Sequential connects show the latency of one reconnect, the storm
+connects --storm clients at once, as after a server-side network blip. How much resumption
+saves depends mostly on the certificate: signing with the ECDSA test key is cheap, while an
+RSA-2048 key costs the server about a millisecond per full handshake, which resumption skips.
+
+Throughput: one client sends --messages messages of --size bytes and another one in the
+same room receives them, with and without TLS.
+    python benchmarks/encryption.py --engine async --connects 200 --storm 500
+"""
+import argparse
+import asyncio
+import os
+import ssl
+import statistics
+import sys
+import time
+
+from load import HOST, SOURCE_DIR, free_port, launch_server, report, stop_server, wait_for_port
+
+sys.path.insert(0, SOURCE_DIR)
+import async_client  # noqa: E402
+import tls  # noqa: E402
+
+
+def start_server(engine, secure):
+    """Start server.py and return (process, port)."""
+    port = free_port()
+    command = [sys.executable, os.path.join(SOURCE_DIR, 'server.py'), '--port', str(port), '--engine', engine,
+               '--backlog', '1024', '--history-replay', '0', '--client-rate', '0', '--room-rate', '0',
+               '--compress-threshold', '0'] + (['--tls'] if secure else [])  # No limits, and the bytes are really sent
+    server = launch_server(command)
+    wait_for_port(port)
+    return server, port
+
+
+def full_handshake_context():
+    """Return a client context that verifies the test certificate but never resumes a session."""
+    return ssl.create_default_context(cafile=tls.TEST_CERT)
+
+
+async def connect(port, username, ssl_context):
+    """Return (seconds from opening a connection to the ACK of its JOIN, whether the TLS session was resumed)."""
+    client = async_client.AsyncClient(HOST, port, username, auto_reconnect=False, ssl_context=ssl_context)
+    start = time.perf_counter()
+    await client.connect()
+    elapsed = time.perf_counter() - start
+    ssl_object = client.writer.get_extra_info('ssl_object')
+    await client.close()
+    return elapsed, ssl_object is not None and ssl_object.session_reused
+
+
+async def sequential(port, count, ssl_context, prefix):
+    """Connect count times one after the other and return (median connect time, fraction resumed)."""
+    samples = [await connect(port, f"{prefix}{index}", ssl_context) for index in range(count)]
+    return statistics.median(elapsed for elapsed, _ in samples), sum(resumed for _, resumed in samples) / count
+
+
+async def storm(port, count, ssl_context, prefix):
+    """Connect count clients at the same time and return (seconds until every JOIN was acknowledged, fraction resumed)."""
+    start = time.perf_counter()
+    samples = await asyncio.gather(*(connect(port, f"{prefix}{index}", ssl_context) for index in range(count)))
+    return time.perf_counter() - start, sum(resumed for _, resumed in samples) / count
+
+
+async def throughput(port, count, size, ssl_context):
+    """Send count messages of size bytes through the server and return the MiB/s received."""
+    sender = async_client.AsyncClient(HOST, port, 'sender', auto_reconnect=False, ssl_context=ssl_context)
+    receiver = async_client.AsyncClient(HOST, port, 'receiver', auto_reconnect=False, ssl_context=ssl_context)
+    await receiver.connect()
+    await sender.connect()
+    text = 'x' * size
+
+    async def send():
+        for _ in range(count):
+            await sender.send(text)
+
+    async def receive():
+        received = 0
+        while received < count:
+            message = await receiver.receive()
+            if message is None:
+                raise ConnectionError("The receiver lost its connection")
+            if message.username == 'sender':
+                received += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(send(), receive())
+    elapsed = time.perf_counter() - start
+    await sender.close()
+    await receiver.close()
+    return count * size / elapsed / 2**20
+
+
+async def run_benchmark(args):
+    results = {'engine': args.engine}
+    plain_server, plain_port = start_server(args.engine, False)
+    tls_server, tls_port = start_server(args.engine, True)
+    try:
+        resuming = tls.client_context()
+        await connect(tls_port, 'warmup', resuming)  # The session every later connection resumes
+
+        for mode, port, ssl_context in (('plain', plain_port, None), ('tls_full', tls_port, full_handshake_context()),
+                                        ('tls_resumed', tls_port, resuming)):
+            elapsed, resumed = await sequential(port, args.connects, ssl_context, mode)
+            results[f"connect_{mode}_ms"] = elapsed * 1000
+            if args.storm:
+                elapsed, storm_resumed = await storm(port, args.storm, ssl_context, f"storm-{mode}")
+                results[f"storm_{mode}_ms"] = elapsed * 1000
+                resumed = min(resumed, storm_resumed)
+            if ssl_context is resuming:
+                results['resumed_fraction'] = resumed  # 1.0 unless the server stopped accepting the tickets
+        results['storm_clients'] = args.storm
+
+        results['message_size'] = args.size
+        results['throughput_plain_mib_s'] = await throughput(plain_port, args.messages, args.size, None)
+        results['throughput_tls_mib_s'] = await throughput(tls_port, args.messages, args.size, resuming)
+    finally:
+        for server in (plain_server, tls_server):
+            stop_server(server)
+    results['tls_throughput_ratio'] = results['throughput_tls_mib_s'] / results['throughput_plain_mib_s']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Handshake and throughput cost of TLS (loopback only)")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='async')
+    parser.add_argument('--connects', type=int, default=100, help="sequential connects per mode")
+    parser.add_argument('--storm', type=int, default=200, help="clients connecting at once per mode, 0 skips this part")
+    parser.add_argument('--messages', type=int, default=5000, help="messages sent for the throughput test")
+    parser.add_argument('--size', type=int, default=4096, help="message size in bytes")
+    parser.add_argument('--json', help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+    report("TLS benchmark", asyncio.run(run_benchmark(args)), args.json)
+
+
+if __name__ == '__main__':
+    main()
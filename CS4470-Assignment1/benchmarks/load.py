@@ -0,0 +1,515 @@
+"""
+Load generation and latency benchmark for server.py and for a mesh of chat.py peers.
+
+Everything runs headless on 127.0.0.1. The server benchmark starts server.py and connects
+simulated clients that speak the real protocol (JOIN with the username, then DATA messages).
+Every message carries its send time, so clients that receive the broadcast can compute the
+end-to-end latency. The server's rate limits are turned off unless --rate-limits is given, so
+the results show what the server can deliver rather than what the limits let through.
+The mesh benchmark starts chat.py peers, connects every pair, and measures
+peer-to-peer delivery through their command loop. With --gossip DEGREE the peers only get a
+ring plus random links (DEGREE connections each on average) and every message is gossiped
+to the whole mesh.
+    python benchmarks/load.py server --clients 2000 --senders 20 --rate 200 --duration 10
+    python benchmarks/load.py server --engine async --workers 4 --rooms 8 --clients 4000
+    python benchmarks/load.py server --size 4096 --compress
+    python benchmarks/load.py server --engine async --tls
+    python benchmarks/load.py server --clients 200 --senders 50 --rate 2000 --rate-limits
+    python benchmarks/load.py mesh --peers 8 --rate 50 --duration 10 --selector
+    python benchmarks/load.py mesh --peers 30 --gossip 4 --rate 20
+    python benchmarks/load.py mesh --peers 8 --selector --tls
+Results are printed as a table, --json FILE also appends them as one JSON line per run so
+that regressions can be tracked over time.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, SOURCE_DIR)
+import compression  # noqa: E402
+import framing  # noqa: E402
+import tls  # noqa: E402
+
+HOST = '127.0.0.1'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+BENCH_MESSAGE = re.compile(r'Message: bench (\d+)')
+
+
+#=====================================Helpers==============================================================
+def free_port():
+    """Return a TCP port that is free on the loopback interface."""
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    """Wait until something accepts connections on the port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def launch_server(command):
+    """Start server.py in a session of its own, so that stop_server() reaches its worker processes too."""
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=SOURCE_DIR,
+                            start_new_session=True)
+
+
+def stop_server(server, timeout=10.0):
+    """Stop a server started by launch_server() and every process it started, and wait for it."""
+    if not hasattr(os, 'killpg'):
+        server.terminate()
+        server.wait()
+        return
+    try:
+        os.killpg(server.pid, signal.SIGTERM)  # The supervisor of --workers stops and joins its workers
+        server.wait(timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    except ProcessLookupError:
+        pass
+    try:
+        os.killpg(server.pid, signal.SIGKILL)  # Whatever did not stop in time
+    except ProcessLookupError:
+        pass
+    server.wait()
+
+
+def process_tree(pid):
+    """Return the pid and the pids of all descendants (Linux /proc), or just the pid elsewhere."""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def process_stats(pid):
+    """Return (resident memory in bytes, CPU seconds) of a process and its descendants, None if unknown."""
+    rss = cpu = 0
+    try:
+        for current in process_tree(pid):
+            with open(f"/proc/{current}/stat") as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+            rss += int(fields[21]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None, None
+    return rss, cpu
+
+
+def percentile(samples, fraction):
+    """Return the value below which the given fraction of the (sorted) samples lies."""
+    if not samples:
+        return float('nan')
+    index = min(len(samples) - 1, int(fraction * len(samples)))
+    return samples[index]
+
+
+def report(title, results, json_path):
+    """Print the results and append them to the JSON file if one was given."""
+    print(title)
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"  {key:<24}{value}")
+    if json_path:
+        with open(json_path, 'a') as output:
+            output.write(json.dumps({'time': time.time(), 'benchmark': title, **results}) + '\n')
+
+
+def latency_results(latencies_ns):
+    """Summarise latency samples in milliseconds."""
+    latencies_ns.sort()
+    return {
+        'latency_samples': len(latencies_ns),
+        'latency_p50_ms': percentile(latencies_ns, 0.50) / 1e6,
+        'latency_p99_ms': percentile(latencies_ns, 0.99) / 1e6,
+        'latency_p999_ms': percentile(latencies_ns, 0.999) / 1e6,
+        'latency_max_ms': (latencies_ns[-1] / 1e6) if latencies_ns else float('nan'),
+    }
+
+
+#=====================================Server benchmark=====================================================
+async def connect_client(index, port, args, semaphore, ssl_context):
+    """Open the connection of a simulated client and send its JOIN frame."""
+    async with semaphore:
+        reader, writer = await asyncio.open_connection(HOST, port, ssl=ssl_context)
+    room = f"room{index % args.rooms}"
+    offer = ','.join(compression.CODECS) if args.compress else None
+    writer.write(framing.encode_frame(framing.JOIN, framing.encode_join(f"bench{index}", room=room, compress=offer)))
+    return index, reader, writer
+
+
+async def run_client(index, reader, writer, args, start_at, counters, latencies):
+    """One simulated client: send at its share of the rate (if it is a sender) and read broadcasts."""
+    loop = asyncio.get_running_loop()
+    room = f"room{index % args.rooms}"
+    stop_at = start_at + args.duration
+
+    async def send():
+        interval = args.senders / args.rate
+        padding = 'x' * max(0, args.size - 24)
+        await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+        next_send = time.monotonic()
+        seq = 0
+        while time.monotonic() < stop_at:
+            writer.write(framing.encode_frame(framing.DATA, f"{time.monotonic_ns()} {seq} {padding}"))
+            counters['sent'] += 1
+            counters['sent_' + room] = counters.get('sent_' + room, 0) + 1
+            seq += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        await writer.drain()
+
+    sender = loop.create_task(send()) if index < args.senders else None
+    observer = index % max(1, args.clients // args.observers) == 0
+    decoder = framing.FrameDecoder()
+    codec = None
+    deadline = stop_at + args.drain
+    try:
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                data = await asyncio.wait_for(reader.read(framing.RECV_SIZE), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            now = time.monotonic_ns()
+            counters['received_bytes'] += len(data)
+            for frame_type, payload in decoder.feed(data):
+                if frame_type == framing.COMPRESSED:
+                    frame_type, payload = compression.decompress_frame(payload, codec)
+                if frame_type == framing.ACK:
+                    codec = framing.decode_join(payload)[1].get('compress') or None
+                if frame_type != framing.MESSAGE:
+                    continue  # Announcements and the ACK
+                message = payload.split(b': ', 1)[1]
+                counters['received'] += 1
+                if observer:
+                    latencies.append(now - int(message.split(b' ', 1)[0]))
+    finally:
+        if sender is not None:
+            sender.cancel()
+        writer.close()
+
+
+async def run_clients(indexes, args, port, connected, start_event, results):
+    """Run a group of simulated clients in one load generator process."""
+    counters = {'connected': 0, 'sent': 0, 'received': 0, 'received_bytes': 0}
+    latencies = []
+    loop = asyncio.get_running_loop()
+
+    # Connect everyone first (with limited concurrency), then wait for the common start time
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    ssl_context = tls.client_context() if args.tls else None
+    outcome = await asyncio.gather(*(connect_client(index, port, args, semaphore, ssl_context) for index in indexes),
+                                   return_exceptions=True)
+    errors = [repr(error) for error in outcome if isinstance(error, Exception)]
+    clients = [client for client in outcome if not isinstance(client, Exception)]
+    counters['connected'] = len(clients)
+    connected.put(len(clients))
+    start_at = await loop.run_in_executor(None, start_event.get)
+
+    runs = [run_client(index, reader, writer, args, start_at, counters, latencies) for index, reader, writer in clients]
+    outcome = await asyncio.gather(*runs, return_exceptions=True)
+    errors += [repr(error) for error in outcome if isinstance(error, Exception)]
+    results.put({'counters': counters, 'latencies': latencies, 'errors': errors[:5], 'error_count': len(errors)})
+
+
+def load_generator(indexes, args, port, connected, start_event, results):
+    """Entry point of a load generator process."""
+    asyncio.run(run_clients(indexes, args, port, connected, start_event, results))
+
+
+def benchmark_server(args):
+    """Start server.py, run the simulated clients against it and report the results."""
+    port = free_port()
+    command = [sys.executable, os.path.join(SOURCE_DIR, 'server.py'), '--port', str(port),
+               '--backlog', str(args.backlog), '--engine', args.engine, '--workers', str(args.workers)]
+    command += ['--tls'] if args.tls else []
+    command += [] if args.rate_limits else ['--client-rate', '0', '--room-rate', '0']
+    command += shlex.split(args.server_args)
+    server = launch_server(command)
+    try:
+        wait_for_port(port)
+        time.sleep(0.2)
+        rss_idle, _ = process_stats(server.pid)
+
+        connected = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        start_events = [multiprocessing.Queue() for _ in range(args.processes)]
+        groups = [list(range(group, args.clients, args.processes)) for group in range(args.processes)]
+        generators = [
+            multiprocessing.Process(target=load_generator, args=(groups[group], args, port, connected, start_events[group], results))
+            for group in range(args.processes)
+        ]
+        for generator in generators:
+            generator.start()
+        for _ in generators:
+            connected.get()
+
+        # Everyone is connected, start the traffic shortly after the JOIN announcements settled
+        start_at = time.monotonic() + 1.0
+        for event in start_events:
+            event.put(start_at)
+        time.sleep(max(0.0, start_at - time.monotonic()))
+        rss_loaded, cpu_start = process_stats(server.pid)
+        time.sleep(args.duration)
+        _, cpu_end = process_stats(server.pid)
+
+        totals = {'connected': 0, 'sent': 0, 'received': 0, 'received_bytes': 0}
+        latencies = []
+        errors = []
+        error_count = 0
+        for _ in generators:
+            outcome = results.get()
+            for key, value in outcome['counters'].items():
+                totals[key] = totals.get(key, 0) + value
+            latencies.extend(outcome['latencies'])
+            errors.extend(outcome['errors'])
+            error_count += outcome['error_count']
+        for generator in generators:
+            generator.join()
+    finally:
+        stop_server(server)
+
+    # Every message is delivered to every member of its room, the sender included
+    members = {}
+    for index in range(args.clients):
+        members[f"room{index % args.rooms}"] = members.get(f"room{index % args.rooms}", 0) + 1
+    expected = sum(totals.get('sent_' + room, 0) * count for room, count in members.items())
+    results = {
+        'engine': args.engine,
+        'workers': args.workers,
+        'tls': args.tls,
+        'clients': args.clients,
+        'rooms': args.rooms,
+        'connected': totals['connected'],
+        'client_errors': error_count,
+        'sent': totals['sent'],
+        'delivered': totals['received'],
+        'delivery_ratio': totals['received'] / expected if expected else float('nan'),
+        'delivered_per_s': totals['received'] / args.duration,
+        'received_mib_per_s': totals['received_bytes'] / args.duration / 2**20,
+        **latency_results(latencies),
+    }
+    if rss_idle is not None and rss_loaded is not None:
+        results['memory_per_conn_kib'] = (rss_loaded - rss_idle) / max(1, args.clients) / 1024
+        results['server_rss_mib'] = rss_loaded / 2**20
+    if cpu_start is not None and cpu_end is not None:
+        results['server_cpu_percent'] = 100 * (cpu_end - cpu_start) / args.duration
+    report(f"server benchmark ({' '.join(command[2:])})", results, args.json)
+    for error in errors:
+        print(f"  client error: {error}")
+
+
+#=====================================Mesh benchmark=======================================================
+class Peer:
+    """A chat.py process driven through its stdin, with a thread reading its stdout."""
+
+    def __init__(self, port, selector, options=()):
+        command = [sys.executable, '-u', os.path.join(SOURCE_DIR, 'chat.py'), str(port)] + (['--selector'] if selector else []) + list(options)
+        self.port = port
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, cwd=SOURCE_DIR, bufsize=1)
+        self.lines = queue.Queue()
+        self.latencies = []
+        self.received = 0
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def command(self, line):
+        self.process.stdin.write(line + '\n')
+        self.process.stdin.flush()
+
+    def read_output(self):
+        """Collect latencies of benchmark messages, queue every other line."""
+        for line in self.process.stdout:
+            now = time.monotonic_ns()
+            # Output of the receiving threads can interleave, so a line may hold several messages
+            sent_times = BENCH_MESSAGE.findall(line)
+            if sent_times:
+                self.received += len(sent_times)
+                self.latencies.extend(now - int(sent_time) for sent_time in sent_times)
+            else:
+                self.lines.put(line)
+
+    def connection_ids(self):
+        """Ask for the connection list and return the connection IDs."""
+        while not self.lines.empty():
+            self.lines.get_nowait()
+        self.command('list')
+        ids = []
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            try:
+                line = self.lines.get(timeout=0.2)
+            except queue.Empty:
+                if ids:
+                    break
+                continue
+            match = re.search(r'(\d+): \S+\s+\d+', line)
+            if match:
+                ids.append(int(match.group(1)))
+        return ids
+
+    def stop(self):
+        try:
+            self.command('exit')
+            self.process.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+def mesh_links(count, degree):
+    """Return the (i, j) pairs to connect: everyone when degree is 0, else a ring plus random links up to degree per peer."""
+    if not degree:
+        return [(i, j) for i in range(count) for j in range(i + 1, count)]
+    links = {tuple(sorted((i, (i + 1) % count))) for i in range(count) if count > 1}
+    candidates = [(i, j) for i in range(count) for j in range(i + 1, count) if (i, j) not in links]
+    random.shuffle(candidates)
+    extra = max(0, count * degree // 2 - len(links))
+    return sorted(links | set(candidates[:extra]))
+
+
+def benchmark_mesh(args):
+    """Start a mesh of chat.py peers, send between them and report the results."""
+    options = ['--gossip-fanout', str(args.fanout)] if args.fanout else []
+    options += ['--tls'] if args.tls else []
+    peers = [Peer(free_port(), args.selector, options) for _ in range(args.peers)]
+    try:
+        for peer in peers:
+            wait_for_port(peer.port)
+        idle = [process_stats(peer.process.pid) for peer in peers]
+        for i, j in mesh_links(args.peers, args.gossip):
+            peers[i].command(f"connect {HOST} {peers[j].port}")
+        time.sleep(0.5 + 0.02 * args.peers ** 2)
+        ids = [peer.connection_ids() for peer in peers]
+        connections = sum(len(peer_ids) for peer_ids in ids) // 2
+        loaded = [process_stats(peer.process.pid) for peer in peers]
+
+        # Every peer sends to all of its connections in turn (or gossips to everyone), at its share of the total rate
+        interval = args.peers / args.rate
+        sent = 0
+        start = time.monotonic()
+        next_send = start
+        turn = 0
+        while time.monotonic() - start < args.duration:
+            for peer, peer_ids in zip(peers, ids):
+                if args.gossip:
+                    peer.command(f"gossip all bench {time.monotonic_ns()}")
+                    sent += 1
+                elif peer_ids:
+                    peer.command(f"send {peer_ids[turn % len(peer_ids)]} bench {time.monotonic_ns()}")
+                    sent += 1
+            turn += 1
+            next_send += interval
+            time.sleep(max(0.0, next_send - time.monotonic()))
+        time.sleep(args.drain)
+        finished = [process_stats(peer.process.pid) for peer in peers]
+    finally:
+        for peer in peers:
+            peer.stop()
+
+    latencies = [latency for peer in peers for latency in peer.latencies]
+    received = sum(peer.received for peer in peers)
+    expected = sent * (args.peers - 1) if args.gossip else sent  # Gossip reaches everyone but the sender
+    results = {
+        'peers': args.peers,
+        'io': 'selector' if args.selector else 'threads',
+        'tls': args.tls,
+        'mode': f"gossip (degree {args.gossip})" if args.gossip else 'direct',
+        'connections': connections,
+        'sent': sent,
+        'delivered': received,
+        'delivery_ratio': received / expected if expected else float('nan'),
+        'delivered_per_s': received / args.duration,
+        **latency_results(latencies),
+    }
+    if all(stats[0] is not None for stats in idle + loaded + finished):
+        growth = sum(after[0] - before[0] for before, after in zip(idle, loaded))
+        results['memory_per_conn_kib'] = growth / max(1, 2 * connections) / 1024
+        results['peer_rss_mib'] = sum(stats[0] for stats in finished) / len(peers) / 2**20
+        cpu = sum(after[1] - before[1] for before, after in zip(loaded, finished))
+        results['peer_cpu_percent'] = 100 * cpu / len(peers) / (args.duration + args.drain)
+    report(f"mesh benchmark ({args.peers} peers)", results, args.json)
+
+
+#=====================================Main=================================================================
+def main():
+    # Options of both modes, given after the mode like the others
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--duration', type=float, default=10.0, help="seconds of measured traffic")
+    common.add_argument('--drain', type=float, default=2.0, help="seconds to wait for in-flight messages afterwards")
+    common.add_argument('--json', help="append the results as a JSON line to this file")
+    common.add_argument('--tls', action='store_true', help="run the server or the peers with --tls and connect with TLS")
+
+    parser = argparse.ArgumentParser(description="Load generation and latency benchmark (loopback only)")
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    server = modes.add_parser('server', parents=[common], help="benchmark server.py with simulated clients")
+    server.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    server.add_argument('--workers', type=int, default=1, help="server worker processes (async engine)")
+    server.add_argument('--rate-limits', action='store_true',
+                        help="keep the server's default rate limits, to measure them (they are disabled otherwise)")
+    server.add_argument('--server-args', default='', help="extra server.py options, e.g. \"--batch-bytes 16384\"")
+    server.add_argument('--clients', type=int, default=1000, help="number of simulated clients")
+    server.add_argument('--rooms', type=int, default=1, help="clients are spread over this many rooms")
+    server.add_argument('--senders', type=int, default=10, help="number of clients that send messages")
+    server.add_argument('--rate', type=float, default=100.0, help="total messages per second over all senders")
+    server.add_argument('--size', type=int, default=64, help="message size in bytes")
+    server.add_argument('--compress', action='store_true', help="clients offer compression in their JOIN frame")
+    server.add_argument('--observers', type=int, default=100, help="number of clients that record latencies")
+    server.add_argument('--processes', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help="load generator processes")
+    server.add_argument('--backlog', type=int, default=1024, help="listen backlog passed to the server")
+    server.add_argument('--connect-concurrency', type=int, default=200, help="connections opened at the same time")
+
+    mesh = modes.add_parser('mesh', parents=[common], help="benchmark a full mesh of chat.py peers")
+    mesh.add_argument('--peers', type=int, default=6, help="number of chat.py processes")
+    mesh.add_argument('--rate', type=float, default=50.0, help="total messages per second over all peers")
+    mesh.add_argument('--selector', action='store_true', help="run the peers with the selector I/O core")
+    mesh.add_argument('--gossip', type=int, default=0, metavar='DEGREE',
+                      help="connect every peer to about DEGREE others instead of all, and gossip every message to the mesh")
+    mesh.add_argument('--fanout', type=int, help="gossip fanout passed to the peers")
+
+    args = parser.parse_args()
+    if args.mode == 'server':
+        args.senders = max(1, min(args.senders, args.clients))
+        args.observers = max(1, min(args.observers, args.clients))
+        benchmark_server(args)
+    else:
+        benchmark_mesh(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Startup benchmark of the headless client and the other entry points.
+
+Import time: every module is imported in a fresh interpreter, several times, and the median
+time of the import statement itself is reported (interpreter startup is not included). The
+headless client has a budget, IMPORT_TARGET_MS on top of `import asyncio` (which its callers
+pay anyway), and must not load any of HEAVY_MODULES. The exit status is 1 when either check
+fails, so the benchmark guards against an import that drags tkinter or http.server in again.
+
+Connect time: starts server.py and connects --clients async_client.AsyncClient instances from
+this one process, reporting the time until every JOIN is acknowledged.
+    python benchmarks/startup.py --runs 10 --clients 500
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from load import HOST, SOURCE_DIR, free_port, launch_server, report, stop_server, wait_for_port
+
+sys.path.insert(0, SOURCE_DIR)
+import async_client  # noqa: E402
+
+IMPORT_TARGET_MS = 25.0  # Budget of `import async_client` beyond `import asyncio`
+HEAVY_MODULES = ('tkinter', 'http.server', 'logging.handlers')  # Only the GUI, the metrics endpoint and console.setup() need them
+MODULES = ('asyncio', 'async_client', 'reconnect', 'client', 'chat', 'server')
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+HEAVY_SCRIPT = "import sys, async_client; print(','.join(name for name in {!r} if name in sys.modules))"
+
+
+def import_time(module, runs):
+    """Return the median seconds `import module` takes in a fresh interpreter."""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module)], cwd=SOURCE_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(float(output))
+    return statistics.median(samples)
+
+
+async def connect_clients(port, count, concurrency):
+    """Connect count clients and return (seconds until all joined, clients)."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect(index):
+        client = async_client.AsyncClient(HOST, port, f"startup{index}", auto_reconnect=False)
+        async with semaphore:
+            await client.connect()
+        return client
+
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(connect(index) for index in range(count)))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(client.close() for client in clients))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import and connect time of the headless client")
+    parser.add_argument('--runs', type=int, default=7, help="fresh interpreters per module")
+    parser.add_argument('--clients', type=int, default=200, help="headless clients connected from one process, 0 skips this part")
+    parser.add_argument('--concurrency', type=int, default=100, help="connections opened at the same time")
+    parser.add_argument('--json', help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    results = {f"import_{module}_ms": import_time(module, args.runs) * 1000 for module in MODULES}
+    results['client_import_over_ms'] = results['import_async_client_ms'] - results['import_asyncio_ms']
+    results['overhead_target_ms'] = IMPORT_TARGET_MS
+    results['heavy_modules_loaded'] = subprocess.run([sys.executable, '-c', HEAVY_SCRIPT.format(HEAVY_MODULES)], cwd=SOURCE_DIR,
+                                                     capture_output=True, text=True, check=True).stdout.strip() or 'none'
+    if args.clients:
+        port = free_port()
+        server = launch_server([sys.executable, os.path.join(SOURCE_DIR, 'server.py'), '--port', str(port),
+                                '--engine', 'async', '--backlog', '1024', '--history-replay', '0'])
+        try:
+            wait_for_port(port)
+            elapsed = asyncio.run(connect_clients(port, args.clients, args.concurrency))
+        finally:
+            stop_server(server)
+        results['clients'] = args.clients
+        results['connect_all_ms'] = elapsed * 1000
+        results['connect_per_client_ms'] = elapsed * 1000 / args.clients
+    report("startup benchmark", results, args.json)
+    if results['client_import_over_ms'] > IMPORT_TARGET_MS or results['heavy_modules_loaded'] != 'none':
+        print(f"import async_client missed its target: {IMPORT_TARGET_MS:.0f} ms beyond asyncio and none of {', '.join(HEAVY_MODULES)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
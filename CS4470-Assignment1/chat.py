@@ -1,16 +1,42 @@
+import argparse  # Importing argparse library to parse the command-line options
+import select  # Importing select library to check whether a TLS socket has room for a heartbeat ping
 import socket  # Importing socket library for creating network connections and communication
+import ssl  # Importing ssl library for the optional TLS connections between peers
 import threading  # Importing threading library to handle multiple client connections simultaneously
 import sys  # Importing sys library to access command-line arguments and system functions
+import time  # Importing time library to timestamp the frames received for the heartbeat
+
+import console  # Level-controlled console output written by a background thread
+import framing  # Length-prefixed frames shared with server.py and client.py
+import gossip  # Group messages relayed from peer to peer across the mesh
+import liveness  # Heartbeats and TCP keepalive to detect dead peers
+import metrics  # Counters and gauges exposed on an optional HTTP endpoint
+import tls  # Optional TLS with session resumption
+import transfer  # Chunked file transfers with resume and integrity checks
+from console import log  # Console output written by a background thread
+from registry import ConnectionRegistry  # Connections indexed by id and (ip, port), with reusable IDs
+from selector_core import SelectorCore  # Optional single-threaded I/O core
 
 # Global variables
-connections = {}  # Dictionary to keep track of active connections in the format {id: (socket, (ip, port))}
+connections = ConnectionRegistry()  # Registry of active connections, looked up by ID or by (ip, port)
 peer_port = None  # Variable to store the port number this server instance is listening on
-connection_id_counter = 1  # Counter to assign unique connection IDs for each new connection
-available_ids = []  # List of reusable connection IDs, used when connections are terminated
-connections_lock = threading.Lock()  # A lock to prevent race conditions when accessing shared connection data
+io_core = None  # SelectorCore when started with --selector, None when every peer has its own thread
+heartbeat = None  # liveness.Heartbeat that pings silent peers and closes dead ones, None when disabled
+PING_FRAME = framing.encode_frame(framing.CONTROL, liveness.PING)
+transfers = transfer.Transfers()  # Files being sent and received, replaced in main()
+mesh = None  # gossip.Gossip that relays group messages, created in main()
+server_tls = None  # SSL context for accepted connections when started with --tls
+client_tls = None  # SSL context for outgoing connections, remembers the session of every peer for resumption
+
+# Metrics, served over HTTP when started with --metrics-port
+messages_received = metrics.counter('chat_peer_messages_received_total', "Messages received from peers")
+messages_sent = metrics.counter('chat_peer_messages_sent_total', "Messages sent to peers")
+bytes_received = metrics.counter('chat_peer_bytes_received_total', "Bytes of complete frames received from peers")
+bytes_sent = metrics.counter('chat_peer_bytes_sent_total', "Bytes of message frames sent to peers")
+metrics.gauge('chat_peer_connections', "Open peer connections", lambda: len(connections))
 
 # List of available commands and the command manual for the user
-commands = ['help', 'myip', 'myport', 'connect', 'list', 'terminate', 'send', 'exit']
+commands = ['help', 'myip', 'myport', 'connect', 'list', 'terminate', 'send', 'sendfile', 'gossip', 'subscribe', 'unsubscribe', 'exit']
 command_manual = """
 Available commands:
 1. help: Display information about the available user interface options or command manual.
@@ -20,7 +46,11 @@ Available commands:
 5. list: Display a numbered list of all the connections this process is part of.
 6. terminate <connection id.>: Terminate the connection listed under the specified number when LIST is used to display all connections.
 7. send <connection id> <message>: Send the message to the host on the connection that is designated by the number.
-8. exit: Close all connections and terminate this process.
+8. sendfile <connection id> <path>: Send a file to the host on the connection, it is saved in the receiver's download directory.
+9. gossip <group> <message>: Send the message to every peer of the mesh subscribed to the group, relayed by the peers in between.
+10. subscribe <group>: Show the gossip messages of the group (every peer is subscribed to "all").
+11. unsubscribe <group>: Stop showing the gossip messages of the group (they are still relayed).
+12. exit: Close all connections and terminate this process.
 """
 
 def show_help():
@@ -29,6 +59,12 @@ def show_help():
 
 def get_my_ip():
     """Retrieve and display the IP address of the machine."""
+    ip_address = find_my_ip()
+    print(f"IP Address: {ip_address}")
+    return ip_address
+
+def find_my_ip():
+    """Return the IP address of the machine, 127.0.0.1 if it cannot be determined."""
     try:
         # Create a UDP socket (this does not establish a connection)
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -41,24 +77,47 @@ def get_my_ip():
         # If there is an error, fallback to localhost and print the error message
         print(f"Error retrieving IP: {e}")
         ip_address = "127.0.0.1"
-    print(f"IP Address: {ip_address}")
     return ip_address
 
 def get_my_port():
     """Display the port number that the current instance is listening on."""
     print(f"Listening on Port: {peer_port}")
 
-def assign_connection_id():
-    """Assign a connection ID by reusing available IDs or creating a new one."""
-    global connection_id_counter
-    if available_ids:  # Check if there are any reusable connection IDs
-        # Return and remove the first reusable ID from the list
-        return available_ids.pop(0)
+def process_frame(connection, frame_type, payload):
+    """
+    Handle one frame received from a peer, for both the threaded handlers and the I/O core.
+    - Return False when the peer closed the connection (exit or terminate).
+    """
+    peer_ip, peer_port = connection.address
+    connection.last_seen = time.monotonic()  # Any frame shows the peer is alive
+    bytes_received.inc(framing.HEADER.size + len(payload))
+    if frame_type in framing.FILE_FRAMES:  # File chunks are binary, handle them before decoding text
+        transfers.handle(connection, frame_type, payload, lambda reply_type, reply: send_to_peer(connection, reply_type, reply))
+        return True
+    if frame_type == framing.GOSSIP:
+        mesh.receive(connection, payload)
+        return True
+    message = payload.decode('utf-8')
+    if frame_type == framing.CONTROL and message == liveness.PING:  # Answer a heartbeat
+        send_to_peer(connection, framing.CONTROL, liveness.PONG)
+    elif frame_type == framing.CONTROL and message == "exit":  # If the peer is exiting
+        log.info(f"Peer at {peer_ip}:{peer_port} has exited the chat.")
+        return False
+    elif frame_type == framing.CONTROL and message == "terminate":  # Handle a termination message
+        log.info(f"Connection with {peer_ip}:{peer_port} is terminated by the server.")
+        return False
+    elif frame_type == framing.DATA:  # If a regular message is received
+        messages_received.inc()
+        log.info(f"Message received from {peer_ip}:{peer_port}\nMessage: {message}")
+    return True
+
+def send_to_peer(connection, frame_type, payload):
+    """Send a frame to a peer while processing a received frame (on the I/O thread when the selector core is used)."""
+    if io_core is not None:
+        io_core.send(connection.id, frame_type, payload)
     else:
-        # If no reusable IDs, use the next available number from the counter
-        connection_id = connection_id_counter
-        connection_id_counter += 1  # Increment the counter for the next connection
-        return connection_id
+        with connection.send_lock:
+            framing.send_frame(connection.sock, frame_type, payload)
 
 def handle_client(client_socket, client_address):
     """
@@ -67,39 +126,51 @@ def handle_client(client_socket, client_address):
     - Store the client's information.
     - Continuously listen for messages from the client.
     """
-    print(f"Connection from {client_address} established.")  # Notify that a client has connected
+    log.info(f"Connection from {client_address} established.")  # Notify that a client has connected
+    connection = None
+    decoder = framing.FrameDecoder()  # Buffers partial frames between reads
     try:
         # Receive the listening port from the client, which indicates where it can receive messages
-        listening_port = client_socket.recv(1024).decode('utf-8')
-        print(f"Peer listening on port {listening_port}")
-        # Assign a unique connection ID for the new client
-        with connections_lock:  # Lock the access to shared resources to avoid race conditions
-            connection_id = assign_connection_id()
-            # Store the client's socket and its IP and listening port
-            connections[connection_id] = (client_socket, (client_address[0], listening_port))
+        client_socket.settimeout(liveness.JOIN_TIMEOUT)  # A peer that never sends its port must not keep the thread forever
+        if server_tls is not None:
+            tls.no_delay(client_socket)
+            client_socket = server_tls.wrap_socket(client_socket, server_side=True)  # TLS handshake, within the same timeout
+            tls.record_handshake(client_socket)
+        frame = framing.recv_frame(client_socket, decoder)
+        if frame is None or frame[0] != framing.JOIN:
+            raise framing.FrameError("Expected the peer's listening port as the first frame")
+        listening_port = frame[1].decode('utf-8')
+        log.info(f"Peer listening on port {listening_port}")
+        # Store the client's socket and its IP and listening port under the lowest free connection ID
+        connection = connections.add(client_socket, (client_address[0], listening_port))
+        if connection is None:
+            raise ValueError(f"Already connected to {client_address[0]}:{listening_port}")
+        client_socket.settimeout(None)
+        if heartbeat is not None:
+            heartbeat.watch(connection)
 
         # Loop to continuously listen for incoming messages from the client
         while True:
             try:
-                # Receive a message from the client (up to 1024 bytes)
-                message = client_socket.recv(1024).decode('utf-8')
-                if message:  # If a message is received, display it
-                    print(f"Message received from {client_address[0]}:{listening_port}\nMessage: {message}")
-                else:  # If no message is received, assume the connection is closed
+                # Receive the next complete frame from the client
+                frame = framing.recv_frame(client_socket, decoder)
+                if frame is None:  # If no frame is received, assume the connection is closed
+                    break
+                if not process_frame(connection, *frame):  # The peer is exiting or terminated the connection
                     break
             except Exception as e:  # Catch any exceptions while receiving messages
-                print(f"Error receiving message from {client_address}: {e}")
+                log.warning(f"Error receiving message from {client_address}: {e}")
                 break
     except Exception as e:  # Handle any initial connection errors
-        print(f"Error handling client {client_address}: {e}")
+        log.warning(f"Error handling client {client_address}: {e}")
 
     # Once the connection is closed, clean up the client's resources
+    if connection is not None:
+        transfers.drop(connection)
     client_socket.close()
-    with connections_lock:  # Lock the access to shared resources for thread safety
-        if connection_id in connections:  # Check if the connection is still listed
-            del connections[connection_id]  # Remove the connection from the dictionary
-            available_ids.append(connection_id)  # Add the ID back to the reusable pool
-            print(f"Connection with {client_address} terminated.")  # Notify that the connection has been terminated
+    # Remove the connection unless terminate_connection() already did, which frees its ID for reuse
+    if connection is not None and connections.remove(connection):
+        log.info(f"Connection with {client_address} terminated.")  # Notify that the connection has been terminated
 
 def connect_to_peer(destination, port):
     """
@@ -107,66 +178,189 @@ def connect_to_peer(destination, port):
     - Check if a connection already exists to avoid duplicate connections.
     - Start a new thread to handle incoming messages from the peer.
     """
-    with connections_lock:  # Lock the access to shared resources
-        # Check if the connection already exists to the same destination and port
-        for conn_data in connections.values():
-            existing_ip, existing_port = conn_data[1]
-            if existing_ip == destination and existing_port == port:
-                print(f"Error: Already connected to {destination}:{port}")
-                return
+    # Check if the connection already exists to the same destination and port
+    if connections.find_address((destination, port)) is not None:
+        print(f"Error: Already connected to {destination}:{port}")
+        return
+
+    if io_core is not None:
+        try:
+            ip = socket.gethostbyname(destination)  # Resolve here so the I/O thread never blocks on DNS
+        except OSError as e:
+            print(f"Failed to connect to {destination}:{port}. Error: {e}")
+            return
+        io_core.submit(io_core.connect, destination, ip, port)  # The I/O core reports the result
+        return
 
     try:
         peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a TCP socket
+        liveness.enable_keepalive(peer_socket)  # Let the kernel detect a peer that vanished
         peer_socket.connect((destination, int(port)))  # Connect to the specified destination and port
+        if client_tls is not None:
+            tls.no_delay(peer_socket)
+            # TLS handshake, resumed if we talked before
+            peer_socket = client_tls.wrap_socket(peer_socket, server_hostname=destination, session=client_tls.session_for(destination, port))
         print(f"Connected to {destination}:{port}.")
-        peer_socket.sendall(str(peer_port).encode())  # Send the local listening port to the peer
+        framing.send_frame(peer_socket, framing.JOIN, str(peer_port))  # Send the local listening port to the peer
 
         # Assign a unique ID and store the connection
-        with connections_lock:
-            connection_id = assign_connection_id()
-            connections[connection_id] = (peer_socket, (destination, port))
+        connection = connections.add(peer_socket, (destination, port))
+        if connection is None:  # Another thread connected to the same peer in the meantime
+            print(f"Error: Already connected to {destination}:{port}")
+            peer_socket.close()
+            return
+        if heartbeat is not None:
+            heartbeat.watch(connection)
 
         # Start a thread to listen for messages from this peer
-        threading.Thread(target=handle_peer_messages, args=(peer_socket, destination, port)).start()
+        threading.Thread(target=handle_peer_messages, args=(connection,)).start()
     except Exception as e:  # Catch any connection errors
         print(f"Failed to connect to {destination}:{port}. Error: {e}")
 
 def list_connections():
     """Display a list of all active connections by iterating through the connections dictionary."""
     print("ID: IP Address      Port")
-    with connections_lock:  # Lock the access to shared resources
-        for conn_id, conn_data in connections.items():
-            ip, port = conn_data[1]  # Get the IP and port from the connection data
-            print(f"{conn_id}: {ip}      {port}")  # Display the connection ID, IP, and port
+    for connection in connections.connections():
+        ip, port = connection.address  # Get the IP and port from the connection data
+        print(f"{connection.id}: {ip}      {port}")  # Display the connection ID, IP, and port
 
 def terminate_connection(conn_id):
     """
     Gracefully terminate a connection by sending a termination notice.
     - Notify the peer before closing the socket.
-    - Update the connections dictionary.
+    - Update the connection registry.
     """
-    with connections_lock:  # Lock the access to shared resources
-        if conn_id in connections:  # Verify that the connection ID exists
-            try:
-                # Notify the peer that the connection is being terminated
-                connections[conn_id][0].sendall("terminate".encode())
-                connections[conn_id][0].close()  # Close the socket connection
-                del connections[conn_id]  # Remove the connection from the dictionary
-                available_ids.append(conn_id)  # Add the connection ID back to the reusable pool
-                print(f"Connection {conn_id} terminated.")
-            except Exception as e:  # Handle any termination errors
-                print(f"Error terminating connection {conn_id}: {e}")
+    if io_core is not None:
+        if io_core.submit(io_core.terminate, conn_id).result():
+            print(f"Connection {conn_id} terminated.")
         else:
             print(f"No such connection with ID: {conn_id}")
+        return
+
+    # Remove the connection first, so its listening thread does not report the closed socket again
+    connection = connections.pop(conn_id)
+    if connection is None:  # Verify that the connection ID exists
+        print(f"No such connection with ID: {conn_id}")
+        return
+    transfers.drop(connection)
+    try:
+        # Notify the peer that the connection is being terminated
+        with connection.send_lock:
+            framing.send_frame(connection.sock, framing.CONTROL, "terminate")
+        print(f"Connection {conn_id} terminated.")
+    except Exception as e:  # Handle any termination errors
+        print(f"Error terminating connection {conn_id}: {e}")
+    finally:
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)  # Wake up the thread blocked in recv() on this socket
+        except OSError:
+            pass
+        connection.sock.close()  # Close the socket connection
 
 def send_message(conn_id, message):
     """Send a message to the specified connection ID, if it exists."""
-    with connections_lock:  # Lock the access to shared resources
-        if conn_id in connections:  # Verify the connection ID
-            connections[conn_id][0].sendall(message.encode())  # Send the message to the peer
+    if io_core is not None:
+        if io_core.submit(io_core.send, conn_id, framing.DATA, message).result():
+            record_sent(message)
             print(f"Message sent to connection {conn_id}.")
         else:
             print(f"No such connection with ID: {conn_id}")
+        return
+
+    connection = connections.get(conn_id)
+    if connection is not None:  # Verify the connection ID
+        with connection.send_lock:  # Only writes to this peer are serialised
+            framing.send_frame(connection.sock, framing.DATA, message)  # Send the message to the peer
+        record_sent(message)
+        print(f"Message sent to connection {conn_id}.")
+    else:
+        print(f"No such connection with ID: {conn_id}")
+
+def send_file(conn_id, path):
+    """Offer a file to the specified connection, the chunks follow once the peer accepts."""
+    connection = connections.get(conn_id)
+    if connection is None:
+        print(f"No such connection with ID: {conn_id}")
+        return
+    try:
+        outgoing = transfers.send(path, connection)
+    except OSError as e:
+        print(f"Cannot send {path}: {e}")
+        return
+    if io_core is not None:
+        io_core.submit(io_core.send, conn_id, framing.FILE_OFFER, outgoing.offer())
+    else:
+        with connection.send_lock:
+            framing.send_frame(connection.sock, framing.FILE_OFFER, outgoing.offer())
+    print(f"Offered {outgoing.name} ({outgoing.size} bytes) to connection {conn_id}.")
+
+def send_gossip(group, message):
+    """Send a message to every peer of the mesh subscribed to the group."""
+    if io_core is not None:
+        count = io_core.submit(mesh.publish, group, message).result()  # Gossip is sent from the I/O thread
+    else:
+        count = mesh.publish(group, message)
+    if count:
+        record_sent(message)
+        print(f"Message sent to group {group} through {count} connections.")
+    else:
+        print("No connections to send the message to.")
+
+def forward_gossip(connection, payload):
+    """Send a GOSSIP frame to one of the peers picked by the mesh."""
+    try:
+        send_to_peer(connection, framing.GOSSIP, payload)
+    except OSError as e:  # That peer's own thread notices the broken connection
+        log.warning(f"Error relaying a message to {connection.address[0]}:{connection.address[1]}: {e}")
+
+def show_gossip(origin, group, text):
+    """Display a gossip message of a subscribed group."""
+    messages_received.inc()
+    log.info(f"Message to {group} from {origin}\nMessage: {text}")
+
+def start_sending(connection, outgoing):
+    """Send the chunks of a file the peer accepted (called by transfers while a frame is processed)."""
+    if io_core is not None:
+        io_core.send_file(connection, outgoing)  # Already on the I/O thread
+    else:
+        threading.Thread(target=transfer.send_chunks, args=(connection.sock, connection.send_lock, outgoing), daemon=True).start()
+
+def ping_peer(connection):
+    """Send a heartbeat ping without waiting for a peer that does not read (called by the heartbeat)."""
+    if io_core is not None:
+        io_core.ping(connection)  # The heartbeat runs on the I/O thread
+        return
+    if not connection.send_lock.acquire(blocking=False):
+        return  # A frame is being sent right now, the peer still gets pinged again
+    try:
+        if isinstance(connection.sock, ssl.SSLSocket):
+            # TLS sockets take no send flags: only send if the socket has room, far more than a ping needs
+            if select.select([], [connection.sock], [], 0)[1]:
+                connection.sock.sendall(PING_FRAME)
+        elif connection.sock.send(PING_FRAME, socket.MSG_DONTWAIT) != len(PING_FRAME):
+            evict_peer(connection)  # Half a frame went out, the stream cannot be used anymore
+    except BlockingIOError:
+        pass  # The send buffer is full, a peer that does not read will not answer either
+    except OSError:
+        evict_peer(connection)
+    finally:
+        connection.send_lock.release()
+
+def evict_peer(connection):
+    """Close a connection whose peer stopped answering heartbeats."""
+    if io_core is not None:
+        io_core.evict(connection)
+        return
+    log.info(f"Peer at {connection.address[0]}:{connection.address[1]} did not answer the heartbeat, disconnecting.")
+    try:
+        connection.sock.shutdown(socket.SHUT_RDWR)  # Its listening thread then cleans up
+    except OSError:
+        pass
+
+def record_sent(message):
+    """Count a sent message and the size of its frame."""
+    messages_sent.inc()
+    bytes_sent.inc(framing.HEADER.size + len(message.encode('utf-8')))
 
 def exit_program():
     """
@@ -174,59 +368,60 @@ def exit_program():
     - Notify all connected peers that the local instance is exiting.
     - Terminate all connections gracefully.
     """
+    if io_core is not None:
+        for connection in connections.connections():
+            io_core.submit(io_core.terminate, connection.id, "exit")  # Inform the peer about the exit
+        io_core.submit(io_core.stop).result()  # Flush what is left and close every socket
+        print("All connections closed. Exiting program.")
+        sys.exit(0)
+
     # Notify all peers that this instance is exiting
-    for conn_id, conn_data in list(connections.items()):
+    for connection in connections.connections():
         try:
-            conn_data[0].sendall("exit".encode())  # Inform the peer about the exit
+            with connection.send_lock:
+                framing.send_frame(connection.sock, framing.CONTROL, "exit")  # Inform the peer about the exit
         except Exception as e:
-            print(f"Error sending exit message to peer {conn_data[1]}: {e}")
+            print(f"Error sending exit message to peer {connection.address}: {e}")
 
     # Terminate each connection individually
-    for conn_id in list(connections.keys()):
-        terminate_connection(conn_id)
+    for connection in connections.connections():
+        terminate_connection(connection.id)
 
-    connections.clear()  # Clear the connections dictionary
     print("All connections closed. Exiting program.")
     sys.exit(0)  # Exit the program
 
-def handle_peer_messages(peer_socket, peer_ip, peer_port):
+def handle_peer_messages(connection):
     """
     Listen for messages from a connected peer.
     - Handle different types of messages (e.g., termination, exit).
     - Clean up resources when the connection is closed.
     """
+    peer_socket = connection.sock
+    peer_ip, peer_port = connection.address
+    decoder = framing.FrameDecoder()  # Buffers partial frames between reads
     while True:
         try:
-            # Wait for a message from the peer
-            message = peer_socket.recv(1024).decode('utf-8')
-            if message == "exit":  # If the peer is exiting
-                print(f"Peer at {peer_ip}:{peer_port} has exited the chat.")
-                break
-            elif message == "terminate":  # Handle a termination message
-                print(f"Connection with {peer_ip}:{peer_port} is terminated by the server.")
+            # Wait for the next complete frame from the peer
+            frame = framing.recv_frame(peer_socket, decoder)
+            if frame is None:  # If no frame is received, the connection may be closed
                 break
-            elif message:  # If a regular message is received
-                print(f"Message received from {peer_ip}:{peer_port}\nMessage: {message}")
-            else:  # If no message is received, the connection may be closed
+            if not process_frame(connection, *frame):  # The peer exited or terminated the connection
                 break
         except ConnectionResetError:  # Handle connection reset errors gracefully
-            print(f"Error receiving message from {peer_ip}:{peer_port}: Connection reset by peer.")
+            log.warning(f"Error receiving message from {peer_ip}:{peer_port}: Connection reset by peer.")
             break
         except Exception as e:  # Catch other exceptions
-            print(f"Error receiving message from {peer_ip}:{peer_port}: {e}")
+            log.warning(f"Error receiving message from {peer_ip}:{peer_port}: {e}")
             break
 
     # Clean up after the connection is closed
+    transfers.drop(connection)
+    if client_tls is not None:
+        client_tls.remember(peer_socket, peer_port)  # The next connection to this peer resumes the TLS session
     peer_socket.close()
-    with connections_lock:
-        # Remove the peer from the connections dictionary if it exists
-        for conn_id, conn_data in list(connections.items()):
-            if conn_data[1] == (peer_ip, peer_port):
-                if conn_id in connections:
-                    del connections[conn_id]
-                    available_ids.append(conn_id)
-                    print(f"Connection with {peer_ip}:{peer_port} terminated.")
-                break
+    # Remove the peer from the connection registry if terminate_connection() has not done so already
+    if connections.remove(connection):
+        log.info(f"Connection with {peer_ip}:{peer_port} terminated.")
 
 def accept_clients(server_socket):
     """
@@ -235,7 +430,8 @@ def accept_clients(server_socket):
     """
     while True:
         client_socket, client_address = server_socket.accept()  # Wait for an incoming connection
-        print(f"New connection from {client_address}")  # Notify about the new connection
+        liveness.enable_keepalive(client_socket)  # Let the kernel detect a peer that vanished
+        log.info(f"New connection from {client_address}")  # Notify about the new connection
         # Start a new thread to manage the connected client
         threading.Thread(target=handle_client, args=(client_socket, client_address)).start()
 
@@ -245,18 +441,55 @@ def main():
     - Set up the server to listen for incoming connections.
     - Create a user interface loop to process commands.
     """
-    global peer_port  # Access the global peer_port variable
-    if len(sys.argv) != 2:  # Verify that a port number has been provided
-        print("Usage: python chat.py <port>")  # Display usage instructions
-        sys.exit(1)
-    peer_port = int(sys.argv[1])  # Assign the specified port number
+    global peer_port, io_core, heartbeat, transfers, mesh, server_tls, client_tls  # Access the global variables set up here
+    # Parse the port number and the options
+    parser = argparse.ArgumentParser(description="CS 4470 peer-to-peer chat")
+    parser.add_argument('port', type=int, help="port to listen on for peer connections")
+    parser.add_argument('--selector', action='store_true', help="multiplex all sockets on a single I/O thread")
+    parser.add_argument('--heartbeat-interval', type=float, default=liveness.DEFAULT_INTERVAL,
+                        help="seconds of silence after which a peer is pinged (0 disables heartbeats)")
+    parser.add_argument('--heartbeat-timeout', type=float, default=liveness.DEFAULT_TIMEOUT,
+                        help="seconds a pinged peer has to answer before the connection is closed")
+    parser.add_argument('--gossip-fanout', type=int, default=gossip.DEFAULT_FANOUT,
+                        help="connections a gossip message is forwarded to by every peer")
+    parser.add_argument('--gossip-ttl', type=int, default=gossip.DEFAULT_TTL, choices=range(1, 256), metavar='TTL',
+                        help="hops a gossip message may travel")
+    parser.add_argument('--download-dir', default=transfer.DEFAULT_DIRECTORY, help="directory where received files are saved")
+    parser.add_argument('--metrics-port', type=int,
+                        help=f"serve Prometheus metrics on http://{metrics.DEFAULT_HOST}:<port>/metrics")
+    parser.add_argument('--log-level', choices=console.LEVELS, default=console.DEFAULT_LEVEL,
+                        help="lowest level of the connection and message notices written to the console")
+    parser.add_argument('--tls', action='store_true', help="encrypt the connections to other peers with TLS (all peers need it)")
+    parser.add_argument('--tls-cert', default=tls.TEST_CERT, help="certificate presented to other peers")
+    parser.add_argument('--tls-key', default=tls.TEST_KEY, help="private key of the certificate")
+    parser.add_argument('--tls-ca', default=tls.TEST_CERT, help="CA certificate the certificates of other peers must be signed with")
+    args = parser.parse_args()
+    console.setup(args.log_level)
+    if args.tls:
+        server_tls, client_tls = tls.peer_contexts(args.tls_cert, args.tls_key, args.tls_ca)
+    if args.metrics_port is not None:
+        metrics.serve(metrics.DEFAULT_HOST, args.metrics_port)
+    peer_port = args.port  # Assign the specified port number
+    transfers = transfer.Transfers(args.download_dir, start_sending)
+    mesh = gossip.Gossip(f"{find_my_ip()}:{peer_port}", connections.connections, forward_gossip,
+                         show_gossip, args.gossip_fanout, args.gossip_ttl)
+    if args.heartbeat_interval > 0:
+        heartbeat = liveness.Heartbeat(ping_peer, evict_peer, lambda connection: connections.get(connection.id) is connection,
+                                       args.heartbeat_interval, args.heartbeat_timeout)
     # Create a server socket to listen for incoming connections
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind(('', peer_port))  # Bind the server socket to the specified port
     server_socket.listen(5)  # Allow up to 5 concurrent connections
     print(f"Server listening on port {peer_port}...")
-    # Start a thread to accept incoming client connections
-    threading.Thread(target=accept_clients, args=(server_socket,)).start()
+    if args.selector:
+        # Multiplex the listening socket and all peer sockets on a single I/O thread
+        io_core = SelectorCore(server_socket, connections, peer_port, process_frame, heartbeat, transfers.drop, server_tls, client_tls)
+        io_core.start()
+    else:
+        if heartbeat is not None:
+            heartbeat.run_reaper()
+        # Start a thread to accept incoming client connections
+        threading.Thread(target=accept_clients, args=(server_socket,)).start()
     # Command interface loop for processing user commands
     while True:
         command = input(">> ").strip().split()
@@ -289,6 +522,28 @@ def main():
                 send_message(int(command[1]), " ".join(command[2:]))
             else:
                 print("Usage: send <connection id> <message>")
+        elif command[0] == 'sendfile':
+            if len(command) > 2 and command[1].isdigit():
+                send_file(int(command[1]), " ".join(command[2:]))
+            else:
+                print("Usage: sendfile <connection id> <path>")
+        elif command[0] == 'gossip':
+            if len(command) > 2:
+                send_gossip(command[1], " ".join(command[2:]))
+            else:
+                print("Usage: gossip <group> <message>")
+        elif command[0] == 'subscribe':
+            if len(command) == 2:
+                mesh.groups.add(command[1])
+                print(f"Subscribed to group {command[1]}.")
+            else:
+                print("Usage: subscribe <group>")
+        elif command[0] == 'unsubscribe':
+            if len(command) == 2:
+                mesh.groups.discard(command[1])
+                print(f"Unsubscribed from group {command[1]}.")
+            else:
+                print("Usage: unsubscribe <group>")
         elif command[0] == 'exit':
             exit_program()
 
@@ -1,13 +1,26 @@
 # Importing the necessary libraries
-import socket
+import queue
 import threading
 import tkinter as tk
 from tkinter import scrolledtext
 from tkinter import messagebox
 
+import framing
+import presence
+import reconnect
+import tls
+import transfer
+
 # Defining the IP address and port number
 HOST = '127.0.0.1' # Localhost
 PORT = 12345 # Port number
+TLS = False # Connect with TLS, the server has to be started with --tls
+TLS_CA = tls.TEST_CERT # CA certificate the server's certificate must be signed with (the self-signed test certificate)
+RENDER_INTERVAL = 50 # Milliseconds between two redraws of the message box
+RENDER_BATCH = 1000 # Lines inserted per redraw at most, the rest waits for the next one
+SCROLLBACK_LINES = 5000 # Lines the message box keeps, older ones are removed
+PRESENCE_LINES = 10 # Presence changes shown one per line, a larger update is summed up in one line
+PRESENCE_NAMES = 50 # Usernames listed for the members of the room, the rest are counted
 
 
 #=====================================GUI==============================================================
@@ -25,90 +38,159 @@ SEND_BUTTON_BACKGROUND_COLOR = 'blue'
 MESSAGE_BOX_COLOR = 'white'
 MESSAGE_BOX_BACKGROUND_COLOR = 'blue'
 
-# Create a client socket class object
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # AF_INET -> IPv4, SOCK_STREAM -> TCP
+# Connection to the server, created when the user joins. It reconnects on its own and queues what is sent while it is down
+client = None
+root = None # Tk window and the widgets the functions below use, created by build_window()
+username_textbox = username_button = message_textbox = message_box = None
+
+# Function to send the chunks of a file another user accepted, on a thread of its own
+def start_sending(connection, outgoing):
+    threading.Thread(target=transfer.send_chunks, args=(client.sock, client.send_lock, outgoing), daemon=True).start()
+
+transfers = transfer.Transfers(transfer.DEFAULT_DIRECTORY, start_sending) # Files sent to and received from other users of the room through the server's relay
 
-# Function to update the message box
+members = {} # Members of the room in the format {username: presence.ONLINE or presence.IDLE}, kept up to date by the server
+
+pending_messages = queue.SimpleQueue() # Lines waiting to be shown, filled by any thread and drained by the Tk main loop
+pending_errors = queue.SimpleQueue() # (title, message) of error dialogs the listening thread wants to show
+
+# Function to update the message box, safe to call from any thread
 def update_message_box(message):
-    message_box.config(state=tk.NORMAL)
-    message_box.insert(tk.END, message + '\n')
-    message_box.config(state=tk.DISABLED)
+    pending_messages.put(message)
 
-# Function to connect to the server
-def connect():
-    # Connect to the server
+# Function to show an error dialog from a thread other than the Tk main loop
+def report_error(title, message):
+    pending_errors.put((title, message))
+
+# Function to draw the queued lines in one batch, runs on the Tk main loop every RENDER_INTERVAL ms
+def render_messages():
+    lines = []
     try:
-        client.connect((HOST, PORT))
-        print(f"Client connected to the server at {HOST}:{PORT}.")
-        update_message_box(f"Client connected to the server at {HOST}:{PORT}.")
-    except:
-        messagebox.showerror("Cannot connect to server", f"Client failed to connect to the server at {HOST}:{PORT}.")
-
-    # Send the username to the server
-    username = username_textbox.get()
-    if username != '':
-        client.sendall(username.encode())
-    else:
-        messagebox.showerror("Invalid Username", f"Username cannot be empty.") 
+        while len(lines) < RENDER_BATCH:
+            lines.append(pending_messages.get_nowait())
+    except queue.Empty:
+        pass
+    if lines:
+        # Only follow the new lines if the user has not scrolled up to read older ones
+        at_bottom = message_box.yview()[1] >= 1.0
+        message_box.config(state=tk.NORMAL)
+        message_box.insert(tk.END, '\n'.join(lines[-SCROLLBACK_LINES:]) + '\n')
+        excess = int(message_box.index('end-1c').split('.')[0]) - 1 - SCROLLBACK_LINES
+        if excess > 0:
+            message_box.delete('1.0', f'{excess + 1}.0')
+        message_box.config(state=tk.DISABLED)
+        if at_bottom:
+            message_box.see(tk.END)
+    try:
+        while True:
+            messagebox.showerror(*pending_errors.get_nowait())
+    except queue.Empty:
+        pass
+    # Come back right away while a backlog is left, so a busy room is caught up within a few redraws
+    root.after(1 if not pending_messages.empty() else RENDER_INTERVAL, render_messages)
 
-    threading.Thread(target=listen_for_messages, args=(client,)).start()
+# Function to connect to the server
+def connect():
+    global client
+    # "name@room" joins a room other than the default one
+    username, _, room = username_textbox.get().partition('@')
+    if username == '':
+        messagebox.showerror("Invalid Username", f"Username cannot be empty.")
+        return
+
+    # Connect to the server and send the username, from a thread that reconnects whenever the connection drops
+    client = reconnect.ReconnectingClient(HOST, PORT, username, room or None, on_frame=handle_frame,
+                                          on_status=update_message_box, on_error=report_error,
+                                          on_disconnect=lambda: transfers.drop(None),
+                                          tls_context=tls.client_context(TLS_CA) if TLS else None)
+    client.start()
 
     # Disable the username textbox and button after joining chat
     username_textbox.config(state=tk.DISABLED)
     username_button.config(state=tk.DISABLED)
 
+# Function to send a frame to the server, queued while the connection is down
+def reply(frame_type, payload):
+    client.send(frame_type, payload)
+
+# Function to offer a file to another user of the room ("/sendfile <username> <path>" in the message box)
+def send_file(command):
+    _, username, path = (command.split(' ', 2) + ['', ''])[:3]
+    if username == '' or path == '':
+        messagebox.showerror("Send File", "Usage: /sendfile <username> <path>")
+        return
+    try:
+        outgoing = transfers.send(path, None)
+    except OSError as e:
+        messagebox.showerror("Send File", f"Cannot send {path}: {e}")
+        return
+    reply(framing.FILE_OFFER, outgoing.offer(to=username))
+    update_message_box(f"Offered {outgoing.name} ({outgoing.size} bytes) to {username}.")
+
 # Function to send a message to the server
 def send_message():
     message = message_textbox.get()
-    if message != '':
-        client.sendall(message.encode())
+    if client is None:
+        messagebox.showerror("Message Error", f"Join the chat before sending messages.")
+    elif message.startswith('/sendfile '):
+        send_file(message)
+        message_textbox.delete(0, tk.END)
+    elif message == '/who':
+        # The server answers with the members of the room, shown by handle_frame()
+        client.send(framing.CONTROL, presence.WHO)
+        message_textbox.delete(0, tk.END)
+    elif message != '':
+        client.send(framing.DATA, message)
         message_textbox.delete(0, tk.END)
     else:
         messagebox.showerror("Message Error", f"The message cannot be empty.")
 
-# Create a root window
-root = tk.Tk()
-# Setting the title and dimensions of the window
-root.title("CS 4470 - Assignment 1 - Chat Client")
-root.geometry("600x800")
-root.resizable(False, False)
+# Function to build the window, called by main() so that importing this module does not start Tk
+def build_window():
+    global root, username_textbox, username_button, message_textbox, message_box
+    # Create a root window
+    root = tk.Tk()
+    # Setting the title and dimensions of the window
+    root.title("CS 4470 - Assignment 1 - Chat Client")
+    root.geometry("600x800")
+    root.resizable(False, False)
 
-# Set the weight of the rows and columns
-root.grid_rowconfigure(0, weight=1)
-root.grid_rowconfigure(1, weight=5)
-root.grid_rowconfigure(2, weight=2)
+    # Set the weight of the rows and columns
+    root.grid_rowconfigure(0, weight=1)
+    root.grid_rowconfigure(1, weight=5)
+    root.grid_rowconfigure(2, weight=2)
 
-# Divide the windows to sections
-top_frame = tk.Frame(root, width=600, height=100, bg=TOP_FRAME_COLOR)
-top_frame.grid(row=0, column=0, sticky=tk.NSEW)
+    # Divide the windows to sections
+    top_frame = tk.Frame(root, width=600, height=100, bg=TOP_FRAME_COLOR)
+    top_frame.grid(row=0, column=0, sticky=tk.NSEW)
 
-middle_frame = tk.Frame(root, width=600, height=500, bg=MIDDLE_FRAME_COLOR)
-middle_frame.grid(row=1, column=0, sticky=tk.NSEW)
+    middle_frame = tk.Frame(root, width=600, height=500, bg=MIDDLE_FRAME_COLOR)
+    middle_frame.grid(row=1, column=0, sticky=tk.NSEW)
 
-bottom_frame = tk.Frame(root, width=600, height=200, bg=BOTTOM_FRAME_COLOR)
-bottom_frame.grid(row=2, column=0, sticky=tk.NSEW)
+    bottom_frame = tk.Frame(root, width=600, height=200, bg=BOTTOM_FRAME_COLOR)
+    bottom_frame.grid(row=2, column=0, sticky=tk.NSEW)
 
-# Create a label "Username" and input text box and submit button
-username_label = tk.Label(top_frame, text="Username:", font=(FONT, 20), bg=USERNAME_LABEL_BACKGROUND_COLOR, fg=USERNAME_LABEL_COLOR)
-username_label.pack(side=tk.LEFT, padx=10, pady=10)
+    # Create a label "Username" and input text box and submit button
+    username_label = tk.Label(top_frame, text="Username:", font=(FONT, 20), bg=USERNAME_LABEL_BACKGROUND_COLOR, fg=USERNAME_LABEL_COLOR)
+    username_label.pack(side=tk.LEFT, padx=10, pady=10)
 
-username_textbox = tk.Entry(top_frame, font=(FONT, 20))
-username_textbox.pack(side=tk.LEFT, padx=15, pady=10)
+    username_textbox = tk.Entry(top_frame, font=(FONT, 20))
+    username_textbox.pack(side=tk.LEFT, padx=15, pady=10)
 
-username_button = tk.Button(top_frame, text="Join Chat", font=(FONT, 20), bg=USERNAME_BUTTON_BACKGROUND_COLOR, fg=USERNAME_BUTTON_COLOR,  command=connect)
-username_button.pack(side=tk.RIGHT, padx=10, pady=10)
+    username_button = tk.Button(top_frame, text="Join Chat", font=(FONT, 20), bg=USERNAME_BUTTON_BACKGROUND_COLOR, fg=USERNAME_BUTTON_COLOR,  command=connect)
+    username_button.pack(side=tk.RIGHT, padx=10, pady=10)
 
-# Create an entry box to send messages with button
-message_textbox = tk.Entry(bottom_frame, font=(FONT, 20))
-message_textbox.pack(side=tk.LEFT, padx=10, pady=10)
+    # Create an entry box to send messages with button
+    message_textbox = tk.Entry(bottom_frame, font=(FONT, 20))
+    message_textbox.pack(side=tk.LEFT, padx=10, pady=10)
 
-send_button = tk.Button(bottom_frame, text="Send", font=(FONT, 20), bg=SEND_BUTTON_BACKGROUND_COLOR, fg=SEND_BUTTON_COLOR, command=send_message)
-send_button.pack(side=tk.RIGHT, padx=10, pady=10)
+    send_button = tk.Button(bottom_frame, text="Send", font=(FONT, 20), bg=SEND_BUTTON_BACKGROUND_COLOR, fg=SEND_BUTTON_COLOR, command=send_message)
+    send_button.pack(side=tk.RIGHT, padx=10, pady=10)
 
-# Create a message box to display messages
-message_box = scrolledtext.ScrolledText(middle_frame, wrap=tk.WORD, width=40, height=20, font=(FONT, 20), bg=MESSAGE_BOX_BACKGROUND_COLOR, fg=MESSAGE_BOX_COLOR)
-message_box.config(state=tk.DISABLED)
-message_box.pack(side=tk.TOP ,padx=10, pady=10)
+    # Create a message box to display messages
+    message_box = scrolledtext.ScrolledText(middle_frame, wrap=tk.WORD, width=40, height=20, font=(FONT, 20), bg=MESSAGE_BOX_BACKGROUND_COLOR, fg=MESSAGE_BOX_COLOR)
+    message_box.config(state=tk.DISABLED)
+    message_box.pack(side=tk.TOP ,padx=10, pady=10)
 #=====================================GUI==============================================================
 
 # # Defining the IP address and port number
@@ -117,18 +199,52 @@ message_box.pack(side=tk.TOP ,padx=10, pady=10)
 
 
 
-# Function to listen for incoming messages from the server
-def listen_for_messages(client):
-    while True:
-        message = client.recv(2048).decode('utf-8')
-        if message != '':
-            username = message.split(": ")[0]
-            content = message.split(": ")[1]
-
-            update_message_box(f"[{username}]: {content}")
+# Function to handle a frame from the server, called by the connection's receiving thread (ACKs and heartbeats are answered there)
+def handle_frame(frame_type, payload):
+    if frame_type in framing.FILE_FRAMES:
+        transfers.handle(None, frame_type, payload, reply)
+        return
+    if frame_type == framing.PRESENCE:
+        show_presence(payload)
+        return
+    if frame_type == framing.MESSAGE:
+        # Chat messages (live or replayed history) carry their sequence number in the room, the connection keeps track of it
+        message = framing.decode_message(payload)[1]
+    elif frame_type == framing.DATA:
+        message = payload.decode('utf-8')
+    else:
+        return
+    username, _, content = message.partition(": ")
+
+    update_message_box(f"[{username}]: {content}")
+
+# Function to update the members of the room and tell the user who joined, left or went idle
+def show_presence(payload):
+    kind, changes = presence.apply_presence(members, payload)
+    if kind == presence.SNAPSHOT:
+        names = [f"{username} (idle)" if state == presence.IDLE else username for username, state in sorted(members.items())]
+        more = f" and {len(names) - PRESENCE_NAMES} more" if len(names) > PRESENCE_NAMES else ''
+        update_message_box(f"[ANNOUNCEMENT]: Online ({len(names)}): {', '.join(names[:PRESENCE_NAMES])}{more}")
+        return
+    events = []
+    for username, state, previous in changes:
+        if state == presence.LEFT:
+            events.append((username, "has left the chat", "left"))
+        elif state == presence.IDLE:
+            events.append((username, "is idle", "went idle"))
+        elif previous is None:
+            events.append((username, "has joined the chat", "joined"))
         else:
-            messagebox.showerror("Message Error" ,f"The message from server is empty.")
-            break
+            events.append((username, "is back", "came back"))
+    if len(events) > PRESENCE_LINES:
+        # A mass join or disconnect: one line instead of a screen full of them
+        counts = {}
+        for _, _, summary in events:
+            counts[summary] = counts.get(summary, 0) + 1
+        update_message_box(f"[ANNOUNCEMENT]: {', '.join(f'{count} {summary}' for summary, count in counts.items())}.")
+        return
+    for username, verb, _ in events:
+        update_message_box(f"[ANNOUNCEMENT]: [{username}] {verb}.")
 
 # # Function to send messages to the server
 # def send_message(client):
@@ -145,7 +261,7 @@ def listen_for_messages(client):
 # def communicate_with_server(client):
 #     username = input("Enter your username: ")
 #     if username != '':
-#         client.sendall(username.encode())
+#         framing.send_frame(client, framing.JOIN, username)
 #     else:
 #         print(f"Username cannot be empty.")
 #         exit(0) 
@@ -157,6 +273,8 @@ def listen_for_messages(client):
 # Main Function
 def main():
 
+    build_window()
+    root.after(RENDER_INTERVAL, render_messages)
     root.mainloop()
 
     # # Create a client socket class object
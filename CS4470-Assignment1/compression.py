@@ -0,0 +1,111 @@
+"""
+Optional compression of large frames between server.py and its clients.
+
+Negotiation, during the handshake:
+- A client lists the codecs it can decode in its JOIN frame: compress=zlib-dict1,zlib
+- The server picks the first one of CODECS it also supports and names it in the ACK frame:
+  compress=zlib-dict1. Without that field (an older server, or compression disabled) the
+  client sends and expects plain frames only.
+
+A COMPRESSED frame carries the type of the original frame in its first byte, then the
+original payload as raw deflate data:
+    +--------+-----------------------+-------------+---------------------------+
+    | type 6 | payload length        | inner type  | deflated inner payload    |
+    | 1 byte | 4 bytes, big-endian   | 1 byte      | <length - 1> bytes        |
+    +--------+-----------------------+-------------+---------------------------+
+Every frame is compressed on its own, without the context of the frames before it, so the
+server can compress a broadcast frame once and queue the same bytes for every client that
+negotiated the codec. The zlib-dict1 codec makes up for the missing context with a preset
+dictionary of strings that are common in chat messages, logs and code. The dictionary can
+never change, a different one needs a new codec name.
+
+Frames smaller than the threshold, and frames that do not get smaller, are sent as they are.
+"""
+import zlib
+
+import framing
+import metrics
+
+ZLIB = 'zlib'
+ZLIB_DICT = 'zlib-dict1'
+CODECS = (ZLIB_DICT, ZLIB)  # In order of preference
+DEFAULT_THRESHOLD = 512  # Payloads from this size on are compressed, 0 disables compression
+LEVEL = 6
+WINDOW_BITS = -15  # Raw deflate, the frame header already says what follows
+
+PRESET_DICTIONARY = (
+    b"[ANNOUNCEMENT]: has joined the chat. has left the chat. "
+    b"Traceback (most recent call last):\n  File \"\", line , in \n    "
+    b"Error: Exception: ERROR WARNING INFO DEBUG null true false None True False "
+    b"import from def class return self. if else elif for while in not and or is "
+    b"function const let var => { } ( ) [ ] ; == != <= >= \n        \n    "
+    b"https:// http:// www. .com/ .org/ the and that this with have you for not are "
+)
+
+frames_compressed = metrics.counter('chat_frames_compressed_total', "Frames compressed (once per broadcast and codec)")
+bytes_saved = metrics.counter('chat_compression_saved_bytes_total', "Payload bytes saved by compressing those frames")
+
+
+def negotiate(offer, enabled=True):
+    """Return the codec to use for a client that offered the comma-separated codecs, None for no compression."""
+    if not enabled or not offer:
+        return None
+    offered = offer.split(',')
+    for codec in CODECS:
+        if codec in offered:
+            return codec
+    return None
+
+
+def compressor(codec):
+    if codec == ZLIB_DICT:
+        return zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, zdict=PRESET_DICTIONARY)
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS)
+
+
+def decompressor(codec):
+    if codec == ZLIB_DICT:
+        return zlib.decompressobj(WINDOW_BITS, zdict=PRESET_DICTIONARY)
+    return zlib.decompressobj(WINDOW_BITS)
+
+
+def compress_frame(frame, codec, threshold=DEFAULT_THRESHOLD):
+    """
+    Return an encoded frame as a COMPRESSED frame for the given codec.
+    - Return the frame itself if there is no codec, it is below the threshold or it does not get smaller.
+    """
+    if codec is None or threshold <= 0 or len(frame) - framing.HEADER.size < threshold:
+        return frame
+    frame_type = frame[0]
+    with memoryview(frame) as view:
+        engine = compressor(codec)
+        data = engine.compress(view[framing.HEADER.size:]) + engine.flush()
+    if 1 + len(data) >= len(frame) - framing.HEADER.size:
+        return frame
+    frames_compressed.inc()
+    bytes_saved.inc(len(frame) - framing.HEADER.size - 1 - len(data))
+    return framing.HEADER.pack(framing.COMPRESSED, 1 + len(data)) + bytes((frame_type,)) + data
+
+
+def encode_frame(frame_type, payload, codec, threshold=DEFAULT_THRESHOLD):
+    """Build a frame like framing.encode_frame() and compress it if that is worth it."""
+    return compress_frame(framing.encode_frame(frame_type, payload), codec, threshold)
+
+
+def decompress_frame(payload, codec, max_payload_size=framing.MAX_PAYLOAD_SIZE):
+    """
+    Return the (frame_type, payload) tuple inside the payload of a COMPRESSED frame.
+    - Raise framing.FrameError if no codec was negotiated, the data is corrupt or inflates beyond the payload limit.
+    """
+    if codec is None:
+        raise framing.FrameError("Compressed frame without a negotiated codec")
+    if not payload or payload[0] not in framing.FRAME_TYPES or payload[0] == framing.COMPRESSED:
+        raise framing.FrameError("Compressed frame with an invalid inner frame type")
+    engine = decompressor(codec)
+    try:
+        data = engine.decompress(memoryview(payload)[1:], max_payload_size)
+    except zlib.error as e:
+        raise framing.FrameError(f"Corrupt compressed frame: {e}") from None
+    if engine.unconsumed_tail or not engine.eof:
+        raise framing.FrameError(f"Compressed frame exceeds the {max_payload_size} byte limit or is truncated")
+    return payload[0], data
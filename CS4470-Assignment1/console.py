@@ -0,0 +1,47 @@
+"""
+Level-controlled console output that never makes the caller wait for the terminal.
+
+print() writes to stdout synchronously, so a slow terminal (or a full pipe) stalls whichever
+thread or event loop printed. Messages logged through `log` are put on a queue instead and a
+background thread writes them, in order, with the format of the old print() calls.
+
+Levels: debug, info (default), warning, error. setup() has to be called once per process
+(including every worker process of the sharded server) before anything is logged.
+"""
+import atexit
+import logging
+import queue
+import sys
+
+LEVELS = ('debug', 'info', 'warning', 'error')
+DEFAULT_LEVEL = 'info'
+
+log = logging.getLogger('chat')
+listener = None  # QueueListener writing the queued messages to the console
+
+
+def setup(level=DEFAULT_LEVEL, stream=None):
+    """Route `log` through a queue to a background writer thread and set the level."""
+    global listener
+    import logging.handlers  # Only processes that write to the console need it
+    if listener is not None:
+        listener.stop()
+    messages = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(messages, handler)
+    listener.start()
+    log.handlers = [logging.handlers.QueueHandler(messages)]
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+def flush():
+    """Write everything that is still queued, e.g. before the process exits."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(flush)
@@ -0,0 +1,392 @@
+"""
+Fan-out broadcast with one bounded outbound queue per client.
+
+broadcast() only appends the already encoded frame to every client's queue, a dedicated
+writer (a thread for the threaded server, a task for the asyncio server) drains each queue.
+A slow or stalled reader therefore only fills up its own queue instead of holding up the
+delivery to everyone else. What happens when a queue is full is set by the overflow policy:
+    drop-oldest: discard the oldest queued frame to make room for the new one.
+    disconnect:  close the slow client.
+    block:       make the sender wait until the queue has room again. The frame is queued
+                 anyway and the sender waits afterwards (wait_for_space()), so it never waits
+                 while holding a lock that other clients need, like the history's.
+Clients that negotiated compression get the COMPRESSED version of large frames, which is
+built once per broadcast and codec, not once per client.
+"""
+import asyncio
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+
+import compression
+import metrics
+from console import log
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+DEFAULT_QUEUE_SIZE = 1024  # Frames that may wait for a single client
+DEFAULT_BATCH_DELAY = 0.002  # Seconds a frame may wait for a batch to fill up
+MAX_IOVECS = 1024  # Buffers per sendmsg() call (IOV_MAX on Linux)
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')  # sendmsg() is not available on Windows
+
+bytes_sent = metrics.counter('chat_bytes_sent_total', "Bytes written to client sockets")
+frames_dropped = metrics.counter('chat_frames_dropped_total', "Frames discarded by the drop-oldest overflow policy")
+send_latency = metrics.histogram('chat_send_latency_seconds', "Time from queueing a frame for a client until it is written to the socket")
+broadcast_time = metrics.histogram('chat_broadcast_seconds', "Time to queue one broadcast frame for every recipient")
+
+
+class ClientQueue:
+    """
+    Bounded outbound queue of a blocking socket, drained by its own writer thread.
+    - Without batching every frame is sent with its own sendall().
+    - With batching (batch_bytes > 0) the writer waits until batch_bytes are queued or the oldest
+      frame is batch_delay seconds old, then sends all queued frames in one vectored sendmsg().
+    """
+
+    def __init__(self, sock, name, max_size=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, batch_bytes=0, batch_delay=DEFAULT_BATCH_DELAY):
+        self.sock = sock
+        self.name = name
+        self.room = None  # Set by Broadcaster.add()
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        self.frames = deque()
+        self.queued_at = deque()  # Time at which each queued frame was added, oldest first
+        self.queued_bytes = 0  # Total size of the queued frames
+        self.dropped = 0  # Frames discarded by the drop-oldest policy
+        self.sends = 0  # Number of send syscalls issued by the writer
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+
+    def put(self, frame, queued_at=None):
+        """
+        Queue a frame for this client. Return False if the client has been closed.
+        - queued_at: time.monotonic() of the broadcast, so it is read once for all recipients.
+        - With the block policy the frame is still queued, the sender then waits in wait_for_space().
+        """
+        with self.condition:
+            if len(self.frames) >= self.max_size and not self.closed:
+                if self.policy == DROP_OLDEST:
+                    self.queued_bytes -= len(self.frames.popleft())
+                    self.queued_at.popleft()
+                    self.dropped += 1
+                    frames_dropped.inc()
+                elif self.policy == DISCONNECT:
+                    log.warning(f"Outbound queue of {self.name} is full, disconnecting.")
+                    self.close_locked()
+            if self.closed:
+                return False
+            self.frames.append(frame)
+            self.queued_at.append(queued_at if queued_at is not None else time.monotonic())
+            self.queued_bytes += len(frame)
+            # While a batch is filling up there is no need to wake the writer for every frame
+            if len(self.frames) == 1 or self.queued_bytes >= self.batch_bytes:
+                self.condition.notify_all()
+            return True
+
+    def wait_for_space(self):
+        """Wait until the queue is below its limit again (or closed)."""
+        with self.condition:
+            while not self.closed and len(self.frames) >= self.max_size:
+                self.condition.wait()
+
+    def depth(self):
+        """Return the number of frames waiting to be sent."""
+        return len(self.frames)
+
+    def close(self):
+        """Stop the writer thread and shut the socket down."""
+        with self.condition:
+            self.close_locked()
+
+    def close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        self.queued_at.clear()
+        self.queued_bytes = 0
+        self.condition.notify_all()
+        try:
+            # Shutting down wakes up the thread blocked in recv() on this socket
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def wait_for_batch(self):
+        """Wait (holding the condition) until there is something to send, return False once closed."""
+        while not self.closed:
+            if not self.frames:
+                self.condition.wait()
+            elif self.batch_bytes <= 0 or self.queued_bytes >= self.batch_bytes:
+                return True
+            else:
+                remaining = self.queued_at[0] + self.batch_delay - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self.condition.wait(remaining)
+        return False
+
+    def write_frames(self):
+        """Writer thread: send queued frames until the queue is closed."""
+        while True:
+            with self.condition:
+                if not self.wait_for_batch():
+                    return
+                oldest = self.queued_at[0]
+                if self.batch_bytes > 0:
+                    batch = list(self.frames)
+                    size = self.queued_bytes
+                    self.frames.clear()
+                    self.queued_at.clear()
+                    self.queued_bytes = 0
+                else:
+                    batch = [self.frames.popleft()]
+                    self.queued_at.popleft()
+                    size = len(batch[0])
+                    self.queued_bytes -= size
+                self.condition.notify_all()  # Wake up senders waiting for space
+            try:
+                if len(batch) == 1:
+                    self.sock.sendall(batch[0])
+                    self.sends += 1
+                else:
+                    self.sends += send_batch(self.sock, batch)
+                bytes_sent.inc(size)
+                send_latency.observe(time.monotonic() - oldest)  # Once per send, for the frame that waited longest
+            except OSError as e:
+                log.warning(f"Error sending to {self.name}: {e}")
+                self.close()
+                return
+
+
+def send_batch(sock, frames):
+    """
+    Send a list of frames with as few syscalls as possible and return the number of syscalls.
+    - Uses sendmsg() with one buffer per frame (no copy into a joined buffer) where available.
+    - Handles partial sends by resuming from the first byte that was not sent.
+    """
+    if not HAVE_SENDMSG or isinstance(sock, ssl.SSLSocket):  # TLS sockets have no sendmsg(), the frames become one record stream anyway
+        sock.sendall(b''.join(frames))
+        return 1
+    calls = 0
+    buffers = [memoryview(frame) for frame in frames]
+    while buffers:
+        sent = sock.sendmsg(buffers[:MAX_IOVECS])
+        calls += 1
+        # Drop the buffers that were sent completely and trim the one that was sent partly
+        index = 0
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        del buffers[:index]
+        if sent:
+            buffers[0] = buffers[0][sent:]
+    return calls
+
+
+class AsyncClientQueue:
+    """
+    Bounded outbound queue of an asyncio StreamWriter, drained by its own writer task.
+    - The writer hands all queued frames to the transport with one writelines() call.
+    - With batching (batch_bytes > 0) it first waits for batch_bytes or batch_delay, like ClientQueue.
+    """
+
+    def __init__(self, writer, name, max_size=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, batch_bytes=0, batch_delay=DEFAULT_BATCH_DELAY):
+        self.writer = writer
+        self.name = name
+        self.room = None  # Set by Broadcaster.add()
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        self.frames = deque()
+        self.queued_at = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.sends = 0  # Number of writelines() calls, each one is a single send syscall or less
+        self.closed = False
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()  # Set while frames are waiting to be written
+        self.full = asyncio.Event()  # Set once batch_bytes are waiting to be written
+        self.space = asyncio.Event()  # Set while the queue has room
+        self.space.set()
+        self.task = self.loop.create_task(self.write_frames())
+
+    def put(self, frame, queued_at=None):
+        """
+        Queue a frame for this client. Return False if the client has been closed.
+        - With the block policy the frame is still queued, the sender then waits in wait_for_space().
+        """
+        if self.closed:
+            return False
+        if len(self.frames) >= self.max_size:
+            if self.policy == DROP_OLDEST:
+                self.queued_bytes -= len(self.frames.popleft())
+                self.queued_at.popleft()
+                self.dropped += 1
+                frames_dropped.inc()
+            elif self.policy == DISCONNECT:
+                log.warning(f"Outbound queue of {self.name} is full, disconnecting.")
+                self.close()
+                return False
+        self.frames.append(frame)
+        self.queued_at.append(queued_at if queued_at is not None else time.monotonic())
+        self.queued_bytes += len(frame)
+        if len(self.frames) >= self.max_size:
+            self.space.clear()
+        if self.queued_bytes >= self.batch_bytes:
+            self.full.set()
+        self.ready.set()
+        return True
+
+    async def wait_for_space(self):
+        """Wait until the queue is below its limit again (or closed)."""
+        while not self.closed and not self.space.is_set():
+            await self.space.wait()
+
+    def depth(self):
+        """Return the number of frames waiting to be sent."""
+        return len(self.frames)
+
+    def close(self):
+        """Stop the writer task and close the transport."""
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        self.queued_at.clear()
+        self.queued_bytes = 0
+        self.ready.set()
+        self.full.set()
+        self.space.set()
+        self.writer.close()
+
+    async def write_frames(self):
+        """Writer task: write queued frames and wait for the transport to drain."""
+        try:
+            while True:
+                await self.ready.wait()
+                if self.batch_bytes > 0 and not self.full.is_set():
+                    remaining = self.queued_at[0] + self.batch_delay - time.monotonic()
+                    if remaining > 0:
+                        try:
+                            await asyncio.wait_for(self.full.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            pass
+                if self.closed:
+                    return
+                self.writer.writelines(self.frames)
+                self.sends += 1
+                bytes_sent.inc(self.queued_bytes)
+                send_latency.observe(time.monotonic() - self.queued_at[0])
+                self.frames.clear()
+                self.queued_at.clear()
+                self.queued_bytes = 0
+                self.ready.clear()
+                self.full.clear()
+                await self.writer.drain()
+                if len(self.frames) < self.max_size:
+                    self.space.set()
+        except (ConnectionError, OSError) as e:
+            log.warning(f"Error sending to {self.name}: {e}")
+            self.close()
+
+
+class Broadcaster:
+    """Registry of client queues that fans an encoded frame out to all of them."""
+
+    def __init__(self, queue_class=ClientQueue, max_size=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, batch_bytes=0, batch_delay=DEFAULT_BATCH_DELAY,
+                 compress_threshold=compression.DEFAULT_THRESHOLD):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}")
+        self.queue_class = queue_class
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_bytes = batch_bytes  # 0 disables batching
+        self.batch_delay = batch_delay
+        self.compress_threshold = compress_threshold  # 0 disables compression
+        self.queues = {}  # Dictionary of queues in the format {socket or writer: queue}
+        self.rooms = {}  # Dictionary of the queues in each room in the format {room: {socket or writer: queue}}
+        self.lock = threading.Lock()
+
+    def add(self, conn, name, room=None, codec=None):
+        """Create the outbound queue (and its writer) for a new client in the given room, codec is the negotiated compression."""
+        queue = self.queue_class(conn, name, self.max_size, self.policy, self.batch_bytes, self.batch_delay)
+        queue.room = room
+        queue.codec = codec
+        with self.lock:
+            self.queues[conn] = queue
+            self.rooms.setdefault(room, {})[conn] = queue
+        return queue
+
+    def remove(self, conn):
+        """Close and forget the queue of a client that left."""
+        with self.lock:
+            queue = self.queues.pop(conn, None)
+            if queue is not None:
+                members = self.rooms[queue.room]
+                del members[conn]
+                if not members:
+                    del self.rooms[queue.room]
+        if queue is not None:
+            queue.close()
+
+    def send(self, conn, frame):
+        """Queue a frame for a single client."""
+        queue = self.queues.get(conn)
+        return queue is not None and queue.put(compression.compress_frame(frame, queue.codec, self.compress_threshold))
+
+    def try_send(self, conn, frame):
+        """Queue a frame for a single client unless its queue is full (never waits, even with the block policy)."""
+        queue = self.queues.get(conn)
+        return queue is not None and queue.depth() < queue.max_size and queue.put(frame)
+
+    def depth(self, conn):
+        """Return the number of frames queued for a client, 0 if it has no queue."""
+        queue = self.queues.get(conn)
+        return queue.depth() if queue is not None else 0
+
+    def broadcast(self, frame, room=None):
+        """Queue the same encoded frame for every client in the room, or for every client if room is None."""
+        with self.lock:
+            if room is None:
+                queues = list(self.queues.values())
+            else:
+                queues = list(self.rooms.get(room, {}).values())
+        queued_at = time.monotonic()
+        variants = {None: frame}  # The frame as sent to the clients of each codec
+        for queue in queues:
+            variant = variants.get(queue.codec)
+            if variant is None:
+                variant = variants[queue.codec] = compression.compress_frame(frame, queue.codec, self.compress_threshold)
+            queue.put(variant, queued_at)
+        broadcast_time.observe(time.monotonic() - queued_at)
+
+    async def wait_for_space(self):
+        """asyncio senders call this after broadcast() to honour the block policy."""
+        if self.policy != BLOCK:
+            return
+        for queue in list(self.queues.values()):
+            await queue.wait_for_space()
+
+    def block_until_space(self):
+        """Threaded senders call this after broadcast(), holding no lock, to honour the block policy."""
+        if self.policy != BLOCK:
+            return
+        with self.lock:
+            queues = list(self.queues.values())
+        for queue in queues:
+            queue.wait_for_space()
+
+    def queue_depths(self):
+        """Return the current depth of every client's queue in the format {(room, name): depth}."""
+        with self.lock:
+            return {(queue.room, queue.name): queue.depth() for queue in self.queues.values()}
@@ -0,0 +1,150 @@
+"""
+Length-prefixed framing shared by chat.py, server.py and client.py.
+
+Every message on the wire is a frame made of a 5 byte header followed by the payload:
+    +--------+-----------------------+-------------------+
+    | type   | payload length        | payload           |
+    | 1 byte | 4 bytes, big-endian   | <length> bytes    |
+    +--------+-----------------------+-------------------+
+TCP is a byte stream, so one recv() may return several frames or only part of one.
+FrameDecoder buffers the received bytes and hands back complete frames only.
+"""
+import struct
+from collections import deque
+
+# Frame types
+DATA = 1  # User text (chat messages, announcements)
+CONTROL = 2  # Control words such as "exit" and "terminate"
+JOIN = 3  # First frame of a connection (username and options for the server, listening port for peers)
+ACK = 4  # Acknowledgement of a JOIN
+MESSAGE = 5  # Chat message relayed by the server: its sequence number in the room, a newline, then the text
+COMPRESSED = 6  # Another frame with a deflated payload, see compression.py
+FILE_OFFER = 7  # File transfers, see transfer.py
+FILE_ACCEPT = 8
+FILE_CHUNK = 9
+FILE_FRAMES = (FILE_OFFER, FILE_ACCEPT, FILE_CHUNK)
+GOSSIP = 10  # Group message relayed from peer to peer, see gossip.py
+PRESENCE = 11  # Members of a room (snapshot) or the changes since the last update (delta), see presence.py
+FRAME_TYPES = (DATA, CONTROL, JOIN, ACK, MESSAGE, COMPRESSED) + FILE_FRAMES + (GOSSIP, PRESENCE)
+
+HEADER = struct.Struct('!BI')  # Frame type and payload length, network byte order
+DEFAULT_ROOM = 'general'  # Room of server clients whose JOIN frame has no room field
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024  # Refuse frames larger than 16 MiB
+RECV_SIZE = 65536  # Number of bytes to ask for per recv()
+
+
+class FrameError(Exception):
+    """Raised when the byte stream does not contain a valid frame."""
+
+
+def encode_frame(frame_type, payload):
+    """Build a frame from a frame type and a bytes or str payload."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise FrameError(f"Payload of {len(payload)} bytes exceeds the {MAX_PAYLOAD_SIZE} byte limit")
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_join(name, **fields):
+    """
+    Build a JOIN payload: the name on the first line, then one "key=value" line per field.
+    - Fields that are None are left out.
+    """
+    lines = [name] + [f"{key}={value}" for key, value in fields.items() if value is not None]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def decode_join(payload):
+    """Split a JOIN payload into the name and a dictionary of its fields."""
+    name, *lines = payload.decode('utf-8').split('\n')
+    fields = {}
+    for line in lines:
+        key, _, value = line.partition('=')
+        fields[key] = value
+    return name, fields
+
+
+def encode_message(seq, text):
+    """Build a MESSAGE payload from a room sequence number and the message text."""
+    return f"{seq}\n{text}".encode('utf-8')
+
+
+def decode_message(payload):
+    """
+    Split a MESSAGE payload into the sequence number and the message text.
+    - Raise ValueError (UnicodeDecodeError included) if the payload is malformed or truncated.
+    """
+    seq, separator, text = payload.decode('utf-8').partition('\n')
+    if not separator:
+        raise ValueError("MESSAGE payload without a sequence number")
+    return int(seq), text
+
+
+def send_frame(sock, frame_type, payload):
+    """Encode a frame and send all of it on a blocking socket."""
+    sock.sendall(encode_frame(frame_type, payload))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder that turns received bytes into (frame_type, payload) tuples.
+    - Received bytes are appended to a single buffer.
+    - Frames are parsed in place through a memoryview, only the payload is copied out.
+    - The consumed prefix is dropped once per feed(), not once per frame.
+    """
+
+    def __init__(self, max_payload_size=MAX_PAYLOAD_SIZE):
+        self.buffer = bytearray()
+        self.ready = deque()  # Decoded frames not handed out yet, used by recv_frame() and read_frame()
+        self.max_payload_size = max_payload_size
+
+    def feed(self, data):
+        """Add received bytes to the buffer and return the list of complete frames."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        end = len(self.buffer)
+        with memoryview(self.buffer) as view:
+            while end - offset >= HEADER.size:
+                frame_type, length = HEADER.unpack_from(view, offset)
+                if frame_type not in FRAME_TYPES:
+                    raise FrameError(f"Unknown frame type {frame_type}")
+                if length > self.max_payload_size:
+                    raise FrameError(f"Frame of {length} bytes exceeds the {self.max_payload_size} byte limit")
+                start = offset + HEADER.size
+                if end - start < length:
+                    break  # The rest of this frame has not arrived yet
+                frames.append((frame_type, view[start:start + length].tobytes()))
+                offset = start + length
+        if offset:
+            del self.buffer[:offset]  # Drop everything that was parsed in one go
+        return frames
+
+    def pending(self):
+        """Return the number of buffered bytes that do not form a complete frame yet."""
+        return len(self.buffer)
+
+
+def recv_frame(sock, decoder):
+    """
+    Return the next (frame_type, payload) tuple from a blocking socket.
+    - Frames that arrived together with it stay queued in the decoder for the next call.
+    - Return None when the peer has closed the connection.
+    """
+    while not decoder.ready:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        decoder.ready.extend(decoder.feed(data))
+    return decoder.ready.popleft()
+
+
+async def read_frame(reader, decoder):
+    """asyncio version of recv_frame() for a StreamReader."""
+    while not decoder.ready:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return None
+        decoder.ready.extend(decoder.feed(data))
+    return decoder.ready.popleft()
@@ -0,0 +1,122 @@
+"""
+Gossip broadcast for chat.py: a message sent to a group reaches every peer of the mesh, not
+only the direct connections of the sender.
+
+Every peer that receives a GOSSIP frame for the first time shows it (if it is subscribed to
+the group) and forwards it to `fanout` of its connections picked at random, except the one
+it came from. Each forward decrements the TTL, at 0 the message is not forwarded anymore.
+With a fanout of f the number of peers reached grows about f times per hop, so a mesh of N
+peers is covered in O(log N) hops while every peer only keeps a few sockets open.
+
+Messages arrive over several paths, so peers remember the ids of the messages they have
+seen in a bounded LRU set and drop the copies.
+
+GOSSIP payload:
+    +-----------------+---------+---------------------------------------------+
+    | message id      | ttl     | origin "\\n" group "\\n" text (UTF-8)       |
+    | 16 bytes        | 1 byte  |                                             |
+    +-----------------+---------+---------------------------------------------+
+"""
+import os
+import random
+import struct
+import threading
+from collections import OrderedDict
+
+import framing
+import metrics
+
+DEFAULT_FANOUT = 4  # Connections a message is forwarded to
+DEFAULT_TTL = 6  # Hops a message may travel
+DEFAULT_SEEN_SIZE = 10000  # Message ids remembered for deduplication
+DEFAULT_GROUP = 'all'  # Group every peer is subscribed to
+PREFIX = struct.Struct('!16sB')  # Message id and TTL
+
+delivered = metrics.counter('chat_gossip_delivered_total', "Gossip messages shown to the user")
+forwarded = metrics.counter('chat_gossip_forwarded_total', "Gossip frames sent to other peers (own messages included)")
+duplicates = metrics.counter('chat_gossip_duplicates_total', "Gossip messages received again and dropped")
+
+
+def encode_gossip(message_id, ttl, origin, group, text):
+    """Build a GOSSIP payload."""
+    return PREFIX.pack(message_id, ttl) + f"{origin}\n{group}\n{text}".encode('utf-8')
+
+
+def decode_gossip(payload):
+    """Split a GOSSIP payload into (message id, ttl, origin, group, text)."""
+    if len(payload) < PREFIX.size:
+        raise framing.FrameError("Gossip frame too short")
+    message_id, ttl = PREFIX.unpack_from(payload)
+    fields = payload[PREFIX.size:].decode('utf-8').split('\n', 2)
+    if len(fields) != 3:
+        raise framing.FrameError("Gossip frame without origin, group and text")
+    origin, group, text = fields
+    return message_id, ttl, origin, group, text
+
+
+class SeenSet:
+    """Bounded set of message ids that forgets the least recently seen ones first."""
+
+    def __init__(self, size=DEFAULT_SEEN_SIZE):
+        self.size = size
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()  # Receiving threads of chat.py check and add at the same time
+
+    def add(self, message_id):
+        """Add an id. Return False if it was already there."""
+        with self.lock:
+            if message_id in self.ids:
+                self.ids.move_to_end(message_id)
+                return False
+            self.ids[message_id] = None
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return True
+
+
+class Gossip:
+    """
+    Gossip state of one peer.
+    - peers(): returns the current connections.
+    - send(connection, payload): sends a GOSSIP frame, from the thread that handles gossip.
+    - show(origin, group, text): displays a message of a subscribed group.
+    """
+
+    def __init__(self, origin, peers, send, show, fanout=DEFAULT_FANOUT, ttl=DEFAULT_TTL, seen_size=DEFAULT_SEEN_SIZE):
+        self.origin = origin  # "ip:port" of this peer, shown as the sender of its messages
+        self.peers = peers
+        self.send = send
+        self.show = show
+        self.fanout = fanout
+        self.ttl = ttl
+        self.seen = SeenSet(seen_size)
+        self.groups = {DEFAULT_GROUP}
+
+    def publish(self, group, text):
+        """Send a new message to a group. Return the number of peers it was sent to."""
+        message_id = os.urandom(16)
+        self.seen.add(message_id)
+        return self.forward(encode_gossip(message_id, self.ttl, self.origin, group, text), None)
+
+    def receive(self, connection, payload):
+        """Handle a GOSSIP frame received on a connection."""
+        message_id, ttl, origin, group, text = decode_gossip(payload)
+        if not self.seen.add(message_id):
+            duplicates.inc()
+            return
+        if group in self.groups:
+            delivered.inc()
+            self.show(origin, group, text)
+        if ttl > 1:
+            # The rest of the payload is forwarded as it is, only the TTL changes
+            self.forward(PREFIX.pack(message_id, ttl - 1) + payload[PREFIX.size:], connection)
+
+    def forward(self, payload, source):
+        """Send a payload to up to fanout random connections other than source."""
+        targets = [connection for connection in self.peers() if connection is not source]
+        if len(targets) > self.fanout:
+            targets = random.sample(targets, self.fanout)
+        for connection in targets:
+            self.send(connection, payload)
+        forwarded.inc(len(targets))
+        return len(targets)
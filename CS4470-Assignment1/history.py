@@ -0,0 +1,138 @@
+"""
+Bounded per-room message history for the chat server.
+
+Every chat message gets the next sequence number of its room and is encoded once into a
+MESSAGE frame. The frame is broadcast and also kept in the room's ring buffer, so replaying
+history to a joining client just queues the stored bytes again, however many clients join at once.
+
+Limits (checked whenever a room is written to or read from):
+- max_bytes: total size of the stored frames of one room, the oldest ones are dropped first.
+- max_age: seconds after which a message is no longer replayed.
+- replay_limit: number of messages replayed to a client that joins without a sequence number.
+
+With a persistence.MessageLog attached, every recorded message is also appended to the log,
+and load() refills the histories from the log when the server starts again.
+
+A client that reconnects sends since=<last seq it saw> in its JOIN frame and gets every stored
+message after it. The ACK frame carries the room's latest sequence number, so a client whose
+since is newer than that can tell that the server restarted.
+"""
+import threading
+import time
+from collections import deque
+
+import framing
+
+DEFAULT_MAX_BYTES = 1024 * 1024  # Stored frames per room
+DEFAULT_MAX_AGE = 3600.0  # Seconds
+DEFAULT_REPLAY_LIMIT = 100  # Messages replayed on a fresh join
+
+
+def parse_since(fields):
+    """Return the since field of a decoded JOIN frame as an int, or None if it is missing or invalid."""
+    try:
+        return int(fields['since'])
+    except (KeyError, ValueError):
+        return None
+
+
+class RoomHistory:
+    """Ring buffer of the encoded MESSAGE frames of one room."""
+    __slots__ = ('entries', 'size', 'last_seq')
+
+    def __init__(self):
+        self.entries = deque()  # (seq, time, frame) tuples, oldest first
+        self.size = 0  # Total size of the stored frames
+        self.last_seq = 0  # Sequence number of the latest message, kept when the entries expire
+
+
+class MessageHistory:
+    """
+    Histories of all rooms.
+    - The server holds lock while it records and broadcasts a message, and while it registers a
+      joining client and queues its replay, so the client gets every message exactly once.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE, replay_limit=DEFAULT_REPLAY_LIMIT, log=None):
+        self.max_bytes = max_bytes  # 0 disables the history, messages still get sequence numbers
+        self.max_age = max_age
+        self.replay_limit = replay_limit
+        self.log = log  # persistence.MessageLog, or None to keep the history in memory only
+        self.rooms = {}  # Dictionary in the format {room: RoomHistory}
+        self.lock = threading.RLock()
+
+    def record(self, room, text):
+        """Give a message the next sequence number of its room, store it and return its encoded frame."""
+        with self.lock:
+            history = self.rooms.get(room)
+            if history is None:
+                history = self.rooms[room] = RoomHistory()
+            history.last_seq += 1
+            frame = framing.encode_frame(framing.MESSAGE, framing.encode_message(history.last_seq, text))
+            self.store(history, history.last_seq, time.monotonic(), frame)
+            if self.log is not None:
+                self.log.append(room, history.last_seq, frame)
+            return frame
+
+    def load(self):
+        """
+        Refill the histories with the messages of the last max_age seconds in the log.
+        - The sequence numbers continue from the newest message of each room in the whole log, so a
+          room that was quiet for longer than max_age does not number its messages from 1 again.
+        """
+        if self.log is None:
+            return
+        # The log has wall-clock times, the histories use the monotonic clock
+        clock_offset = time.monotonic() - time.time()
+        with self.lock:
+            for room, seq in self.log.last_seqs().items():
+                history = self.rooms.get(room)
+                if history is None:
+                    history = self.rooms[room] = RoomHistory()
+                history.last_seq = max(history.last_seq, seq)
+            for _, timestamp, room, seq, frame in self.log.read(start=time.time() - self.max_age):
+                history = self.rooms.get(room)
+                if history is None:
+                    history = self.rooms[room] = RoomHistory()
+                history.last_seq = max(history.last_seq, seq)
+                self.store(history, seq, timestamp + clock_offset, frame)
+
+    def store(self, history, seq, timestamp, frame):
+        """Add an encoded frame to a room's ring buffer and drop what no longer fits."""
+        if len(frame) <= self.max_bytes:
+            history.entries.append((seq, timestamp, frame))
+            history.size += len(frame)
+        self.prune(history)
+
+    def replay(self, room, since=None):
+        """
+        Return the stored frames a joining client should get, oldest first.
+        - since None: the latest replay_limit messages.
+        - since N: every stored message with a sequence number above N.
+        """
+        with self.lock:
+            history = self.rooms.get(room)
+            if history is None:
+                return []
+            self.prune(history)
+            entries = history.entries
+            if since is None:
+                start = max(0, len(entries) - self.replay_limit)
+            else:
+                # Walk back from the newest entry, so the cost is proportional to what is replayed
+                start = len(entries)
+                while start > 0 and entries[start - 1][0] > since:
+                    start -= 1
+            return [entries[index][2] for index in range(start, len(entries))]
+
+    def latest(self, room):
+        """Return the sequence number of the latest message of a room, 0 if there is none."""
+        history = self.rooms.get(room)
+        return history.last_seq if history is not None else 0
+
+    def prune(self, history):
+        """Drop the oldest entries of a room until it is within the size and age limits."""
+        entries = history.entries
+        expired = time.monotonic() - self.max_age
+        while entries and (history.size > self.max_bytes or entries[0][1] < expired):
+            history.size -= len(entries.popleft()[2])
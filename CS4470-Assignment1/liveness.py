@@ -0,0 +1,152 @@
+"""
+Dead-peer detection for server.py and chat.py: TCP keepalive, heartbeats and a timer-wheel reaper.
+
+A peer that disappears without a FIN (crash, cable pulled, NAT entry dropped) leaves the
+socket open forever, with its thread blocked in recv() and its registry entry in place.
+- TCP keepalive makes the kernel probe idle connections and fail them eventually.
+- Heartbeats find dead peers sooner: a connection that has been silent for `interval`
+  seconds gets a CONTROL "ping", every frame counts as a sign of life (a "pong" is just the
+  cheapest one), and a connection that stays silent for `timeout` seconds after the ping is
+  evicted through the evict callback.
+- The deadlines live in a hashed timer wheel. Receiving a frame only stores the time in
+  connection.last_seen, the wheel is consulted once per tick and only touches the
+  connections whose deadline falls in that tick, never all of them.
+"""
+import socket
+import threading
+import time
+
+import metrics
+from console import log
+
+PING = "ping"
+PONG = "pong"
+DEFAULT_INTERVAL = 30.0  # Seconds of silence before a connection is pinged, 0 disables heartbeats
+DEFAULT_TIMEOUT = 10.0  # Seconds to wait for any frame after a ping
+DEFAULT_TICK = 1.0  # Resolution of the timer wheel in seconds
+WHEEL_SLOTS = 512  # The wheel covers WHEEL_SLOTS * tick seconds
+JOIN_TIMEOUT = 30.0  # Seconds a new connection may take to send its JOIN frame
+KEEPALIVE_IDLE = 60  # Seconds of idleness before the kernel starts probing
+KEEPALIVE_INTERVAL = 10  # Seconds between two probes
+KEEPALIVE_COUNT = 5  # Unanswered probes before the kernel drops the connection
+
+evictions = metrics.counter('chat_heartbeat_evictions_total', "Connections closed because they did not answer a heartbeat ping")
+
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Turn on TCP keepalive, with the timing options the platform supports."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError:
+        pass  # Not a TCP socket, or already closed
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: one list of keys per tick, for the next WHEEL_SLOTS ticks.
+    - schedule() is O(1). Deadlines beyond the wheel are put in its last slot, the owner sees
+      that they are not due yet and schedules them again.
+    - advance() is O(number of keys due), a slot only ever holds keys of its own tick.
+    - There is no cancel, owners check whether a key that comes due is still relevant.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)  # Last tick that has been processed
+        self.lock = threading.Lock()
+
+    def schedule(self, key, when):
+        """Make key come due at monotonic time `when` (rounded up to the next tick)."""
+        with self.lock:
+            tick = min(max(int(when / self.tick) + 1, self.current + 1), self.current + len(self.slots))
+            self.slots[tick % len(self.slots)].append(key)
+
+    def advance(self, now):
+        """Return the keys whose tick has passed up to monotonic time `now`, removing them from the wheel."""
+        due = []
+        with self.lock:
+            target = int(now / self.tick)
+            # After a long pause (e.g. a suspended laptop) one turn of the wheel visits every slot
+            target = min(target, self.current + len(self.slots))
+            while self.current < target:
+                self.current += 1
+                slot = self.current % len(self.slots)
+                due.extend(self.slots[slot])
+                self.slots[slot] = []
+            self.current = max(self.current, int(now / self.tick))
+        return due
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(slot) for slot in self.slots)
+
+
+class Heartbeat:
+    """
+    Heartbeat bookkeeping for a set of registry connections.
+    - send_ping(connection): send a CONTROL "ping", must not block.
+    - evict(connection): close a connection that stopped responding.
+    - is_active(connection): False once the connection has been removed, its timers are then dropped.
+    Receivers set connection.last_seen = time.monotonic() for every frame, call watch() once per
+    connection and check() once per tick (from a thread or task, see run_reaper()).
+    """
+
+    def __init__(self, send_ping, evict, is_active, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT, tick=DEFAULT_TICK):
+        self.send_ping = send_ping
+        self.evict = evict
+        self.is_active = is_active
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick)
+
+    def watch(self, connection):
+        """Start watching a newly registered connection."""
+        connection.last_seen = time.monotonic()
+        connection.pinged = 0.0
+        self.wheel.schedule(connection, connection.last_seen + self.interval)
+
+    def check(self, now=None):
+        """Ping or evict the connections whose deadline has passed."""
+        now = time.monotonic() if now is None else now
+        for connection in self.wheel.advance(now):
+            if self.is_active(connection):
+                self.expire(connection, now)
+
+    def expire(self, connection, now):
+        """Handle a connection whose deadline has passed: reschedule, ping or evict it."""
+        if connection.pinged and connection.last_seen < connection.pinged:
+            # Nothing arrived since the ping
+            deadline = connection.pinged + self.timeout
+            if now >= deadline:
+                evictions.inc()
+                self.evict(connection)
+            else:
+                self.wheel.schedule(connection, deadline)
+            return
+        deadline = connection.last_seen + self.interval
+        if now < deadline:  # Active since the last check
+            self.wheel.schedule(connection, deadline)
+            return
+        connection.pinged = now
+        self.send_ping(connection)
+        self.wheel.schedule(connection, now + self.timeout)
+
+    def run_reaper(self):
+        """Start a daemon thread that calls check() once per tick."""
+        def reap():
+            while True:
+                time.sleep(self.wheel.tick)
+                try:
+                    self.check()
+                except Exception as e:  # Never let one bad connection stop the reaper
+                    log.error(f"Heartbeat check failed: {e}")
+        threading.Thread(target=reap, daemon=True).start()
@@ -0,0 +1,206 @@
+"""
+Counters, gauges and histograms for server.py and chat.py, exposed in the Prometheus text format.
+
+Recording has to be cheap enough for the per-message paths, so no lock is taken:
+- Every thread records into its own cell (a small list found through threading.local), so
+  increments from different threads never touch the same memory and cannot be lost.
+- Cells are only summed up when the metrics are collected. The cells of threads that have
+  exited are folded into a base value at that point, so short-lived client threads do not
+  make the list grow forever.
+- Gauges are functions evaluated at collection time (e.g. the number of connected clients).
+
+serve(host, port) answers GET /metrics on a background thread:
+    curl http://127.0.0.1:9100/metrics
+http.server is only imported by serve(), it takes longer to import than the rest of the
+chat modules together and clients that never serve metrics should not pay for it.
+"""
+import bisect
+import threading
+
+# Upper bounds in seconds of the histogram buckets, from 100 microseconds to 2.5 seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+DEFAULT_HOST = '127.0.0.1'  # The endpoint is for local scrapers only
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    """Format a number for the text format (integers without a decimal point)."""
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class ShardedValues:
+    """A fixed-size list of numbers with one copy per thread, summed up on collect()."""
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.cells = []  # (thread, cell) tuples of the threads that have recorded something
+        self.retired = [0] * size  # Sum of the cells of threads that have exited
+        self.lock = threading.Lock()  # Only taken when a thread records for the first time and on collect()
+
+    def cell(self):
+        """Return the calling thread's cell."""
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+            return cell
+
+    def collect(self):
+        """Return the sum of all cells."""
+        with self.lock:
+            alive = []
+            for thread, cell in self.cells:
+                if thread.is_alive():
+                    alive.append((thread, cell))
+                else:  # The thread cannot write to its cell anymore
+                    for index, value in enumerate(cell):
+                        self.retired[index] += value
+            self.cells = alive
+            total = list(self.retired)
+            for _, cell in alive:
+                for index, value in enumerate(cell):
+                    total[index] += value
+        return total
+
+
+class Counter:
+    """Monotonically increasing count, e.g. of messages or bytes."""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = ShardedValues(1)
+
+    def inc(self, amount=1):
+        self.values.cell()[0] += amount
+
+    def value(self):
+        return self.values.collect()[0]
+
+    def render(self):
+        return [f"{self.name} {format_value(self.value())}"]
+
+
+class Gauge:
+    """Current value returned by a function, e.g. the number of connected clients."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def value(self):
+        return self.function()
+
+    def render(self):
+        return [f"{self.name} {format_value(self.value())}"]
+
+
+class Histogram:
+    """Distribution of observed values (seconds) over fixed buckets, with their count and sum."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf bucket, then the sum of the observed values
+        self.values = ShardedValues(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self.values.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def render(self):
+        values = self.values.collect()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), values):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(values[-1])}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """All metrics of the process, by name."""
+
+    def __init__(self):
+        self.metrics = {}  # Dictionary in the format {name: metric}, in registration order
+        self.lock = threading.Lock()
+
+    def register(self, metric_class, name, *args):
+        """Return the metric with the given name, creating it on first use."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, *args)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help):
+    """Return the counter with the given name from the default registry."""
+    return REGISTRY.register(Counter, name, help)
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+    """Return the histogram with the given name from the default registry."""
+    return REGISTRY.register(Histogram, name, help, buckets)
+
+
+def gauge(name, help, function):
+    """Register a gauge in the default registry, or point an existing one to a new function."""
+    metric = REGISTRY.register(Gauge, name, help, function)
+    metric.function = function
+    return metric
+
+
+def serve(host, port):
+    """Start the metrics HTTP endpoint on a daemon thread and return the HTTP server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serves the registry on /metrics."""
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not worth a line on the console
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,406 @@
+"""
+Durable, segmented append-only log of the chat messages broadcast by the server.
+
+The log is a directory of segments. Each segment is a pair of files named after the offset
+(the log-wide record number) of its first record:
+    00000000000000000000.log    records, appended and never modified
+    00000000000000000000.index  sparse index, one entry per INDEX_INTERVAL bytes of records
+
+Record layout (big-endian):
+    +-------------+-------------+--------+-----------+-----------+-------------+------+-------+
+    | body length | CRC-32      | offset | timestamp | room seq  | room length | room | frame |
+    | 4 bytes     | 4 bytes     | 8      | 8 (float) | 8         | 2           |      |       |
+    +-------------+-------------+--------+-----------+-----------+-------------+------+-------+
+The frame is the encoded MESSAGE frame exactly as it was broadcast, so replaying it needs no encoding.
+
+- append() only queues the record. A writer thread collects everything appended within
+  flush_interval and writes it with one write() and one fsync() (group commit), so a crash loses
+  at most the last flush_interval of messages and the broadcast path never waits for the disk.
+- read() maps segments with mmap and uses the index to jump to the first record of a time range,
+  so serving history never loads whole files.
+- A segment is closed once it reaches segment_bytes. Closed segments are deleted, oldest first,
+  while the log is larger than retention_bytes or their records are older than retention_age.
+  The limits are checked at startup, at every rotation and, for the age limit of a log that
+  stopped growing, by the writer thread every RETENTION_CHECK_INTERVAL seconds.
+- On startup a torn record at the end of the last segment (crash during a write) is truncated
+  and its index is rebuilt.
+"""
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from console import log
+
+RECORD_HEADER = struct.Struct('!II')  # Body length, CRC-32 of the body
+RECORD_BODY = struct.Struct('!QdQH')  # Offset, wall-clock time, room sequence number, room name length
+INDEX_ENTRY = struct.Struct('!QdI')  # Offset, wall-clock time, position of the record in the segment
+LOG_SUFFIX = '.log'
+INDEX_SUFFIX = '.index'
+INDEX_INTERVAL = 4096  # Bytes of records between two index entries
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_RETENTION_BYTES = 1024 * 1024 * 1024
+DEFAULT_RETENTION_AGE = 7 * 24 * 3600.0  # Seconds
+DEFAULT_FLUSH_INTERVAL = 0.005  # Seconds a record may wait for the group commit
+RETENTION_CHECK_INTERVAL = 60.0  # Seconds between two retention checks of the writer thread (or retention_age if shorter)
+
+
+def sync(fd):
+    """Flush a file's data to disk (fdatasync() where available, it skips the metadata update)."""
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def write_all(fd, data):
+    """os.write() until every byte is written."""
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def encode_record(offset, timestamp, room, seq, frame):
+    """Build a log record."""
+    room = room.encode('utf-8')
+    body = RECORD_BODY.pack(offset, timestamp, seq, len(room)) + room + frame
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+class Segment:
+    """One log file and its sparse index."""
+    __slots__ = ('base_offset', 'path', 'index_path', 'size', 'index', 'last_indexed', 'log_fd', 'index_fd')
+
+    def __init__(self, directory, base_offset):
+        self.base_offset = base_offset
+        self.path = os.path.join(directory, f"{base_offset:020d}{LOG_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}{INDEX_SUFFIX}")
+        self.size = 0  # Bytes of records written to the file
+        self.index = []  # (offset, time, position) tuples
+        self.last_indexed = 0  # Position of the record of the latest index entry
+        self.log_fd = None  # Only the active segment is open for writing
+        self.index_fd = None
+
+    def first_time(self):
+        """Return the time of the first record, None if the segment is empty."""
+        return self.index[0][1] if self.index else None
+
+    def load_index(self):
+        """Read the index file. Return False if it is missing or damaged."""
+        try:
+            with open(self.index_path, 'rb') as file:
+                data = file.read()
+            self.size = os.path.getsize(self.path)
+        except OSError:
+            return False
+        if len(data) % INDEX_ENTRY.size:
+            return False
+        self.index = [INDEX_ENTRY.unpack_from(data, position) for position in range(0, len(data), INDEX_ENTRY.size)]
+        if self.index:
+            self.last_indexed = self.index[-1][2]
+        return True
+
+    def recover(self):
+        """
+        Scan the records, rebuild the index and truncate anything after the last valid record.
+        - Return the offset of the last valid record, None if there is none.
+        """
+        self.index = []
+        self.last_indexed = 0
+        last_offset = None
+        position = 0
+        with open(self.path, 'r+b') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    while position + RECORD_HEADER.size <= size:
+                        length, checksum = RECORD_HEADER.unpack_from(view, position)
+                        body = position + RECORD_HEADER.size
+                        if body + length > size or length < RECORD_BODY.size or zlib.crc32(view[body:body + length]) != checksum:
+                            break
+                        offset, timestamp, _, _ = RECORD_BODY.unpack_from(view, body)
+                        if not self.index or position - self.last_indexed >= INDEX_INTERVAL:
+                            self.index.append((offset, timestamp, position))
+                            self.last_indexed = position
+                        last_offset = offset
+                        position = body + length
+            if position < size:
+                log.warning(f"Truncating {size - position} damaged bytes at the end of {self.path}")
+                file.truncate(position)
+        self.size = position
+        with open(self.index_path, 'wb') as file:
+            file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        return last_offset
+
+    def open_for_append(self):
+        """Open the files of the new active segment for appending."""
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+        self.log_fd = os.open(self.path, flags, 0o644)
+        self.index_fd = os.open(self.index_path, flags, 0o644)
+
+    def close(self):
+        """Flush and close the files of the active segment."""
+        if self.log_fd is None:
+            return
+        sync(self.log_fd)
+        sync(self.index_fd)
+        os.close(self.log_fd)
+        os.close(self.index_fd)
+        self.log_fd = self.index_fd = None
+
+    def read(self, room=None, start=None, end=None):
+        """Yield (offset, time, room, seq, frame) for the matching records of this segment."""
+        index = list(self.index)  # Snapshot, the writer thread may append to it
+        position = 0
+        if start is not None and index:
+            # Jump to the last index entry before the start of the range, then scan forward
+            entry = bisect.bisect_left([entry[1] for entry in index], start) - 1
+            position = index[max(0, entry)][2]
+        wanted = room.encode('utf-8') if room is not None else None
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:  # Deleted by the retention policy in the meantime
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if size <= position:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                while position + RECORD_HEADER.size <= size:
+                    length, _ = RECORD_HEADER.unpack_from(view, position)
+                    body = position + RECORD_HEADER.size
+                    if body + length > size:
+                        return  # A record the writer thread is still writing
+                    offset, timestamp, seq, room_length = RECORD_BODY.unpack_from(view, body)
+                    position = body + length
+                    if start is not None and timestamp < start:
+                        continue
+                    if end is not None and timestamp > end:
+                        return
+                    name = body + RECORD_BODY.size
+                    record_room = view[name:name + room_length]
+                    if wanted is not None and record_room != wanted:
+                        continue
+                    yield offset, timestamp, record_room.decode('utf-8'), seq, view[name + room_length:position]
+
+    def last_seqs(self, seqs):
+        """Raise the {room: sequence number} entries of seqs to the newest record of each room in this segment."""
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                position = 0
+                while position + RECORD_HEADER.size <= size:
+                    length, _ = RECORD_HEADER.unpack_from(view, position)
+                    body = position + RECORD_HEADER.size
+                    if body + length > size:
+                        return
+                    _, _, seq, room_length = RECORD_BODY.unpack_from(view, body)
+                    name = body + RECORD_BODY.size
+                    room = view[name:name + room_length]
+                    if seq > seqs.get(room, 0):
+                        seqs[room] = seq
+                    position = body + length
+
+
+class MessageLog:
+    """Segmented append-only message log with group commit, see the module docstring."""
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, retention_bytes=DEFAULT_RETENTION_BYTES,
+                 retention_age=DEFAULT_RETENTION_AGE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        self.flush_interval = flush_interval
+        self.segments = []  # Oldest first, the last one is the active segment
+        self.pending = []  # (offset, record) tuples waiting for the writer thread
+        self.pending_since = 0.0  # Time at which the oldest pending record was appended
+        self.next_offset = 0  # Offset of the next appended record
+        self.retention_checked = 0.0  # time.monotonic() of the last enforce_retention()
+        self.last_time = 0.0  # Timestamps never go backwards, even if the wall clock does
+        self.closed = False
+        self.condition = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+        self.open_segments()
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def open_segments(self):
+        """Load the existing segments, recover the last one and open it for appending."""
+        offsets = sorted(int(name[:-len(LOG_SUFFIX)]) for name in os.listdir(self.directory)
+                         if name.endswith(LOG_SUFFIX) and name[:-len(LOG_SUFFIX)].isdigit())
+        for position, base_offset in enumerate(offsets):
+            segment = Segment(self.directory, base_offset)
+            if position == len(offsets) - 1 or not segment.load_index():
+                last_offset = segment.recover()
+                if position == len(offsets) - 1:
+                    self.next_offset = base_offset if last_offset is None else last_offset + 1
+            self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+        for segment in self.segments:
+            if segment.index:
+                self.last_time = max(self.last_time, segment.index[-1][1])
+        self.segments[-1].open_for_append()
+        self.enforce_retention()
+
+    def append(self, room, seq, frame):
+        """Queue a message for the writer thread and return its offset. Does not wait for the disk."""
+        with self.condition:
+            if self.closed:
+                raise ValueError("The message log is closed")
+            self.last_time = max(self.last_time, time.time())
+            offset = self.next_offset
+            self.next_offset += 1
+            if not self.pending:
+                self.pending_since = time.monotonic()
+                self.condition.notify_all()
+            self.pending.append((offset, self.last_time, encode_record(offset, self.last_time, room, seq, frame)))
+            return offset
+
+    def close(self):
+        """Write what is pending, then close the active segment."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.segments[-1].close()
+
+    def read(self, room=None, start=None, end=None):
+        """
+        Yield (offset, time, room, seq, frame) for every record of a room (or of every room if None)
+        with a time between start and end (both inclusive, None for no limit), oldest first.
+        """
+        segments = list(self.segments)
+        for position, segment in enumerate(segments):
+            following = segments[position + 1].first_time() if position + 1 < len(segments) else None
+            if start is not None and following is not None and following < start:
+                continue  # Everything in this segment is older than the range
+            first = segment.first_time()
+            if end is not None and first is not None and first > end:
+                return
+            yield from segment.read(room, start, end)
+
+    def last_seqs(self):
+        """
+        Return the sequence number of the newest record of every room in the log, {room: seq}.
+        - Scans the record headers of every segment, the frames are not read.
+        """
+        seqs = {}
+        for segment in list(self.segments):
+            segment.last_seqs(seqs)
+        return {room.decode('utf-8'): seq for room, seq in seqs.items()}
+
+    def size(self):
+        """Return the total size of the segments in bytes."""
+        return sum(segment.size for segment in self.segments)
+
+    def write_records(self):
+        """Writer thread: write and sync the pending records in batches (group commit), and apply the age limit."""
+        check_interval = min(RETENTION_CHECK_INTERVAL, max(self.retention_age, 1.0))  # At most once per second
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    # Wake up for the next retention check even if nothing is appended
+                    timeout = self.retention_checked + check_interval - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if self.closed and not self.pending:
+                    return
+                batch = self.pending
+                if batch:
+                    # Give the appends of the next flush_interval a chance to join this batch
+                    deadline = self.pending_since + self.flush_interval
+                    while not self.closed and time.monotonic() < deadline:
+                        self.condition.wait(deadline - time.monotonic())
+                    batch = self.pending
+                    self.pending = []
+            try:
+                if batch:
+                    self.write_batch(batch)
+                if time.monotonic() - self.retention_checked >= check_interval:
+                    self.enforce_retention()
+            except OSError as e:
+                log.error(f"Error writing to the message log in {self.directory}: {e}")
+
+    def write_batch(self, batch):
+        """Append a batch of records to the active segment, rolling over to a new segment when it is full."""
+        records = []
+        entries = []
+        segment = self.segments[-1]
+        size, last_indexed = segment.size, segment.last_indexed  # The segment's own are updated once the records are written
+        for offset, timestamp, record in batch:
+            if size and size + len(record) > self.segment_bytes:
+                self.write_chunk(segment, records, entries, size, last_indexed)
+                records, entries = [], []
+                self.rotate(offset)
+                segment = self.segments[-1]
+                size, last_indexed = 0, 0
+            if not (segment.index or entries) or size - last_indexed >= INDEX_INTERVAL:
+                entries.append((offset, timestamp, size))
+                last_indexed = size
+            size += len(record)
+            records.append(record)
+        self.write_chunk(segment, records, entries, size, last_indexed)
+
+    def write_chunk(self, segment, records, entries, size, last_indexed):
+        """
+        Write records and index entries with one write() each, sync the records, then account for them.
+        - If a write fails (ENOSPC, EIO) both files are cut back to what was written before, so the
+          index never points past the last complete record, and the error is raised.
+        """
+        if not records:
+            return
+        try:
+            write_all(segment.log_fd, b''.join(records))
+            if entries:
+                write_all(segment.index_fd, b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+            sync(segment.log_fd)
+        except OSError:
+            try:
+                os.ftruncate(segment.log_fd, segment.size)
+                os.ftruncate(segment.index_fd, len(segment.index) * INDEX_ENTRY.size)
+            except OSError as e:
+                log.error(f"Could not cut {segment.path} back to its last complete record: {e}")
+            raise
+        segment.size = size
+        segment.index.extend(entries)
+        segment.last_indexed = last_indexed
+
+    def rotate(self, base_offset):
+        """Close the active segment, start a new one and apply the retention limits."""
+        self.segments[-1].close()
+        segment = Segment(self.directory, base_offset)
+        segment.open_for_append()
+        self.segments.append(segment)
+        self.enforce_retention()
+
+    def enforce_retention(self):
+        """Delete closed segments, oldest first, while the log is too large or they are too old."""
+        self.retention_checked = time.monotonic()
+        expired = time.time() - self.retention_age
+        total = self.size()
+        while len(self.segments) > 1:
+            oldest, following = self.segments[0], self.segments[1]
+            newest_time = following.first_time()  # Every record of the oldest segment is older than this
+            if total <= self.retention_bytes and (newest_time is None or newest_time >= expired):
+                return
+            self.segments.pop(0)
+            total -= oldest.size
+            for path in (oldest.path, oldest.index_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
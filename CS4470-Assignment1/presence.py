@@ -0,0 +1,184 @@
+"""
+Presence of the clients of server.py: who is in a room, and who is idle.
+
+Instead of one announcement per join broadcast to the whole room (N joins cost N * N frames),
+the changes of a room are collected and broadcast once per window as a single PRESENCE delta.
+A mass join or a reconnect storm of N clients then costs about N frames per window, and a
+client that leaves and comes back within the window causes no update at all.
+
+Every client sees the same state: the one of the last flush. A joining client gets it as a
+snapshot (so it does not list itself until the next delta), then the deltas of every later
+flush. The snapshot is queued under the same lock as the deltas, so a client never applies an
+older snapshot after a newer delta. A "who" query is answered with the same snapshot, which
+also resynchronises a client whose queue overflowed and dropped a delta.
+
+A member becomes idle after idle_after seconds without sending a chat message and online
+again with the next one. Members are kept in order of activity, so the sweep at every flush
+only looks at the ones that actually go idle.
+
+PRESENCE payload (UTF-8, usernames cannot contain a newline since they are the first line of a JOIN):
+    snapshot\\n+alice\\n~bob     every member of the room, replaces the client's list
+    delta\\n+carol\\n-dave       changes since the previous flush, applied in order
+States: '+' online, '~' idle, '-' left (deltas only).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import framing
+import metrics
+from console import log
+
+DEFAULT_WINDOW = 0.2  # Seconds over which the changes of a room are coalesced into one delta
+DEFAULT_IDLE_AFTER = 300.0  # Seconds without a chat message after which a member is idle, 0 disables idle tracking
+WHO = b"who"  # CONTROL payload of a client asking for the members of its room
+ONLINE = '+'
+IDLE = '~'
+LEFT = '-'
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+
+deltas_sent = metrics.counter('chat_presence_deltas_total', "Presence deltas broadcast to a room")
+changes_sent = metrics.counter('chat_presence_changes_total', "Joins, leaves and idle changes sent in presence deltas")
+changes_coalesced = metrics.counter('chat_presence_coalesced_total', "Presence changes cancelled out within a window and never sent")
+
+
+def encode_presence(kind, members):
+    """Build a PRESENCE payload from SNAPSHOT or DELTA and (username, state) pairs."""
+    return '\n'.join([kind] + [state + username for username, state in members]).encode('utf-8')
+
+
+def decode_presence(payload):
+    """Split a PRESENCE payload into the kind and a list of (username, state) pairs."""
+    kind, *lines = payload.decode('utf-8').split('\n')
+    if kind not in (SNAPSHOT, DELTA) or any(line[:1] not in (ONLINE, IDLE, LEFT) for line in lines):
+        raise framing.FrameError("Presence frame with an unknown kind or state")
+    return kind, [(line[1:], line[0]) for line in lines]
+
+
+def apply_presence(directory, payload):
+    """
+    Update a {username: state} dictionary with a PRESENCE payload.
+    - Return the kind and a list of (username, state, previous state or None if it was not a member).
+    """
+    kind, members = decode_presence(payload)
+    if kind == SNAPSHOT:
+        directory.clear()
+    changes = []
+    for username, state in members:
+        if state == LEFT:
+            changes.append((username, state, directory.pop(username, None)))
+        else:
+            changes.append((username, state, directory.get(username)))
+            directory[username] = state
+    return kind, changes
+
+
+class RoomPresence:
+    """Presence state of one room."""
+    __slots__ = ('members', 'activity', 'announced', 'changed')
+
+    def __init__(self):
+        self.members = {}  # Current state in the format {username: ONLINE or IDLE}
+        self.activity = OrderedDict()  # {username: time of the last chat message} of the online members, least recent first
+        self.announced = {}  # State as of the last flush, what every client of the room sees
+        self.changed = set()  # Usernames whose state may differ from the announced one
+
+
+class Presence:
+    """
+    Presence of every room.
+    - join(), leave() and active() are called by the server's connection handlers.
+    - flush() returns the deltas to broadcast, the server calls it once per window.
+    - The server holds lock while it queues a snapshot for a client and while it broadcasts the
+      deltas of a flush, so every client gets them in the order they were made.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, idle_after=DEFAULT_IDLE_AFTER):
+        self.window = window
+        self.idle_after = idle_after
+        self.rooms = {}  # Dictionary in the format {room: RoomPresence}
+        self.lock = threading.RLock()
+
+    def join(self, room, username):
+        """Mark a user of a room online."""
+        with self.lock:
+            presence = self.rooms.get(room)
+            if presence is None:
+                presence = self.rooms[room] = RoomPresence()
+            presence.members[username] = ONLINE
+            presence.activity[username] = time.monotonic()
+            presence.activity.move_to_end(username)
+            presence.changed.add(username)
+
+    def leave(self, room, username):
+        """Remove a user from a room."""
+        with self.lock:
+            presence = self.rooms.get(room)
+            if presence is None or presence.members.pop(username, None) is None:
+                return
+            presence.activity.pop(username, None)
+            presence.changed.add(username)
+
+    def active(self, room, username):
+        """Record a chat message of a user, which makes an idle user online again."""
+        with self.lock:
+            presence = self.rooms.get(room)
+            if presence is None or username not in presence.members:
+                return
+            if presence.members[username] == IDLE:
+                presence.members[username] = ONLINE
+                presence.changed.add(username)
+            presence.activity[username] = time.monotonic()
+            presence.activity.move_to_end(username)
+
+    def snapshot(self, room):
+        """Return the SNAPSHOT payload of a room, as of the last flush."""
+        with self.lock:
+            presence = self.rooms.get(room)
+            return encode_presence(SNAPSHOT, presence.announced.items() if presence is not None else ())
+
+    def flush(self):
+        """Mark the members that went idle and return the (room, DELTA payload) of every room that changed."""
+        deltas = []
+        with self.lock:
+            idle_since = time.monotonic() - self.idle_after
+            for room, presence in list(self.rooms.items()):
+                if self.idle_after > 0:
+                    while presence.activity and next(iter(presence.activity.values())) <= idle_since:
+                        username, _ = presence.activity.popitem(last=False)
+                        presence.members[username] = IDLE
+                        presence.changed.add(username)
+                if presence.changed:
+                    changes = []
+                    for username in presence.changed:
+                        state = presence.members.get(username, LEFT)
+                        if state == presence.announced.get(username, LEFT):
+                            changes_coalesced.inc()
+                            continue
+                        changes.append((username, state))
+                        if state == LEFT:
+                            del presence.announced[username]
+                        else:
+                            presence.announced[username] = state
+                    presence.changed.clear()
+                    if changes:
+                        deltas.append((room, encode_presence(DELTA, changes)))
+                        changes_sent.inc(len(changes))
+                if not presence.members and not presence.announced:
+                    del self.rooms[room]
+        deltas_sent.inc(len(deltas))
+        return deltas
+
+    def run_flusher(self, broadcast):
+        """Start a daemon thread that broadcasts the deltas once per window with broadcast(room, payload)."""
+        def flush():
+            while True:
+                time.sleep(self.window)
+                try:
+                    with self.lock:
+                        for room, payload in self.flush():
+                            broadcast(room, payload)
+                except Exception as e:  # Never let one bad room stop the updates
+                    log.error(f"Presence flush failed: {e}")
+        threading.Thread(target=flush, daemon=True).start()
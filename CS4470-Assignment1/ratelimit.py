@@ -0,0 +1,159 @@
+"""
+Token-bucket rate limits for the chat messages clients send to server.py.
+
+Every client has its own bucket and every room has one shared by its members. A message
+takes one token from both. The check is a few float operations, done in the read path
+before the message is recorded and broadcast.
+
+What happens to a message over the limit depends on the policy:
+- throttle (default): the message is let through, but the reader waits until the tokens
+  are paid back before it reads the next frame. While it waits the client's socket is not
+  read, so its kernel buffers fill up and TCP flow control slows the client down instead
+  of the server buffering its messages.
+- drop: the message is discarded and the client is not slowed down.
+
+A room's bucket is forgotten once it has filled up again (a new one would be in the same
+state), so the buckets of rooms that went quiet do not pile up on a long-running server.
+"""
+import threading
+import time
+
+import metrics
+
+THROTTLE = 'throttle'
+DROP = 'drop'
+POLICIES = (THROTTLE, DROP)
+DEFAULT_CLIENT_RATE = 20.0  # Messages per second of one client, 0 disables the limit
+DEFAULT_CLIENT_BURST = 50  # Messages a client may send at once after being quiet
+DEFAULT_ROOM_RATE = 500.0  # Messages per second of all the clients of a room, 0 disables the limit
+DEFAULT_ROOM_BURST = 1000
+SWEEP_INTERVAL = 60.0  # Seconds between two sweeps of the room buckets that filled up again
+
+throttled = metrics.counter('chat_messages_throttled_total', "Messages over a rate limit whose sender had to wait")
+throttle_seconds = metrics.counter('chat_throttle_seconds_total', "Seconds readers waited because of the rate limits")
+dropped = metrics.counter('chat_messages_rate_limited_total', "Messages dropped because of the rate limits")
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens and gains `rate` tokens per second.
+    - The room buckets are shared by the reader threads of their clients, hence the lock.
+    - reserve() may leave the bucket in debt, the caller then waits for the debt to be paid back.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, now):
+        """Take a token, even if there is none, and return the seconds until the bucket is out of debt."""
+        with self.lock:
+            self.refill(now)
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def try_take(self, now):
+        """Take a token if there is one, return False otherwise."""
+        with self.lock:
+            self.refill(now)
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def give_back(self):
+        """Return a token taken by try_take()."""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def full(self, now):
+        """Return True if the bucket has refilled to its burst."""
+        with self.lock:
+            return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Rate limit configuration of the server and the buckets of its rooms."""
+
+    def __init__(self, client_rate=DEFAULT_CLIENT_RATE, client_burst=DEFAULT_CLIENT_BURST,
+                 room_rate=DEFAULT_ROOM_RATE, room_burst=DEFAULT_ROOM_BURST, policy=THROTTLE):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown rate limit policy: {policy}")
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.policy = policy
+        self.rooms = {}  # Dictionary in the format {room: TokenBucket}
+        self.swept = time.monotonic()  # Time of the last sweep()
+        self.sweep_lock = threading.Lock()
+
+    def client_bucket(self):
+        """Return a new bucket for a client, or None if clients are not limited."""
+        return TokenBucket(self.client_rate, self.client_burst) if self.client_rate > 0 else None
+
+    def room_bucket(self, room):
+        """Return the bucket of a room, or None if rooms are not limited."""
+        if self.room_rate <= 0:
+            return None
+        bucket = self.rooms.get(room)
+        if bucket is None:
+            # setdefault is atomic, so two threads creating the same bucket end up using one
+            bucket = self.rooms.setdefault(room, TokenBucket(self.room_rate, self.room_burst))
+        return bucket
+
+    def admit(self, client_bucket, room):
+        """
+        Charge one message to a client and its room.
+        - Return the seconds the reader should wait before reading the client's next frame.
+        - Return None if the message has to be dropped.
+        """
+        now = time.monotonic()
+        if self.room_rate > 0 and now - self.swept >= SWEEP_INTERVAL:
+            self.sweep(now)  # Before fetching the bucket, so this message is not charged to a forgotten one
+        room_bucket = self.room_bucket(room)
+        if client_bucket is None and room_bucket is None:
+            return 0.0
+        if self.policy == DROP:
+            if client_bucket is not None and not client_bucket.try_take(now):
+                dropped.inc()
+                return None
+            if room_bucket is not None and not room_bucket.try_take(now):
+                if client_bucket is not None:
+                    client_bucket.give_back()
+                dropped.inc()
+                return None
+            return 0.0
+        delay = 0.0
+        if client_bucket is not None:
+            delay = client_bucket.reserve(now)
+        if room_bucket is not None:
+            delay = max(delay, room_bucket.reserve(now))
+        if delay > 0:
+            throttled.inc()
+            throttle_seconds.inc(delay)
+        return delay
+
+    def sweep(self, now):
+        """
+        Forget the room buckets that have filled up again.
+        - A reader that fetched a bucket just before it is forgotten charges one message to the old
+          bucket, which at most lets one extra message through.
+        """
+        if not self.sweep_lock.acquire(blocking=False):
+            return  # Another thread is sweeping
+        try:
+            self.swept = now
+            for room, bucket in list(self.rooms.items()):
+                if bucket.full(now) and self.rooms.get(room) is bucket:
+                    del self.rooms[room]
+        finally:
+            self.sweep_lock.release()
@@ -0,0 +1,248 @@
+"""
+Connection of client.py to server.py that survives the server going away.
+
+When the connection drops (server restart, network outage, heartbeat eviction) the client
+connects again on its own:
+- Attempts are spaced by exponential backoff with full jitter: the n-th wait is a random
+  time between 0 and min(max_delay, base_delay * 2**n). After a server restart its clients
+  spread their reconnects over the whole window instead of all arriving in the same tick.
+- The JOIN frame of a reconnect carries since=<sequence number of the last message received>,
+  so the server replays only the messages that were missed instead of the full replay of a
+  fresh join.
+- Frames sent while disconnected wait in a bounded outbox and go out, in order, as soon as the
+  server has acknowledged the next JOIN. A frame whose send failed is kept for the next
+  connection too, so a message may arrive twice but is not lost silently.
+- With a tls.client_context() every reconnect offers the TLS session of the previous
+  connection, so a reconnect storm costs resumed handshakes instead of full ones.
+"""
+import random
+import socket
+import ssl
+import threading
+import zlib
+from collections import deque
+
+import compression
+import framing
+import liveness
+import metrics
+import tls
+from console import log
+
+DEFAULT_BASE_DELAY = 0.5  # Seconds, upper bound of the first wait
+DEFAULT_MAX_DELAY = 30.0  # Seconds, upper bound of any wait
+DEFAULT_OUTBOX_LIMIT = 1000  # Frames kept while disconnected, the oldest ones are dropped beyond that
+CONNECT_TIMEOUT = 10.0  # Seconds a connection attempt may take
+USERNAME_TAKEN = b"username-taken"
+
+reconnects = metrics.counter('chat_client_reconnects_total', "Connections to the server made again after one dropped")
+outbox_dropped = metrics.counter('chat_client_outbox_dropped_total', "Frames dropped because the outbox was full while disconnected")
+
+
+class Backoff:
+    """Exponential backoff with full jitter. reset() after a connection succeeded."""
+
+    def __init__(self, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts = 0
+
+    def next_delay(self):
+        """Return the seconds to wait before the next attempt."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ReconnectingClient:
+    """
+    A client connection to server.py that reconnects and resumes on its own.
+    - on_frame(frame_type, payload): every frame the caller has to handle (chat messages, file
+      frames), decompressed, called on the receiving thread. ACKs and pings are handled here.
+    - on_status(text): connection events worth telling the user about.
+    - on_error(title, text): a failure that stops the client (the username is taken).
+    - on_disconnect(): the connection dropped, called before the next attempt.
+    - tls_context: a tls.client_context() to connect with TLS, None for plain TCP.
+    """
+
+    def __init__(self, host, port, username, room=None, on_frame=None, on_status=None, on_error=None,
+                 on_disconnect=None, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 outbox_limit=DEFAULT_OUTBOX_LIMIT, tls_context=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.room = room
+        self.on_frame = on_frame or (lambda frame_type, payload: None)
+        self.on_status = on_status or (lambda text: None)
+        self.on_error = on_error or (lambda title, text: None)
+        self.on_disconnect = on_disconnect or (lambda: None)
+        self.backoff = Backoff(base_delay, max_delay)
+        self.outbox = deque()  # (frame_type, payload) waiting for a connection, encoded when sent since the codec may change
+        self.outbox_limit = outbox_limit
+        self.send_lock = threading.Lock()  # Serialises every write to the socket, and the outbox with it
+        self.sock = None
+        self.connected = False  # True between the ACK and the end of the connection
+        self.ever_connected = False
+        self.codec = None
+        self.last_seq = None  # Sequence number of the latest chat message received, None before the first one
+        self.tls_context = tls_context
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Connect and keep the connection up on a daemon thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        """Stop reconnecting and close the current connection."""
+        self.stopped.set()
+        with self.send_lock:
+            self.connected = False
+            sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def send(self, frame_type, payload):
+        """Send a frame now, or queue it until the connection is back. Never raises on a dropped connection."""
+        with self.send_lock:
+            if self.connected:
+                try:
+                    self.sock.sendall(compression.encode_frame(frame_type, payload, self.codec))
+                    return
+                except OSError:
+                    self.connected = False  # The receiving thread notices too and reconnects
+            self.queue(frame_type, payload)
+
+    def queue(self, frame_type, payload):
+        # Called with the send lock held
+        self.outbox.append((frame_type, payload))
+        if len(self.outbox) > self.outbox_limit:
+            self.outbox.popleft()
+            outbox_dropped.inc()
+
+    def flush(self):
+        """Send the outbox after the server acknowledged the JOIN, before any new frame."""
+        with self.send_lock:
+            while self.outbox:
+                frame_type, payload = self.outbox[0]
+                try:
+                    self.sock.sendall(compression.encode_frame(frame_type, payload, self.codec))
+                except OSError:
+                    return  # Kept for the next connection
+                self.outbox.popleft()
+            self.connected = True
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                sock = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+                if self.tls_context is not None:
+                    tls.no_delay(sock)
+                    # Resumes the previous session if it can
+                    sock = self.tls_context.wrap_socket(sock, server_hostname=self.host, session=self.tls_context.session_for(self.host, self.port))
+            except ssl.SSLCertVerificationError as e:
+                self.on_error("TLS Error", f"The certificate of the server at {self.host}:{self.port} was rejected: {e.verify_message}")
+                return
+            except OSError as e:
+                self.wait(f"Cannot connect to the server at {self.host}:{self.port}: {e}")
+                continue
+            sock.settimeout(None)
+            liveness.enable_keepalive(sock)
+            with self.send_lock:
+                self.sock = sock
+            try:
+                # Offer every codec we can decode, the server names the one it picked in the ACK
+                framing.send_frame(sock, framing.JOIN, framing.encode_join(
+                    self.username, room=self.room, compress=','.join(compression.CODECS), since=self.last_seq))
+                result = self.listen(sock)
+            except (OSError, framing.FrameError, ValueError, zlib.error) as e:  # ValueError includes UnicodeDecodeError
+                result = f"Connection to the server lost: {e}"
+            finally:
+                with self.send_lock:
+                    self.connected = False
+                sock.close()
+            self.on_disconnect()
+            if result is None or self.stopped.is_set():
+                return
+            self.wait(result)
+
+    def wait(self, reason):
+        """Tell the user why the connection is down and sleep until the next attempt."""
+        delay = self.backoff.next_delay()
+        log.warning(f"{reason}, reconnecting in {delay:.1f}s")
+        self.on_status(f"{reason}. Reconnecting in {delay:.1f}s...")
+        self.stopped.wait(delay)
+
+    def listen(self, sock):
+        """
+        Receive frames until the connection ends.
+        - Return why it ended, or None if the client must not reconnect.
+        """
+        decoder = framing.FrameDecoder()
+        while True:
+            frame = framing.recv_frame(sock, decoder)
+            if frame is None:
+                return "The server closed the connection"
+            frame_type, payload = frame
+            if frame_type == framing.COMPRESSED:
+                frame_type, payload = compression.decompress_frame(payload, self.codec)
+            if frame_type == framing.ACK:
+                self.on_ack(payload)
+                continue
+            if frame_type == framing.CONTROL and payload == USERNAME_TAKEN:
+                if not self.ever_connected:
+                    self.on_error("Invalid Username", "Username is already taken.")
+                    return None
+                # Our previous connection is still registered until the server notices it is gone
+                return "The previous session is still open on the server"
+            if frame_type == framing.CONTROL and payload == liveness.PING.encode():
+                # Answer the server's heartbeat, otherwise it disconnects an idle client
+                with self.send_lock:
+                    framing.send_frame(sock, framing.CONTROL, liveness.PONG)
+                continue
+            if frame_type == framing.MESSAGE:
+                try:
+                    self.last_seq = framing.decode_message(payload)[0]
+                except ValueError as e:  # UnicodeDecodeError included, the frames after it are still intact
+                    log.warning(f"Dropped a malformed message from the server: {e}")
+                    continue
+            try:
+                self.on_frame(frame_type, payload)
+            except Exception as e:  # One frame the caller cannot handle must not stop the receiving thread
+                log.error(f"Dropped a frame of type {frame_type} from the server: {e!r}")
+
+    def on_ack(self, payload):
+        _, fields = framing.decode_join(payload)
+        self.codec = fields.get('compress') or None
+        latest = parse_seq(fields)
+        if self.ever_connected:
+            reconnects.inc()
+            if self.last_seq is not None and latest < self.last_seq:
+                # The server restarted without its message log, its numbering started over
+                self.on_status("Reconnected, the server lost the room's history: messages may have been missed.")
+                self.last_seq = latest
+            else:
+                self.on_status(f"Reconnected to the server at {self.host}:{self.port}.")
+        else:
+            self.on_status(f"Client connected to the server at {self.host}:{self.port}.")
+        if self.last_seq is None:
+            # The replay that follows ends at this message, a reconnect must not replay it again
+            self.last_seq = latest
+        if self.tls_context is not None:
+            self.tls_context.remember(self.sock, self.port)  # The session tickets arrived before the ACK
+        self.ever_connected = True
+        self.backoff.reset()
+        self.flush()
+
+
+def parse_seq(fields):
+    """Return the seq field of a decoded ACK frame as an int, 0 if it is missing or invalid."""
+    try:
+        return int(fields['seq'])
+    except (KeyError, ValueError):
+        return 0
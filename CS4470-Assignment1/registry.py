@@ -0,0 +1,104 @@
+"""
+Connection registry shared by chat.py and server.py.
+
+Connections are indexed by id, by (ip, port) and by username, so every lookup is a single
+dictionary access instead of a scan over all connections. Released ids go to a min-heap and
+the lowest one is handed out again first.
+
+Locking:
+- The registry lock only guards the indexes and is never held while doing socket I/O.
+- Lookups read the dictionaries without taking the lock (single dict reads are atomic in CPython).
+- Each connection has its own send lock, so sending to one peer does not block the others.
+"""
+import heapq
+import threading
+
+
+class Connection:
+    """One registered connection."""
+    __slots__ = ('id', 'sock', 'address', 'username', 'room', 'send_lock', 'last_seen', 'pinged', 'codec')
+
+    def __init__(self, connection_id, sock, address, username, room):
+        self.id = connection_id
+        self.sock = sock  # Socket (or asyncio StreamWriter) of the connection
+        self.address = address  # (ip, port) tuple
+        self.username = username  # None for chat.py peers
+        self.room = room  # Chat room of a server client, None for chat.py peers
+        self.send_lock = threading.Lock()  # Serialises writes of whole frames to this connection
+        self.last_seen = 0.0  # time.monotonic() of the last frame received, see liveness.Heartbeat
+        self.pinged = 0.0  # time.monotonic() of the last unanswered heartbeat ping, 0 if none
+        self.codec = None  # Compression negotiated with the client, see compression.py
+
+    def __repr__(self):
+        return f"Connection({self.id}, {self.address}, {self.username!r}, {self.room!r})"
+
+
+class ConnectionRegistry:
+    """Connections indexed by id, (ip, port) and username, with reusable ids."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_id = {}  # Dictionary in the format {id: Connection}
+        self.by_address = {}  # Dictionary in the format {(ip, port): Connection}
+        self.by_username = {}  # Dictionary in the format {(room, username): Connection}
+        self.free_ids = []  # Min-heap of ids released by removed connections
+        self.next_id = 1  # Next never used id
+
+    def add(self, sock, address, username=None, room=None):
+        """
+        Register a connection and give it the lowest free id.
+        - Return None if the address, or the username within the room, is already registered.
+        """
+        with self.lock:
+            if address in self.by_address or (username is not None and (room, username) in self.by_username):
+                return None
+            if self.free_ids:
+                connection_id = heapq.heappop(self.free_ids)
+            else:
+                connection_id = self.next_id
+                self.next_id += 1
+            connection = Connection(connection_id, sock, address, username, room)
+            self.by_id[connection_id] = connection
+            self.by_address[address] = connection
+            if username is not None:
+                self.by_username[(room, username)] = connection
+            return connection
+
+    def remove(self, connection):
+        """Unregister a connection. Return False if it was already removed."""
+        with self.lock:
+            if self.by_id.get(connection.id) is not connection:
+                return False
+            del self.by_id[connection.id]
+            del self.by_address[connection.address]
+            if connection.username is not None:
+                del self.by_username[(connection.room, connection.username)]
+            heapq.heappush(self.free_ids, connection.id)
+            return True
+
+    def pop(self, connection_id):
+        """Unregister and return the connection with the given id, or None if there is none."""
+        connection = self.by_id.get(connection_id)
+        if connection is not None and self.remove(connection):
+            return connection
+        return None
+
+    def get(self, connection_id):
+        """Return the connection with the given id, or None."""
+        return self.by_id.get(connection_id)
+
+    def find_address(self, address):
+        """Return the connection to the given (ip, port), or None."""
+        return self.by_address.get(address)
+
+    def find_username(self, username, room=None):
+        """Return the connection of the given user in the given room, or None."""
+        return self.by_username.get((room, username))
+
+    def connections(self):
+        """Return a snapshot list of all connections, ordered by id."""
+        with self.lock:
+            return sorted(self.by_id.values(), key=lambda connection: connection.id)
+
+    def __len__(self):
+        return len(self.by_id)
@@ -0,0 +1,445 @@
+"""
+Single-threaded I/O core for chat.py built on the selectors module (epoll on Linux).
+
+The listening socket and every peer socket are non-blocking and multiplexed on one thread,
+instead of one accept thread plus one thread per peer. The command loop in chat.py runs on
+the main thread and hands work to the core with submit(), which is thread-safe and returns a
+concurrent.futures.Future for the result.
+
+With a liveness.Heartbeat, select() wakes up once per heartbeat tick and the checks run on the
+I/O thread, so pinging and evicting peers needs no locking.
+
+With TLS contexts the sockets are wrapped before they are registered and the handshake is
+driven by the socket events like everything else. Frames queued meanwhile (the JOIN frame of
+an outgoing connection) wait in the outbound buffer until the handshake is done.
+"""
+import errno
+import queue
+import selectors
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import framing
+import liveness
+import tls
+import transfer
+from console import log
+
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)  # A TLS record may need more bytes in or out first
+ACCEPT_PAUSE = 0.1  # Seconds the listening socket is left alone after accept() failed, e.g. out of file descriptors
+
+
+class PeerState:
+    """Per-socket state kept by the I/O core."""
+    __slots__ = ('sock', 'address', 'decoder', 'outbound', 'connection', 'connecting', 'close_after_flush', 'files', 'handshaking')
+
+    def __init__(self, sock, address, connecting=False):
+        self.sock = sock
+        self.address = address  # (ip, port) as shown by list, the port is the peer's listening port once known
+        self.decoder = framing.FrameDecoder()
+        self.outbound = bytearray()  # Bytes the kernel did not accept yet
+        self.connection = None  # Registry entry, set once the connection is established
+        self.connecting = connecting  # True while a non-blocking connect() is in progress
+        self.close_after_flush = False  # Close the socket once the outbound buffer is empty
+        self.files = deque()  # transfer.OutgoingFile objects with chunks left to send, served round-robin
+        self.handshaking = False  # True until the TLS handshake of a wrapped socket is complete
+
+
+class SelectorCore:
+    """
+    Event loop that owns the listening socket and all peer sockets.
+    - registry: the ConnectionRegistry shared with chat.py.
+    - local_port: listening port announced to peers in the JOIN frame.
+    - on_frame(connection, frame_type, payload): called for every received frame,
+      returns False when the peer closed the connection.
+    - heartbeat: liveness.Heartbeat whose ping and evict callbacks use ping() and evict(), or None.
+    - on_close(connection): called once a registered connection has been closed, or None.
+    - server_tls, client_tls: SSL contexts for accepted and outgoing connections (see tls.peer_contexts()), or None.
+    """
+
+    def __init__(self, server_socket, registry, local_port, on_frame, heartbeat=None, on_close=None, server_tls=None, client_tls=None):
+        self.selector = selectors.DefaultSelector()
+        self.server_socket = server_socket
+        self.registry = registry
+        self.local_port = local_port
+        self.on_frame = on_frame
+        self.heartbeat = heartbeat
+        self.on_close = on_close
+        self.server_tls = server_tls
+        self.client_tls = client_tls
+        self.peers = {}  # Dictionary in the format {socket: PeerState}
+        self.tasks = queue.SimpleQueue()  # Work submitted by other threads
+        self.running = False
+        self.accept_paused_until = None  # Monotonic time at which the listening socket is watched again after accept() failed
+        # A socket pair used to wake the selector up when work is submitted
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Register the listening socket and start the I/O thread."""
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.run_tasks)
+        self.running = True
+        self.thread.start()
+
+    def submit(self, function, *args):
+        """Run function(*args) on the I/O thread. Thread-safe, returns a Future."""
+        future = Future()
+        self.tasks.put((future, function, args))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            pass  # The wakeup socket is full, so the I/O thread is going to wake up anyway
+        return future
+
+    def run(self):
+        """I/O thread: dispatch socket events until stop() is called."""
+        tick = self.heartbeat.wheel.tick if self.heartbeat is not None else None
+        while self.running:
+            timeout = tick
+            if self.accept_paused_until is not None:
+                timeout = self.accept_paused_until - time.monotonic()
+                if timeout <= 0:
+                    self.accept_paused_until = None
+                    self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+                    timeout = tick
+                elif tick is not None:
+                    timeout = min(timeout, tick)
+            if self.heartbeat is not None:
+                try:
+                    self.heartbeat.check()
+                except Exception as e:  # Never let one bad connection stop the I/O thread
+                    log.error(f"Heartbeat check failed: {e}")
+            for key, events in self.selector.select(timeout):
+                try:
+                    self.dispatch(key, events)
+                except Exception as e:  # Never let one bad connection stop the I/O thread
+                    log.error(f"Handling an event failed: {e}")
+                    state = self.peers.get(key.fileobj)
+                    if state is not None:
+                        self.close(state)
+        self.selector.close()
+
+    def dispatch(self, key, events):
+        """Call the handlers of one ready socket."""
+        callback = key.data
+        if callback is not None:  # Listening or wakeup socket
+            callback()
+            return
+        state = self.peers.get(key.fileobj)
+        if state is None:
+            return
+        if events & selectors.EVENT_WRITE:
+            self.on_writable(state)
+        if events & selectors.EVENT_READ and key.fileobj in self.peers:
+            self.on_readable(state)
+
+    def run_tasks(self):
+        """Run all submitted work, called on the I/O thread when the wakeup socket is readable."""
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                future, function, args = self.tasks.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def accept(self):
+        """Accept a pending connection on the listening socket."""
+        try:
+            client_socket, client_address = self.server_socket.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:  # Out of file descriptors or memory: retrying right away would spin on the ready socket
+            log.error(f"Accepting a connection failed: {e}")
+            self.selector.unregister(self.server_socket)
+            self.accept_paused_until = time.monotonic() + ACCEPT_PAUSE
+            return
+        log.info(f"New connection from {client_address}")  # Notify about the new connection
+        log.info(f"Connection from {client_address} established.")
+        client_socket.setblocking(False)
+        liveness.enable_keepalive(client_socket)
+        if self.server_tls is not None:
+            tls.no_delay(client_socket)
+            client_socket = self.server_tls.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+        state = PeerState(client_socket, client_address)
+        state.handshaking = self.server_tls is not None
+        self.peers[client_socket] = state
+        self.selector.register(client_socket, selectors.EVENT_READ)
+
+    def connect(self, destination, ip, port):
+        """Start a non-blocking connection to a peer (runs on the I/O thread)."""
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer_socket.setblocking(False)
+        liveness.enable_keepalive(peer_socket)
+        if self.client_tls is not None:
+            # Wrapped before connecting, so the socket registered below is the one used from now on
+            tls.no_delay(peer_socket)
+            peer_socket = self.client_tls.wrap_socket(peer_socket, do_handshake_on_connect=False, server_hostname=ip,
+                                                      session=self.client_tls.session_for(ip, port))
+        error = peer_socket.connect_ex((ip, int(port)))
+        if error not in CONNECT_IN_PROGRESS:
+            peer_socket.close()
+            log.info(f"Failed to connect to {destination}:{port}. Error: {errno.errorcode.get(error, error)}")
+            return
+        self.peers[peer_socket] = PeerState(peer_socket, (destination, port), connecting=True)
+        self.selector.register(peer_socket, selectors.EVENT_WRITE)
+
+    def finish_connect(self, state):
+        """Complete a non-blocking connect() once the socket turned writable."""
+        state.connecting = False
+        error = state.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        destination, port = state.address
+        if error:
+            log.info(f"Failed to connect to {destination}:{port}. Error: {errno.errorcode.get(error, error)}")
+            self.discard(state)
+            return
+        state.connection = self.registry.add(state.sock, state.address)
+        if state.connection is None:  # Connected to the same peer in the meantime
+            log.info(f"Error: Already connected to {destination}:{port}")
+            self.discard(state)
+            return
+        log.info(f"Connected to {destination}:{port}.")
+        self.watch(state.connection)
+        self.selector.modify(state.sock, selectors.EVENT_READ)
+        state.handshaking = self.client_tls is not None
+        if not self.write(state, framing.encode_frame(framing.JOIN, str(self.local_port))):  # Buffered until the handshake is done
+            return
+        if state.handshaking:
+            self.handshake(state)
+
+    def handshake(self, state):
+        """Advance the TLS handshake of a socket, called whenever it is readable or writable until it is done."""
+        try:
+            state.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.selector.modify(state.sock, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(state.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return
+        except OSError as e:  # ssl.SSLError included, e.g. a certificate that does not verify
+            log.warning(f"TLS handshake with {state.address[0]}:{state.address[1]} failed: {e}")
+            self.close(state)
+            return
+        state.handshaking = False
+        if state.sock.server_side:
+            tls.record_handshake(state.sock)
+        # Send what was queued during the handshake
+        self.selector.modify(state.sock, selectors.EVENT_READ | selectors.EVENT_WRITE if state.outbound else selectors.EVENT_READ)
+
+    def on_readable(self, state):
+        """Read whatever is available and hand every complete frame to on_frame()."""
+        if state.handshaking:
+            self.handshake(state)
+            return
+        try:
+            data = state.sock.recv(framing.RECV_SIZE)
+            if not data:  # The peer closed the connection
+                self.close(state)
+                return
+            if isinstance(state.sock, ssl.SSLSocket):
+                # Decrypted bytes left in the TLS buffer do not make the socket readable again
+                while state.sock.pending():
+                    data += state.sock.recv(state.sock.pending())
+            for frame_type, payload in state.decoder.feed(data):
+                if state.connection is None:
+                    if not self.register_peer(state, frame_type, payload):
+                        return
+                elif not self.on_frame(state.connection, frame_type, payload):
+                    self.close(state)
+                    return
+        except WOULD_BLOCK:
+            pass
+        except (OSError, framing.FrameError, UnicodeDecodeError) as e:
+            log.warning(f"Error receiving message from {state.address[0]}:{state.address[1]}: {e}")
+            self.close(state)
+
+    def register_peer(self, state, frame_type, payload):
+        """Handle the JOIN frame of an accepted connection. Return False if the connection was closed."""
+        if frame_type != framing.JOIN:
+            log.warning(f"Error handling client {state.address}: Expected the peer's listening port as the first frame")
+            self.discard(state)
+            return False
+        listening_port = payload.decode('utf-8')
+        log.info(f"Peer listening on port {listening_port}")
+        state.address = (state.address[0], listening_port)
+        state.connection = self.registry.add(state.sock, state.address)
+        if state.connection is None:
+            log.warning(f"Error handling client {state.address}: Already connected to {state.address[0]}:{listening_port}")
+            self.discard(state)
+            return False
+        self.watch(state.connection)
+        return True
+
+    def watch(self, connection):
+        """Start the heartbeat of a newly registered connection."""
+        if self.heartbeat is not None:
+            self.heartbeat.watch(connection)
+
+    def on_writable(self, state):
+        """Finish a pending connect(), flush the outbound buffer, then go on with the file transfers."""
+        if state.connecting:
+            self.finish_connect(state)
+            return
+        if state.handshaking:
+            self.handshake(state)
+            return
+        if state.outbound:
+            try:
+                sent = state.sock.send(state.outbound)
+            except WOULD_BLOCK:
+                return
+            except OSError as e:
+                log.warning(f"Error sending message to {state.address[0]}:{state.address[1]}: {e}")
+                self.close(state)
+                return
+            del state.outbound[:sent]
+            if state.outbound:
+                return
+        if state.close_after_flush:
+            self.discard(state)
+        else:
+            self.pump(state)
+
+    def send_file(self, connection, outgoing):
+        """Start sending the chunks of a transfer.OutgoingFile (runs on the I/O thread)."""
+        state = self.peers.get(connection.sock)
+        if state is not None:
+            state.files.append(outgoing)
+            self.pump(state)
+
+    def pump(self, state):
+        """
+        Queue the next file chunk once the outbound buffer is empty.
+        - One chunk per call: the socket then has to become writable again, so the other sockets,
+          and the chat messages queued behind the chunk, get their turn in between.
+        - The chunk is read into the outbound buffer, sendfile() does not work with partial writes
+          on a non-blocking socket.
+        """
+        while state.files and not state.outbound:
+            outgoing = state.files[0]
+            chunk = outgoing.next_chunk()
+            if chunk is None:
+                state.files.popleft()
+                continue
+            state.files.rotate(-1)  # Round-robin between the files sent over this connection
+            offset, length = chunk
+            try:
+                data = outgoing.read(offset, length)
+            except (OSError, ValueError) as e:
+                log.warning(f"Sending {outgoing.name} failed: {e}")
+                state.files.remove(outgoing)
+                continue
+            if not self.write(state, transfer.chunk_header(outgoing.id, offset, length) + data):
+                return
+            break
+        if state.outbound or state.files:
+            self.selector.modify(state.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        else:
+            self.selector.modify(state.sock, selectors.EVENT_READ)
+
+    def write(self, state, data):
+        """
+        Send data now if the socket accepts it, buffer the rest until it is writable.
+        - Return False if sending failed (the peer reset the connection), the connection is closed then.
+        """
+        if state.handshaking:
+            state.outbound += data
+            return True
+        if not state.outbound:
+            try:
+                sent = state.sock.send(data)
+            except WOULD_BLOCK:
+                sent = 0
+            except OSError as e:
+                log.warning(f"Error sending message to {state.address[0]}:{state.address[1]}: {e}")
+                self.close(state)
+                return False
+            if sent == len(data):
+                return True
+            data = data[sent:]
+            self.selector.modify(state.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        state.outbound += data
+        return True
+
+    def send(self, conn_id, frame_type, payload):
+        """Queue a frame for the connection with the given ID. Return False if there is no such connection."""
+        connection = self.registry.get(conn_id)
+        state = self.peers.get(connection.sock) if connection is not None else None
+        if state is None:
+            return False
+        return self.write(state, framing.encode_frame(frame_type, payload))
+
+    def ping(self, connection):
+        """Send a heartbeat ping to a connection (called by the heartbeat on the I/O thread)."""
+        self.send(connection.id, framing.CONTROL, liveness.PING)
+
+    def evict(self, connection):
+        """Close a connection that stopped answering heartbeats (called on the I/O thread)."""
+        state = self.peers.get(connection.sock)
+        if state is not None:
+            log.info(f"Peer at {state.address[0]}:{state.address[1]} did not answer the heartbeat, disconnecting.")
+            self.close(state)
+
+    def terminate(self, conn_id, notice="terminate"):
+        """Send a CONTROL notice and close the connection once it has been flushed."""
+        connection = self.registry.pop(conn_id)
+        if connection is None:
+            return False
+        if self.on_close is not None:
+            self.on_close(connection)
+        state = self.peers.get(connection.sock)
+        if state is not None and self.write(state, framing.encode_frame(framing.CONTROL, notice)):
+            if state.outbound:
+                state.close_after_flush = True
+            else:
+                self.discard(state)
+        return True
+
+    def close(self, state):
+        """Close a connection that ended on the peer's side and remove it from the registry."""
+        self.discard(state)
+        if state.connection is not None and self.registry.remove(state.connection):
+            log.info(f"Connection with {state.address[0]}:{state.address[1]} terminated.")
+            if self.on_close is not None:
+                self.on_close(state.connection)
+
+    def discard(self, state):
+        """Unregister and close a socket without touching the registry."""
+        if self.peers.pop(state.sock, None) is None:
+            return
+        self.selector.unregister(state.sock)
+        if self.client_tls is not None and not state.handshaking and not state.sock.server_side:
+            self.client_tls.remember(state.sock, state.address[1])  # The next connection to this peer resumes the session
+        state.sock.close()
+
+    def stop(self):
+        """Send what is still buffered (best effort), close every socket and stop the I/O thread."""
+        for state in list(self.peers.values()):
+            if state.outbound and not state.connecting:
+                try:
+                    state.sock.setblocking(True)
+                    state.sock.settimeout(1)
+                    state.sock.sendall(state.outbound)
+                except OSError:
+                    pass
+            self.discard(state)
+        self.running = False
@@ -1,72 +1,368 @@
+import argparse
 import socket
 import threading
+import time
+
+import fanout
+import framing
+import compression
+import console
+import history
+import liveness
+import metrics
+import persistence
+import presence
+import ratelimit
+import tls
+import transfer
+from console import log
+from registry import ConnectionRegistry
 
 HOST = '127.0.0.1' # Localhost
 PORT = 12345 # Port number
 LISTEN_QUEUE = 5 # Number of clients that can wait for a connection
-active_clients = [] # List to store all active clients
+active_clients = ConnectionRegistry() # Registry of all active clients, indexed by id, address and username
+broadcaster = fanout.Broadcaster(fanout.ClientQueue) # Outbound queue and writer thread per client, replaced in main()
+message_history = history.MessageHistory() # Recent messages of every room, replayed to joining clients, replaced in main()
+heartbeat = None # liveness.Heartbeat that pings silent clients and evicts dead ones, created in main()
+rate_limiter = ratelimit.RateLimiter() # Message rate limits per client and per room, replaced in main()
+room_presence = presence.Presence() # Who is online or idle in every room, broadcast as coalesced deltas, replaced in main()
+file_relay = transfer.Relay(active_clients.find_username) # Routes file transfers between two clients of a room
+tls_context = None # SSL context when started with --tls, None for plain TCP
+PING_FRAME = framing.encode_frame(framing.CONTROL, liveness.PING)
+PONG_FRAME = framing.encode_frame(framing.CONTROL, liveness.PONG)
+PING_PAYLOAD = liveness.PING.encode() # CONTROL payload of a ping from a client
+
+# Metrics, shared with async_server.py (registering a name again returns the same metric)
+connections_accepted = metrics.counter('chat_connections_accepted_total', "Client connections accepted")
+bytes_received = metrics.counter('chat_bytes_received_total', "Bytes of complete frames received from clients")
+messages_received = metrics.counter('chat_messages_received_total', "Chat messages received from clients")
+metrics.gauge('chat_clients_connected', "Clients that joined a room", lambda: len(active_clients))
+metrics.gauge('chat_outbound_queued_frames', "Frames waiting in the outbound queues of all clients",
+              lambda: sum(broadcaster.queue_depths().values()))
+metrics.gauge('chat_outbound_queue_max_frames', "Frames waiting in the fullest outbound queue",
+              lambda: max(broadcaster.queue_depths().values(), default=0))
 
 # Function to listen for incoming messages from the client
-def listen_for_messages(client, username):
-    while True:
-        message = client.recv(2048).decode('utf-8')
-        if message != '':
-            final_message = f"{username}: {message}"
-            # final_message = f'' + username + ": " + message
-            broadcast(final_message)
-        else:
-            print(f"The message from {username} is empty.")
+def listen_for_messages(connection, decoder):
+    client, username = connection.sock, connection.username
+    bucket = rate_limiter.client_bucket() # Only this thread uses the client's bucket
+    try:
+        while True:
+            try:
+                frame = framing.recv_frame(client, decoder)
+            except (OSError, framing.FrameError) as e:
+                log.warning(f"Error receiving message from {username}: {e}")
+                frame = None
+            if frame is None:
+                # An empty read means the client closed the connection
+                log.info(f"{username} has disconnected.")
+                break
+            frame_type, payload = frame
+            connection.last_seen = time.monotonic() # Any frame shows the client is alive
+            bytes_received.inc(framing.HEADER.size + len(payload))
+            if frame_type == framing.COMPRESSED:
+                try:
+                    frame_type, payload = compression.decompress_frame(payload, connection.codec)
+                except framing.FrameError as e:
+                    log.warning(f"Dropped a frame from {username}: {e}")
+                    continue
+            if frame_type == framing.CONTROL and payload == PING_PAYLOAD:
+                send_to_client(PONG_FRAME, client)
+            if frame_type == framing.CONTROL and payload == presence.WHO:
+                send_presence(client, connection.room)
+            if frame_type in framing.FILE_FRAMES:
+                relay_file_frame(connection, frame_type, payload)
+                continue
+            if frame_type != framing.DATA:
+                continue
+            try:
+                message = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                log.warning(f"Dropped a message from {username}, it is not valid UTF-8.")
+                continue
+            if message != '':
+                messages_received.inc()
+                delay = rate_limiter.admit(bucket, connection.room)
+                if delay is None:
+                    log.debug(f"Dropped a message from {username}, it is over the rate limit.")
+                    continue
+                final_message = f"{username}: {message}"
+                # final_message = f'' + username + ": " + message
+                broadcast_message(final_message, connection.room)
+                room_presence.active(connection.room, username)
+                if delay > 0:
+                    # Not reading from the socket lets TCP flow control slow the client down
+                    time.sleep(delay)
+                # With the block policy, stop reading from this client until every queue has room
+                broadcaster.block_until_space()
+            else:
+                log.info(f"The message from {username} is empty.")
+    finally:
+        # However the loop ended, the client must not stay registered once its thread is gone
+        room_presence.leave(connection.room, username) # Before the username is free again for a new connection
+        active_clients.remove(connection)
+        file_relay.drop(connection)
+        broadcaster.remove(client)
+        client.close()
 
-# Function to send messages to all clients connected to the server
-def broadcast(message):
-    for client in active_clients:
-        send_to_client(message, client[1])
+# Function to record a chat message in the room's history and send it to everyone in the room
+def broadcast_message(message, room):
+    # Holding the history lock means a joining client gets this message either in its replay or live, never twice
+    with message_history.lock:
+        frame = message_history.record(room, message)
+        broadcaster.broadcast(frame, room)
 
-# Function to send messages to a specific client
-def send_to_client(message, recipient):
-    recipient.sendall(message.encode())
+# Function to register a client's outbound queue and replay the room's history to it
+def join_room(client, username, room, since, codec=None):
+    with message_history.lock:
+        broadcaster.add(client, username, room, codec)
+        # The ACK carries the room's latest sequence number and the negotiated compression, then the stored frames are queued as they are
+        ack = framing.encode_join(username, seq=message_history.latest(room), compress=codec)
+        send_to_client(framing.encode_frame(framing.ACK, ack), client)
+        for frame in message_history.replay(room, since):
+            send_to_client(frame, client)
+
+# Function to send the members of the room to a client, as of the last presence update
+def send_presence(client, room):
+    # Holding the presence lock means the snapshot is queued before or after a delta, never in the middle of a flush
+    with room_presence.lock:
+        send_to_client(framing.encode_frame(framing.PRESENCE, room_presence.snapshot(room)), client)
+
+# Function to send the presence changes of a room to everyone in it (called by the presence flusher with the lock held)
+def broadcast_presence(room, payload):
+    broadcaster.broadcast(framing.encode_frame(framing.PRESENCE, payload), room)
+
+# Function to send an encoded frame to a specific client
+def send_to_client(frame, recipient):
+    broadcaster.send(recipient, frame)
+
+# Function to pass a file transfer frame on to the other client of the transfer
+def relay_file_frame(connection, frame_type, payload):
+    route = file_relay.route(connection, frame_type, payload)
+    if route is None:
+        return
+    target, payload = route
+    # Stop reading from the sender while the receiver is behind, so the chunks do not pile up in its queue
+    while broadcaster.depth(target.sock) >= transfer.RELAY_QUEUE_LIMIT:
+        time.sleep(transfer.RELAY_WAIT)
+    send_to_client(framing.encode_frame(frame_type, payload), target.sock)
+
+# Function to ping a silent client (called by the heartbeat reaper, must not block)
+def ping_client(connection):
+    broadcaster.try_send(connection.sock, PING_FRAME)
+
+# Function to disconnect a client that stopped responding to pings
+def evict_client(connection):
+    log.info(f"{connection.username} did not answer the heartbeat, disconnecting.")
+    try:
+        # Wakes up the thread blocked in recv(), which then cleans up as if the client had left
+        connection.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
 
 # Function to handle client
-def handle_client(client):
+def handle_client(client, address):
     # print(f"Connection from {address[0]}:{address[1]} has been established.")
+    decoder = framing.FrameDecoder()
+    client.settimeout(liveness.JOIN_TIMEOUT) # A client that never sends its JOIN frame must not keep the thread forever
+    if tls_context is not None:
+        # The TLS handshake runs on this thread within the same timeout, so a slow one never holds up accept()
+        try:
+            tls.no_delay(client)
+            client = tls_context.wrap_socket(client, server_side=True)
+        except OSError as e:
+            log.info(f"TLS handshake with {address[0]}:{address[1]} failed: {e}")
+            client.close()
+            return
+        tls.record_handshake(client)
     while True:
-        username = client.recv(2048).decode('utf-8')
+        try:
+            frame = framing.recv_frame(client, decoder)
+        except (OSError, framing.FrameError) as e:
+            log.info(f"No JOIN frame from {address[0]}:{address[1]}: {e}")
+            frame = None
+        if frame is None:
+            client.close()
+            return
+        frame_type, payload = frame
+        if frame_type != framing.JOIN:
+            log.info(f"Expected a JOIN frame from {address[0]}:{address[1]}, got a frame of type {frame_type}.")
+            continue
+        try:
+            username, fields = framing.decode_join(payload)
+        except UnicodeDecodeError:
+            log.info(f"The JOIN frame from {address[0]}:{address[1]} is not valid UTF-8.")
+            client.close()
+            return
+        room = fields.get('room') or framing.DEFAULT_ROOM
         if username != '':
-            active_clients.append((username, client))
-            broadcast(f"[ANNOUNCEMENT]: [{username}] has joined the chat.")
+            connection = active_clients.add(client, address, username, room)
+            if connection is None:
+                log.info(f"Username '{username}' is already taken in room '{room}'.")
+                framing.send_frame(client, framing.CONTROL, "username-taken")
+                client.close()
+                return
+            client.settimeout(None)
+            if heartbeat is not None:
+                heartbeat.watch(connection)
+            connection.codec = compression.negotiate(fields.get('compress'), broadcaster.compress_threshold > 0)
+            join_room(client, username, room, history.parse_since(fields), connection.codec)
+            # The room learns about the join with the next presence delta, the client gets the members as of the last one
+            room_presence.join(room, username)
+            send_presence(client, room)
             break
         else:
-            print(f"Client's 'username' is empty.")
+            log.info(f"Client's 'username' is empty.")
 
     # Create a new thread to listen for messages from the client
-    threading.Thread(target=listen_for_messages, args=(client, username, )).start()
+    threading.Thread(target=listen_for_messages, args=(connection, decoder, )).start()
 
 
+# Function to parse the command-line options
+def parse_args():
+    parser = argparse.ArgumentParser(description="CS 4470 chat server")
+    parser.add_argument('--host', default=HOST, help="IP address to bind to")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument('--backlog', type=int, default=LISTEN_QUEUE, help="number of clients that can wait for a connection")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: two threads per client, async: all clients on one asyncio event loop")
+    parser.add_argument('--queue-size', type=int, default=fanout.DEFAULT_QUEUE_SIZE,
+                        help="number of outbound frames that may wait for a single client")
+    parser.add_argument('--overflow', choices=fanout.OVERFLOW_POLICIES, default=fanout.DROP_OLDEST,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument('--batch-bytes', type=int, default=0,
+                        help="coalesce queued frames into one send once this many bytes are pending (0 disables batching)")
+    parser.add_argument('--batch-delay', type=float, default=fanout.DEFAULT_BATCH_DELAY * 1000,
+                        help="milliseconds a frame may wait for its batch to fill up")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes, rooms are sharded across them (async engine only)")
+    parser.add_argument('--history-bytes', type=int, default=history.DEFAULT_MAX_BYTES,
+                        help="bytes of recent messages kept per room for replay (0 disables the history)")
+    parser.add_argument('--history-age', type=float, default=history.DEFAULT_MAX_AGE,
+                        help="seconds after which a message is no longer replayed")
+    parser.add_argument('--history-replay', type=int, default=history.DEFAULT_REPLAY_LIMIT,
+                        help="number of recent messages replayed to a client that joins")
+    parser.add_argument('--log-dir', help="directory of the durable message log (no log unless given)")
+    parser.add_argument('--log-segment-bytes', type=int, default=persistence.DEFAULT_SEGMENT_BYTES,
+                        help="size at which the message log starts a new segment file")
+    parser.add_argument('--log-retention-bytes', type=int, default=persistence.DEFAULT_RETENTION_BYTES,
+                        help="delete the oldest log segments once the log is larger than this")
+    parser.add_argument('--log-retention-age', type=float, default=persistence.DEFAULT_RETENTION_AGE,
+                        help="delete log segments whose messages are older than this many seconds")
+    parser.add_argument('--log-flush-interval', type=float, default=persistence.DEFAULT_FLUSH_INTERVAL * 1000,
+                        help="milliseconds a message may wait to be written and synced with the ones after it")
+    parser.add_argument('--compress-threshold', type=int, default=compression.DEFAULT_THRESHOLD,
+                        help="compress messages of at least this many bytes for clients that support it (0 disables compression)")
+    parser.add_argument('--client-rate', type=float, default=ratelimit.DEFAULT_CLIENT_RATE,
+                        help="messages per second a client may send (0 disables the limit)")
+    parser.add_argument('--client-burst', type=int, default=ratelimit.DEFAULT_CLIENT_BURST,
+                        help="messages a client may send at once above its rate")
+    parser.add_argument('--room-rate', type=float, default=ratelimit.DEFAULT_ROOM_RATE,
+                        help="messages per second all clients of a room may send together (0 disables the limit)")
+    parser.add_argument('--room-burst', type=int, default=ratelimit.DEFAULT_ROOM_BURST,
+                        help="messages a room may get at once above its rate")
+    parser.add_argument('--rate-policy', choices=ratelimit.POLICIES, default=ratelimit.THROTTLE,
+                        help="over the limit: stop reading from the client until it is back under (throttle) or drop the message")
+    parser.add_argument('--presence-window', type=float, default=presence.DEFAULT_WINDOW * 1000,
+                        help="milliseconds over which joins, leaves and idle changes of a room are coalesced into one update")
+    parser.add_argument('--idle-after', type=float, default=presence.DEFAULT_IDLE_AFTER,
+                        help="seconds without a chat message after which a client is shown as idle (0 disables idle tracking)")
+    parser.add_argument('--heartbeat-interval', type=float, default=liveness.DEFAULT_INTERVAL,
+                        help="seconds of silence after which a client is pinged (0 disables heartbeats)")
+    parser.add_argument('--heartbeat-timeout', type=float, default=liveness.DEFAULT_TIMEOUT,
+                        help="seconds a pinged client has to answer before it is disconnected")
+    parser.add_argument('--metrics-port', type=int,
+                        help=f"serve Prometheus metrics on http://{metrics.DEFAULT_HOST}:<port>/metrics (worker i uses port + i)")
+    parser.add_argument('--log-level', choices=console.LEVELS, default=console.DEFAULT_LEVEL,
+                        help="lowest level of the messages written to the console")
+    parser.add_argument('--tls', action='store_true', help="accept TLS connections only")
+    parser.add_argument('--tls-cert', default=tls.TEST_CERT, help="certificate of the server (a self-signed test certificate by default)")
+    parser.add_argument('--tls-key', default=tls.TEST_KEY, help="private key of the certificate")
+    args = parser.parse_args()
+    if args.workers > 1 and args.engine != 'async':
+        parser.error("--workers requires --engine async")
+    if args.workers > 1 and args.tls:
+        parser.error("--tls cannot be combined with --workers, a TLS session cannot be handed over to another worker")
+    return args
+
 # Define main function
 def main():
+    global broadcaster, message_history, heartbeat, rate_limiter, tls_context, room_presence
+    args = parse_args()
+    console.setup(args.log_level)
+    options = {'queue_size': args.queue_size, 'overflow': args.overflow,
+               'batch_bytes': args.batch_bytes, 'batch_delay': args.batch_delay / 1000,
+               'history_bytes': args.history_bytes, 'history_age': args.history_age,
+               'history_replay': args.history_replay, 'log_dir': args.log_dir,
+               'log_segment_bytes': args.log_segment_bytes, 'log_retention_bytes': args.log_retention_bytes,
+               'log_retention_age': args.log_retention_age, 'log_flush_interval': args.log_flush_interval / 1000,
+               'heartbeat_interval': args.heartbeat_interval, 'heartbeat_timeout': args.heartbeat_timeout,
+               'client_rate': args.client_rate, 'client_burst': args.client_burst, 'room_rate': args.room_rate,
+               'room_burst': args.room_burst, 'rate_policy': args.rate_policy, 'compress_threshold': args.compress_threshold,
+               'tls_cert': args.tls_cert if args.tls else None, 'tls_key': args.tls_key,
+               'presence_window': args.presence_window / 1000, 'idle_after': args.idle_after}
+    if args.workers > 1:
+        # Imported here so the threaded engine does not load asyncio
+        import shards
+        shards.run(args.host, args.port, args.backlog, args.workers, options, args.log_level, args.metrics_port)
+        return
+    if args.metrics_port is not None:
+        metrics.serve(metrics.DEFAULT_HOST, args.metrics_port)
+    if args.engine == 'async':
+        import async_server
+        async_server.run(args.host, args.port, args.backlog, **options)
+        return
+    broadcaster = fanout.Broadcaster(fanout.ClientQueue, args.queue_size, args.overflow, args.batch_bytes, args.batch_delay / 1000,
+                                     args.compress_threshold)
+    message_log = None
+    if args.log_dir:
+        message_log = persistence.MessageLog(args.log_dir, args.log_segment_bytes, args.log_retention_bytes,
+                                             args.log_retention_age, args.log_flush_interval / 1000)
+    message_history = history.MessageHistory(args.history_bytes, args.history_age, args.history_replay, message_log)
+    message_history.load()
+    rate_limiter = ratelimit.RateLimiter(args.client_rate, args.client_burst, args.room_rate, args.room_burst, args.rate_policy)
+    if args.tls:
+        tls_context = tls.server_context(args.tls_cert, args.tls_key)
+    room_presence = presence.Presence(args.presence_window / 1000, args.idle_after)
+    room_presence.run_flusher(broadcast_presence)
+    if args.heartbeat_interval > 0:
+        heartbeat = liveness.Heartbeat(ping_client, evict_client, lambda connection: active_clients.get(connection.id) is connection,
+                                       args.heartbeat_interval, args.heartbeat_timeout)
+        heartbeat.run_reaper()
+
     # Create a server socket class object
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # AF_INET -> IPv4, SOCK_STREAM -> TCP
+    # A restarted server can bind while the connections of the previous one are in TIME_WAIT, and its clients reconnect right away
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     
     # Bind the server to the IP address and port
     try:
-        server.bind((HOST, PORT))
-        print(f"Server is bound to the IP address {HOST} and port {PORT}.")
+        server.bind((args.host, args.port))
+        log.info(f"Server is bound to the IP address {args.host} and port {args.port}.")
     except:
-        print("Server failed to bind to the IP address {HOST} and port {PORT}.")
+        log.error(f"Server failed to bind to the IP address {args.host} and port {args.port}.")
         return
     
     # Listen for incoming connections
-    server.listen(LISTEN_QUEUE)
-    print(f"Server is listening on {HOST}:{PORT}")
+    server.listen(args.backlog)
+    log.info(f"Server is listening on {args.host}:{args.port}")
 
     # While loop to keep listening for incoming connections
-    while True:
-        # Accept incoming connections
-        client, address = server.accept()
-        print(f"Connected: {address[0]}:{address[1]}.")
+    try:
+        while True:
+            # Accept incoming connections
+            client, address = server.accept()
+            connections_accepted.inc()
+            liveness.enable_keepalive(client)
+            log.info(f"Connected: {address[0]}:{address[1]}.")
 
-        # Create a new thread to handle the client
-        threading.Thread(target=handle_client, args=(client, )).start()
+            # Create a new thread to handle the client
+            threading.Thread(target=handle_client, args=(client, address, )).start()
+    finally:
+        # Write the messages that are still waiting for the group commit
+        if message_history.log is not None:
+            message_history.log.close()
 
 
 
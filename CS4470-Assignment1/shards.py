@@ -0,0 +1,272 @@
+"""
+Room sharding across worker processes for the asyncio server engine.
+
+python server.py --engine async --workers N starts N worker processes, each running the asyncio
+engine on its own core. All workers accept on the same port, either with their own SO_REUSEPORT
+socket (Linux, BSD) or on one listening socket inherited from the supervisor process.
+
+Every room is owned by one worker, chosen by hashing the room name. A worker that accepts a
+client for a room it does not own passes the client's socket to the owner over a Unix-domain
+datagram socket (SCM_RIGHTS), together with the JOIN frame and any bytes read after it, so all
+members of a room live in one process and a room broadcast never leaves its worker.
+Broadcasts that concern every room (the shutdown announcement) are sent by the supervisor to
+every worker over the same Unix-domain sockets.
+
+No worker accepts clients before every worker has bound its bus socket, otherwise a handoff
+to a worker that is still starting would fail and the client would be served by the wrong
+worker, splitting its room in two.
+"""
+import array
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import async_server
+import console
+import framing
+import metrics
+from console import log
+
+HANDOFF = b'H'  # Bus message carrying a client socket, its JOIN payload and the bytes read after it
+FORWARD = b'F'  # Bus message carrying an encoded frame for a room (or for every room)
+JOIN_LENGTH = struct.Struct('!I')
+ROOM_LENGTH = struct.Struct('!H')
+MAX_BUS_MESSAGE = 1024 * 1024  # Largest bus datagram, a handoff carries at most one recv() of client data
+HANDOFF_TIMEOUT = 5.0  # Seconds to keep retrying a handoff while the owner's bus queue is full
+STARTUP_TIMEOUT = 30.0  # Seconds a worker waits for the others to bind their bus sockets
+SUPERVISOR_CHECK_INTERVAL = 1.0  # Seconds between two checks of a worker that its supervisor is still alive
+HAVE_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+def shard_for(room, count):
+    """Return the index of the worker that owns a room (stable across processes, unlike hash())."""
+    return zlib.crc32(room.encode('utf-8')) % count
+
+
+def bus_path(bus_dir, index):
+    """Return the path of the Unix-domain socket of a worker."""
+    return os.path.join(bus_dir, f"shard-{index}.sock")
+
+
+def encode_forward(room, frame):
+    """Build a FORWARD bus message, room None means every room."""
+    room = (room or '').encode('utf-8')
+    return FORWARD + ROOM_LENGTH.pack(len(room)) + room + frame
+
+
+class Shard:
+    """
+    Bus endpoint of one worker process.
+    - adopt(sock, join_payload, decoder): called for every client socket handed over by another worker.
+    - deliver(room, frame): called for every frame the supervisor sends to the worker's clients.
+    """
+
+    def __init__(self, index, count, bus_dir, adopt, deliver):
+        self.index = index
+        self.count = count
+        self.bus_dir = bus_dir
+        self.adopt = adopt
+        self.deliver = deliver
+        self.bus = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bus.bind(bus_path(bus_dir, index))
+        self.bus.setblocking(False)
+
+    def start(self, loop):
+        """Start receiving bus messages on the event loop."""
+        loop.add_reader(self.bus.fileno(), self.receive)
+
+    def owns(self, room):
+        """Return True if this worker serves the given room."""
+        return shard_for(room, self.count) == self.index
+
+    async def hand_off(self, client, join_payload, decoder):
+        """
+        Pass a client socket to the worker that owns its room and close the local copy.
+        - Waits while the owner's bus queue is full (Linux queues only a few datagrams per socket,
+          see net.unix.max_dgram_qlen), which happens when many clients connect at once.
+        - Return False if the owner could not be reached, the client is then served here.
+        """
+        owner = shard_for(framing.decode_join(join_payload)[1].get('room') or framing.DEFAULT_ROOM, self.count)
+        # Frames the decoder already parsed go back in front of the bytes it has not parsed yet
+        leftover = b''.join(framing.encode_frame(frame_type, payload) for frame_type, payload in decoder.ready)
+        message = HANDOFF + JOIN_LENGTH.pack(len(join_payload)) + join_payload + leftover + bytes(decoder.buffer)
+        # socket.send_fds() ignores its address argument, so build the SCM_RIGHTS message here
+        rights = (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [client.fileno()]))
+        deadline = time.monotonic() + HANDOFF_TIMEOUT
+        delay = 0.001
+        while True:
+            try:
+                self.bus.sendmsg([message], [rights], 0, bus_path(self.bus_dir, owner))
+                break
+            except BlockingIOError as e:
+                if time.monotonic() >= deadline:
+                    log.error(f"Could not hand the client over to worker {owner}: {e}")
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+            except OSError as e:
+                log.error(f"Could not hand the client over to worker {owner}: {e}")
+                return False
+        client.close()
+        return True
+
+    def receive(self):
+        """Handle every bus message that is waiting (called by the event loop)."""
+        while True:
+            try:
+                message, fds, _, _ = socket.recv_fds(self.bus, MAX_BUS_MESSAGE, 1)
+            except BlockingIOError:
+                return
+            kind = message[:1]
+            if kind == HANDOFF and fds:
+                (join_length,) = JOIN_LENGTH.unpack_from(message, 1)
+                start = 1 + JOIN_LENGTH.size
+                join_payload = message[start:start + join_length]
+                client = socket.socket(fileno=fds[0])
+                client.setblocking(False)
+                decoder = framing.FrameDecoder()
+                decoder.ready.extend(decoder.feed(message[start + join_length:]))
+                self.adopt(client, join_payload, decoder)
+            elif kind == FORWARD:
+                (room_length,) = ROOM_LENGTH.unpack_from(message, 1)
+                start = 1 + ROOM_LENGTH.size
+                room = message[start:start + room_length].decode('utf-8') or None
+                self.deliver(room, message[start + room_length:])
+            else:
+                for fd in fds:
+                    os.close(fd)
+
+
+def create_listener(host, port, backlog, reuse_port):
+    """Create a listening socket, with SO_REUSEPORT so that every worker can bind its own."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(backlog)
+    return server
+
+
+async def serve_worker(index, count, bus_dir, server, ready):
+    """Serve clients of one worker process until it is terminated, once every worker is ready."""
+    loop = asyncio.get_running_loop()
+
+    def adopt(client, join_payload, decoder):
+        try:
+            address = client.getpeername()
+        except OSError:  # The client left while it was being handed over
+            client.close()
+            return
+        async_server.start_client(client, address, join_payload, decoder)
+
+    def deliver(room, frame):
+        async_server.broadcaster.broadcast(frame, room)
+
+    async_server.shard = Shard(index, count, bus_dir, adopt, deliver)
+    async_server.shard.start(loop)
+    try:
+        # Blocking is fine here, nothing else runs on the loop yet
+        ready.wait(STARTUP_TIMEOUT)
+    except threading.BrokenBarrierError:
+        log.error(f"Worker {index} stops: not every worker started within {STARTUP_TIMEOUT:g} seconds.")
+        return
+    log.info(f"Worker {index} (pid {os.getpid()}) is serving its rooms.")
+    with server:
+        await async_server.accept_clients(server)
+
+
+def watch_supervisor(supervisor):
+    """Start a daemon thread that stops this worker once the supervisor process is gone (e.g. killed with SIGKILL)."""
+    def watch():
+        while os.getppid() == supervisor:
+            time.sleep(SUPERVISOR_CHECK_INTERVAL)
+        log.error(f"The supervisor (pid {supervisor}) is gone, stopping worker {os.getpid()}.")
+        os.kill(os.getpid(), signal.SIGTERM)  # Stops like a terminate() of the supervisor would
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def run_worker(index, count, bus_dir, ready, supervisor, host, port, backlog, server, options, log_level, metrics_port):
+    """Entry point of a worker process."""
+    console.setup(log_level)  # The writer thread of the parent's console does not exist in this process
+    if metrics_port is not None:
+        metrics.serve(metrics.DEFAULT_HOST, metrics_port + index)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor handles Ctrl+C and stops the workers
+    # Turn the supervisor's terminate() into SystemExit, so the message log is closed properly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watch_supervisor(supervisor)
+    if server is None:
+        server = create_listener(host, port, backlog, reuse_port=True)
+    if options.get('log_dir'):
+        # Every worker owns a fixed set of rooms, so each one keeps its own log
+        options = dict(options, log_dir=os.path.join(options['log_dir'], f"worker-{index}"))
+    async_server.configure(**options)
+    try:
+        asyncio.run(serve_worker(index, count, bus_dir, server, ready))
+    finally:
+        async_server.close_log()
+
+
+def announce(bus_dir, count, message):
+    """Send a DATA frame to every client of every worker, from outside the workers."""
+    bus = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    with bus:
+        data = encode_forward(None, framing.encode_frame(framing.DATA, message))
+        for index in range(count):
+            try:
+                bus.sendto(data, bus_path(bus_dir, index))
+            except OSError:
+                pass
+
+
+def shutdown_signal(signum, frame):
+    """SIGTERM handler of the supervisor."""
+    raise KeyboardInterrupt
+
+
+def run(host, port, backlog, workers, options, log_level=console.DEFAULT_LEVEL, metrics_port=None):
+    """Start the worker processes and supervise them until Ctrl+C."""
+    bus_dir = tempfile.mkdtemp(prefix='chat-shards-')
+    server = None
+    try:
+        if HAVE_REUSEPORT:
+            # Bind once here to report errors early, every worker then binds its own socket
+            create_listener(host, port, backlog, reuse_port=True).close()
+        else:
+            server = create_listener(host, port, backlog, reuse_port=False)
+    except OSError:
+        log.error(f"Server failed to bind to the IP address {host} and port {port}.")
+        shutil.rmtree(bus_dir, ignore_errors=True)
+        return
+    log.info(f"Server is listening on {host}:{port} ({workers} async worker processes)")
+
+    ready = multiprocessing.Barrier(workers)  # Passed once every worker has bound its bus socket
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(index, workers, bus_dir, ready, os.getpid(), host, port, backlog, server,
+                                                         options, log_level, metrics_port))
+        for index in range(workers)
+    ]
+    # Stop on kill -TERM (e.g. from a service manager) like on Ctrl+C, so the workers are stopped too
+    signal.signal(signal.SIGTERM, shutdown_signal)
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        announce(bus_dir, workers, "[ANNOUNCEMENT]: The server is shutting down.")
+        time.sleep(0.5)  # Give the writer tasks a moment to deliver the announcement
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(bus_dir, ignore_errors=True)
@@ -0,0 +1,52 @@
+"""
+Tests of async_client.AsyncClient against a scripted server.
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import async_client  # noqa: E402
+import framing  # noqa: E402
+
+
+class MalformedFrameTest(unittest.IsolatedAsyncioTestCase):
+
+    async def serve(self, frames):
+        """Start a server that acknowledges the JOIN, then sends frames. Return its port."""
+        async def handle(reader, writer):
+            await framing.read_frame(reader, framing.FrameDecoder())
+            writer.write(framing.encode_frame(framing.ACK, framing.encode_join('bot', seq=0)))
+            for frame in frames:
+                writer.write(frame)
+            await writer.drain()
+            await reader.read()  # Keep the connection open until the client closes it
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return server.sockets[0].getsockname()[1]
+
+    async def test_truncated_message_is_dropped(self):
+        port = await self.serve([
+            framing.encode_frame(framing.MESSAGE, b'12'),  # Truncated before the newline
+            framing.encode_frame(framing.MESSAGE, b'x\nalice: hi'),  # Not a sequence number
+            framing.encode_frame(framing.MESSAGE, b'\xff\n'),  # Not UTF-8
+            framing.encode_frame(framing.MESSAGE, framing.encode_message(3, 'alice: still here')),
+        ])
+        client = async_client.AsyncClient('127.0.0.1', port, 'bot', auto_reconnect=False)
+        await client.connect()
+        try:
+            message = await asyncio.wait_for(client.receive(), 5)
+            self.assertEqual(message, async_client.Message(3, 'alice', 'still here'))
+            self.assertEqual(client.last_seq, 3)
+            self.assertFalse(client.task.done())
+        finally:
+            await client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests of history.MessageHistory with a persistence.MessageLog attached.
+    python -m pytest tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import framing  # noqa: E402
+import history  # noqa: E402
+import persistence  # noqa: E402
+
+
+def decode_seq(frame):
+    """Return the sequence number of an encoded MESSAGE frame."""
+    return framing.decode_message(frame[framing.HEADER.size:])[0]
+
+
+class RestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chat-history-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def restart(self, max_age):
+        """Return a MessageHistory loaded from the log, as a restarted server would."""
+        message_log = persistence.MessageLog(self.directory)
+        self.addCleanup(message_log.close)
+        messages = history.MessageHistory(max_age=max_age, log=message_log)
+        messages.load()
+        return messages
+
+    def test_restart_within_max_age_replays_the_messages(self):
+        messages = self.restart(max_age=3600)
+        for text in ('one', 'two', 'three'):
+            messages.record('lobby', text)
+        messages.log.close()
+
+        restarted = self.restart(max_age=3600)
+        self.assertEqual(restarted.latest('lobby'), 3)
+        self.assertEqual([decode_seq(frame) for frame in restarted.replay('lobby')], [1, 2, 3])
+
+    def test_restart_after_max_age_keeps_numbering(self):
+        messages = self.restart(max_age=0.05)
+        for text in ('one', 'two', 'three'):
+            messages.record('lobby', text)
+        messages.record('other', 'four')
+        messages.log.close()
+        time.sleep(0.1)  # Every message is now older than max_age
+
+        restarted = self.restart(max_age=0.05)
+        self.assertEqual(restarted.replay('lobby'), [])
+        self.assertEqual(restarted.latest('lobby'), 3)
+        self.assertEqual(restarted.latest('other'), 1)
+        self.assertEqual(decode_seq(restarted.record('lobby', 'five')), 4)
+        restarted.log.close()
+
+        message_log = persistence.MessageLog(self.directory)
+        self.addCleanup(message_log.close)
+        seqs = [(room, seq) for _, _, room, seq, _ in message_log.read()]
+        self.assertEqual(len(seqs), len(set(seqs)), "a (room, seq) pair was written twice")
+
+
+if __name__ == '__main__':
+    unittest.main()
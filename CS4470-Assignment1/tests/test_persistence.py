@@ -0,0 +1,55 @@
+"""
+Tests of persistence.MessageLog.
+    python -m pytest tests
+"""
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import persistence  # noqa: E402
+
+
+class FailedWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chat-log-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_failed_write_leaves_no_partial_record(self):
+        message_log = persistence.MessageLog(self.directory, flush_interval=0)
+        message_log.append('lobby', 1, b'first')
+        message_log.close()
+
+        message_log = persistence.MessageLog(self.directory, flush_interval=0)
+        self.addCleanup(message_log.close)
+        segment = message_log.segments[-1]
+        size, entries = segment.size, len(segment.index)
+
+        def disk_full(fd, data):
+            os.write(fd, bytes(data)[:len(data) // 2])  # Part of the record reaches the file
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+        with mock.patch.object(persistence, 'write_all', disk_full):
+            with self.assertRaises(OSError):
+                message_log.write_batch([(1, 0.0, persistence.encode_record(1, 0.0, 'lobby', 2, b'second'))])
+        self.assertEqual(segment.size, size)
+        self.assertEqual(len(segment.index), entries)
+        self.assertEqual(os.path.getsize(segment.path), size)
+
+        message_log.append('lobby', 2, b'third')
+        message_log.close()
+        message_log = persistence.MessageLog(self.directory)
+        self.addCleanup(message_log.close)
+        frames = [frame for _, _, _, _, frame in message_log.read()]
+        self.assertEqual(frames, [b'first', b'third'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Optional TLS for server.py, client.py and chat.py.
+
+The frames are the same with and without TLS, the socket is just wrapped (ssl.SSLSocket for
+blocking and selector code, ssl= for asyncio streams). Everything negotiates TLS 1.2 or later.
+
+Test certificates: certs/test-cert.pem is a self-signed ECDSA P-256 certificate for localhost
+and 127.0.0.1, and serves as its own CA on the client side. Its key is in the repository, so
+it is for tests and benchmarks only. To make a new one (e.g. with the server's own name):
+    openssl req -x509 -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -nodes -days 3650 \\
+        -subj "/CN=localhost" -addext "subjectAltName=DNS:localhost,IP:127.0.0.1" \\
+        -keyout certs/test-key.pem -out certs/test-cert.pem
+
+Session resumption: the server hands out session tickets (stateless, encrypted with a key of
+its SSL context, so they stay valid until the server process restarts). A client context keeps
+the latest session of every server it talked to, by host and port since several chat.py peers
+can listen on one host, and offers it on the next connection to the same server. A resumed
+handshake skips the certificate signature and its verification, the expensive part of a full
+handshake, which is what a reconnect storm after a network blip is made of. Tickets are per
+process: the workers of the sharded server cannot resume each other's sessions, and a
+restarted server falls back to full handshakes.
+"""
+import contextlib
+import contextvars
+import os
+import socket
+import ssl
+import threading
+
+import metrics
+
+CERT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'certs')
+TEST_CERT = os.path.join(CERT_DIR, 'test-cert.pem')
+TEST_KEY = os.path.join(CERT_DIR, 'test-key.pem')
+HANDSHAKE_TIMEOUT = 10.0  # Seconds a TLS handshake may take
+TICKETS = 4  # Session tickets sent per TLS 1.3 handshake (each can resume one connection)
+
+handshakes = metrics.counter('chat_tls_handshakes_total', "TLS handshakes completed by the server")
+resumed = metrics.counter('chat_tls_resumed_total', "TLS handshakes that resumed an earlier session")
+
+
+def server_context(certfile=TEST_CERT, keyfile=TEST_KEY):
+    """Return the SSL context of a server with the given certificate and private key."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = TICKETS
+    return context
+
+
+def client_context(cafile=TEST_CERT, check_hostname=True):
+    """
+    Return a ResumingContext that trusts the certificates signed by cafile.
+    - check_hostname False still verifies the certificate chain, for chat.py peers that are
+      addressed by IP and share one certificate.
+    """
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_verify_locations(cafile)
+    context.check_hostname = check_hostname
+    return context
+
+
+def peer_contexts(certfile=TEST_CERT, keyfile=TEST_KEY, cafile=TEST_CERT):
+    """Return the (server, client) contexts of a chat.py peer, which accepts and opens connections."""
+    return server_context(certfile, keyfile), client_context(cafile, check_hostname=False)
+
+
+def no_delay(sock):
+    """
+    Turn Nagle's algorithm off on a socket about to be wrapped. asyncio only does it for sockets
+    whose proto is IPPROTO_TCP, and socket.socket() leaves it at 0 (so do the sockets it accepts).
+    - With TLS 1.3 the server writes its session tickets right after the handshake, and the
+      next small record would otherwise wait for the peer's delayed ACK, about 40 ms.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass  # Not a TCP socket, or already closed
+
+
+def record_handshake(ssl_object):
+    """Count a handshake the server completed, and whether it was resumed."""
+    handshakes.inc()
+    if ssl_object.session_reused:
+        resumed.inc()
+
+
+# (host, port) of the server an asyncio connection of the current task is opened to, see ResumingContext.resuming()
+connecting_to = contextvars.ContextVar('connecting_to', default=None)
+
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Client context that keeps the latest session of every server, by (host, port).
+    - Blocking code passes session=session_for(host, port) to wrap_socket().
+    - asyncio streams have no session= option: open the connection within resuming(host, port)
+      and wrap_bio() offers the session.
+    - remember() stores the session of a connection. With TLS 1.3 the tickets arrive after the
+      handshake, so call it once something has been read (e.g. after the JOIN is acknowledged).
+    """
+
+    def __init__(self, protocol):
+        self.sessions = {}  # {(server_hostname, port): ssl.SSLSession}
+        self.sessions_lock = threading.Lock()
+
+    def session_for(self, host, port):
+        """Return the session to offer to a server, or None."""
+        with self.sessions_lock:
+            return self.sessions.get((host, int(port)))
+
+    def remember(self, ssl_object, port):
+        """Keep the session of a connection to the given port for the next one to the same server."""
+        session = ssl_object.session
+        if not ssl_object.server_side and session is not None and session.has_ticket:
+            with self.sessions_lock:
+                self.sessions[(ssl_object.server_hostname, int(port))] = session
+
+    @contextlib.contextmanager
+    def resuming(self, host, port):
+        """Make the asyncio connections opened by the current task within this block offer the session of (host, port)."""
+        token = connecting_to.set((host, port))
+        try:
+            yield
+        finally:
+            connecting_to.reset(token)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        # asyncio calls this from a callback that runs in a copy of the connecting task's context
+        address = connecting_to.get()
+        if session is None and not server_side and address is not None:
+            session = self.session_for(*address)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
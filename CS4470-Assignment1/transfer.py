@@ -0,0 +1,364 @@
+"""
+Chunked file transfer for chat.py peers, and for server.py clients through the server's relay.
+
+A file is cut into chunks of CHUNK_SIZE bytes, each sent as its own FILE_CHUNK frame. The
+sender takes the connection's send lock (or the I/O core's turn) once per chunk, so chat
+messages and other transfers on the same connection get through in between, never more than
+one chunk later.
+
+Protocol (the transfer id is ID_SIZE random bytes, written as hex in the text fields):
+- FILE_OFFER   sender -> receiver: encode_join(id, filename=, size=, sha256=), plus to=<username>
+               for the server's relay, which replaces it with from=<username>.
+- FILE_ACCEPT  receiver -> sender: encode_join(id, offset=N) asks for the file from byte N on.
+               The sender also rewinds to N when the receiver sees a gap (e.g. a chunk dropped
+               by the server's overflow policy).
+               status=done confirms the file arrived and its SHA-256 matches.
+               status=corrupt means it did not match, the file is sent again from byte 0.
+- FILE_CHUNK   sender -> receiver: the id, the offset of the chunk (CHUNK_PREFIX), then the data.
+
+Resuming: the receiver writes to <directory>/<sha256>.part and only renames the file once its
+hash has been verified. When the same file is offered again after the connection dropped,
+the receiver answers with the size of its .part file and only the rest is sent.
+"""
+import hashlib
+import os
+import socket
+import struct
+import threading
+
+import framing
+from console import log
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_DIRECTORY = 'downloads'
+ID_SIZE = 8  # Bytes of a transfer id
+CHUNK_PREFIX = struct.Struct(f'!{ID_SIZE}sQ')  # Transfer id and offset of the chunk in the file
+RELAY_QUEUE_LIMIT = 16  # Frames the server lets pile up for a receiver before it stops reading from the sender
+RELAY_WAIT = 0.005  # Seconds between two checks of the receiver's queue
+DONE = 'done'
+CORRUPT = 'corrupt'
+
+
+def chunk_header(transfer_id, offset, length):
+    """Return the frame header and chunk prefix that go in front of `length` bytes of file data."""
+    return framing.HEADER.pack(framing.FILE_CHUNK, CHUNK_PREFIX.size + length) + CHUNK_PREFIX.pack(transfer_id, offset)
+
+
+def parse_id(text):
+    """Return the transfer id of an OFFER or ACCEPT name, or None if it is not valid hex of the right size."""
+    try:
+        transfer_id = bytes.fromhex(text)
+    except ValueError:
+        return None
+    return transfer_id if len(transfer_id) == ID_SIZE else None
+
+
+def parse_offer(text, fields):
+    """Return (transfer id, filename, size, sha256) of a decoded FILE_OFFER, or None if any of them is missing or invalid."""
+    transfer_id = parse_id(text)
+    try:
+        size = int(fields['size'])
+        sha256 = fields['sha256']
+        name = fields['filename']
+    except (KeyError, ValueError):
+        return None
+    if transfer_id is None or size < 0 or name == '' or len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+        return None
+    return transfer_id, name, size, sha256
+
+
+def describe_sender(connection, fields):
+    """Return who a FILE_OFFER comes from: the from field set by the server's relay, else the peer's address."""
+    if fields.get('from'):
+        return fields['from']
+    if connection is None:
+        return "the server"
+    return f"{connection.address[0]}:{connection.address[1]}"
+
+
+def unique_path(directory, name):
+    """Return a path in directory for the file name that does not exist yet ("name (1).ext" and so on)."""
+    name = os.path.basename(name) or 'file'
+    stem, extension = os.path.splitext(name)
+    path = os.path.join(directory, name)
+    copy = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem} ({copy}){extension}")
+        copy += 1
+    return path
+
+
+def send_chunks(sock, send_lock, outgoing):
+    """
+    Send the chunks of a file on a blocking socket until all of them are sent.
+    - socket.sendfile() lets the kernel copy the data from the file to the socket (zero-copy).
+    - The send lock is taken once per chunk, so other frames get their turn in between.
+    """
+    try:
+        while (chunk := outgoing.next_chunk()) is not None:
+            offset, length = chunk
+            with send_lock:
+                sock.sendall(chunk_header(outgoing.id, offset, length))
+                if sock.sendfile(outgoing.file, offset, length) != length:
+                    raise OSError(f"{outgoing.name} got shorter while it was being sent")
+    except (OSError, ValueError) as e:  # ValueError: the file was closed because the connection ended
+        log.warning(f"Sending {outgoing.name} failed: {e}")
+        try:
+            sock.shutdown(socket.SHUT_RDWR)  # Part of a frame may have been sent, the stream cannot be used anymore
+        except OSError:
+            pass
+
+
+class OutgoingFile:
+    """A file being sent. next_chunk() hands out the chunks, restart() rewinds on the receiver's request."""
+
+    def __init__(self, path, connection):
+        self.file = open(path, 'rb')
+        self.name = os.path.basename(path)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.sha256 = hashlib.file_digest(self.file, 'sha256').hexdigest()
+        self.id = os.urandom(ID_SIZE)
+        self.connection = connection
+        self.offset = 0  # Next byte to send
+        self.running = False  # True while chunks are being sent
+        self.lock = threading.Lock()
+
+    def offer(self, **fields):
+        """Return the FILE_OFFER payload."""
+        return framing.encode_join(self.id.hex(), filename=self.name, size=self.size, sha256=self.sha256, **fields)
+
+    def restart(self, offset):
+        """Continue from offset. Return True if the caller has to start sending (nobody is sending right now)."""
+        with self.lock:
+            self.offset = min(max(offset, 0), self.size)
+            if self.running:
+                return False
+            self.running = True
+            return True
+
+    def next_chunk(self):
+        """Return (offset, length) of the next chunk to send, or None (and stop running) when all is sent."""
+        with self.lock:
+            if self.offset >= self.size:
+                self.running = False
+                return None
+            chunk = (self.offset, min(CHUNK_SIZE, self.size - self.offset))
+            self.offset += chunk[1]
+            return chunk
+
+    def read(self, offset, length):
+        """Read a chunk, for senders that cannot use socket.sendfile()."""
+        data = os.pread(self.file.fileno(), length, offset)
+        if len(data) != length:
+            raise OSError(f"{self.name} got shorter while it was being sent")
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class IncomingFile:
+    """A file being received into <directory>/<sha256>.part."""
+
+    def __init__(self, directory, transfer_id, name, size, sha256, connection):
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.connection = connection
+        self.directory = directory
+        self.part_path = os.path.join(directory, f"{sha256}.part")
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(self.part_path, 'ab')
+        self.received = self.file.tell()  # What an earlier attempt left behind
+        if self.received > size:
+            self.file.truncate(0)
+            self.received = 0
+        self.gap_reported = False  # A gap has been reported and the sender has not rewound yet
+
+    def finish(self):
+        """Verify the complete file. Return its final path, or None if the hash does not match (the .part is deleted)."""
+        self.file.close()
+        with open(self.part_path, 'rb') as part:
+            digest = hashlib.file_digest(part, 'sha256').hexdigest()
+        if digest != self.sha256:
+            os.remove(self.part_path)
+            return None
+        path = unique_path(self.directory, self.name)
+        os.replace(self.part_path, path)
+        return path
+
+    def close(self):
+        self.file.close()
+
+
+class Transfers:
+    """
+    The incoming and outgoing files of one process, over any number of connections.
+    - start_sending(connection, outgoing): called when a receiver asks for chunks and nobody is
+      sending this file, it sends outgoing.next_chunk() until that returns None.
+    - handle() is called by the receiving side of a connection for every FILE_* frame, reply(frame_type,
+      payload) sends a frame back on the same connection.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, start_sending=None):
+        self.directory = directory
+        self.start_sending = start_sending
+        self.incoming = {}  # Dictionary in the format {transfer id: IncomingFile}
+        self.outgoing = {}  # Dictionary in the format {transfer id: OutgoingFile}
+
+    def send(self, path, connection):
+        """Open a file to send over the connection and return it, the caller sends outgoing.offer() as a FILE_OFFER."""
+        outgoing = OutgoingFile(path, connection)
+        self.outgoing[outgoing.id] = outgoing
+        return outgoing
+
+    def handle(self, connection, frame_type, payload, reply):
+        if frame_type == framing.FILE_CHUNK:
+            self.on_chunk(payload, reply)
+        elif frame_type == framing.FILE_OFFER:
+            self.on_offer(connection, payload, reply)
+        elif frame_type == framing.FILE_ACCEPT:
+            self.on_accept(connection, payload)
+
+    def on_offer(self, connection, payload, reply):
+        text, fields = framing.decode_join(payload)
+        offer = parse_offer(text, fields)
+        if offer is None:
+            log.warning(f"Ignored an invalid file offer from {describe_sender(connection, fields)}.")
+            return
+        transfer_id, name, size, sha256 = offer
+        # A transfer of the same file that is still open (e.g. on a connection that just died) gives up its .part file
+        for other_id, other in list(self.incoming.items()):
+            if other.sha256 == sha256:
+                other.close()
+                del self.incoming[other_id]
+        incoming = IncomingFile(self.directory, transfer_id, name, size, sha256, connection)
+        self.incoming[transfer_id] = incoming
+        sender = describe_sender(connection, fields)
+        resumed = f", resuming at byte {incoming.received}" if incoming.received else ""
+        log.info(f"Receiving {os.path.basename(name)} ({size} bytes) from {sender}{resumed}.")
+        if incoming.received == size:
+            self.complete(incoming, reply)
+        else:
+            reply(framing.FILE_ACCEPT, framing.encode_join(text, offset=incoming.received))
+
+    def on_chunk(self, payload, reply):
+        if len(payload) < CHUNK_PREFIX.size:
+            return
+        transfer_id, offset = CHUNK_PREFIX.unpack_from(payload)
+        incoming = self.incoming.get(transfer_id)
+        if incoming is None:
+            return  # Already complete, or offered on another connection
+        if offset != incoming.received:
+            # Chunks before what was received are duplicates after a rewind, after it something got lost
+            if offset > incoming.received and not incoming.gap_reported:
+                incoming.gap_reported = True
+                reply(framing.FILE_ACCEPT, framing.encode_join(transfer_id.hex(), offset=incoming.received))
+            return
+        with memoryview(payload) as view:
+            data = view[CHUNK_PREFIX.size:]
+            if incoming.received + len(data) > incoming.size:
+                return
+            incoming.file.write(data)
+            incoming.received += len(data)
+        incoming.gap_reported = False
+        if incoming.received == incoming.size:
+            self.complete(incoming, reply)
+
+    def complete(self, incoming, reply):
+        """Verify a fully received file and tell the sender how it went."""
+        del self.incoming[incoming.id]
+        path = incoming.finish()
+        if path is None:
+            log.warning(f"{incoming.name} arrived corrupted, asking for it again.")
+            # Receive it again from scratch under the same id
+            incoming = IncomingFile(self.directory, incoming.id, incoming.name, incoming.size, incoming.sha256, incoming.connection)
+            self.incoming[incoming.id] = incoming
+            reply(framing.FILE_ACCEPT, framing.encode_join(incoming.id.hex(), offset=0, status=CORRUPT))
+            return
+        log.info(f"Received {incoming.name}, saved as {path}.")
+        reply(framing.FILE_ACCEPT, framing.encode_join(incoming.id.hex(), offset=incoming.size, status=DONE))
+
+    def on_accept(self, connection, payload):
+        text, fields = framing.decode_join(payload)
+        transfer_id = parse_id(text)
+        outgoing = self.outgoing.get(transfer_id)
+        if outgoing is None or outgoing.connection is not connection:
+            return
+        if fields.get('status') == DONE:
+            del self.outgoing[transfer_id]
+            outgoing.close()
+            log.info(f"{outgoing.name} was delivered and verified.")
+            return
+        if fields.get('status') == CORRUPT:
+            log.warning(f"{outgoing.name} arrived corrupted, sending it again.")
+        try:
+            offset = int(fields.get('offset', 0))
+        except ValueError:
+            return
+        if outgoing.restart(offset):
+            self.start_sending(connection, outgoing)
+
+    def drop(self, connection):
+        """Forget the transfers of a closed connection (the .part files stay for a later resume)."""
+        for transfers in (self.incoming, self.outgoing):
+            for transfer_id, transfer in list(transfers.items()):
+                if transfer.connection is connection:
+                    transfer.close()
+                    del transfers[transfer_id]
+
+
+class Relay:
+    """
+    Routes the FILE_* frames of server.py's clients between the two users of a transfer.
+    - find_user(username, room): returns the registry connection of a user, or None.
+    - route() returns (target connection, payload to forward), or None to drop the frame.
+    """
+
+    def __init__(self, find_user):
+        self.find_user = find_user
+        self.routes = {}  # Dictionary in the format {transfer id: (sender connection, receiver connection)}
+        self.lock = threading.Lock()
+
+    def route(self, connection, frame_type, payload):
+        if frame_type == framing.FILE_CHUNK:
+            route = self.routes.get(payload[:ID_SIZE])
+            if route is None or route[0] is not connection:
+                return None
+            return route[1], payload
+        try:
+            text, fields = framing.decode_join(payload)
+        except UnicodeDecodeError:
+            return None
+        transfer_id = parse_id(text)
+        if transfer_id is None:
+            return None
+        if frame_type == framing.FILE_OFFER:
+            if parse_offer(text, fields) is None:
+                return None  # Never pass on an offer the receiver could not handle
+            receiver = self.find_user(fields.pop('to', ''), connection.room)
+            if receiver is None or receiver is connection:
+                return None
+            with self.lock:
+                route = self.routes.setdefault(transfer_id, (connection, receiver))
+            if route != (connection, receiver):
+                return None  # Somebody else's transfer id
+            fields['from'] = connection.username
+            return receiver, framing.encode_join(text, **fields)
+        if frame_type == framing.FILE_ACCEPT:
+            route = self.routes.get(transfer_id)
+            if route is None or route[1] is not connection:
+                return None
+            if fields.get('status') == DONE:
+                with self.lock:
+                    self.routes.pop(transfer_id, None)
+            return route[0], payload
+        return None
+
+    def drop(self, connection):
+        """Forget the routes of a client that left."""
+        with self.lock:
+            for transfer_id, route in list(self.routes.items()):
+                if connection in route:
+                    del self.routes[transfer_id]